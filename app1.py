@@ -5,10 +5,37 @@ import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 import sqlite3
+import base64
+import bcrypt
 import hashlib
+import hmac
+import importlib
+import itertools
+import json
+import multiprocessing
+import openpyxl
+import os
+import queue
+import re
+import secrets
+import shutil
+import sys
+import tempfile
+import unicodedata
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+import threading
+import time
 import traceback
 
+try:
+    import pyarrow  # tùy chọn, dùng cho export Parquet
+    import pyarrow.parquet as pq
+except ImportError:
+    pyarrow = pq = None
+
 premium_sidebar = """
 <style>
 [data-testid="stSidebar"] {
@@ -102,14 +129,99 @@ NEXT_SUBJECTS = {
     'giai_tich_2': 'giai_tich_3',  # Môn năm sau
     'tieng_an_do_2': 'tieng_an_do_3',  # Môn năm sau
 }
+# Tên hiển thị của các môn năm sau (môn trong năm lấy tên từ SUBJECTS)
+NEXT_YEAR_SUBJECT_NAMES = {
+    'tu_tuong': 'Tư tưởng (Năm 2)',
+    'giai_tich_3': 'Giải tích 3 (Năm 2)',
+    'tieng_an_do_3': 'Tiếng Ấn Độ 3 (Năm 2)',
+}
 
 SEMESTER_1_SUBJECTS = ['triet', 'giai_tich_1', 'tieng_an_do_1', 'gdtc', 'thvp']
 SEMESTER_2_SUBJECTS = ['giai_tich_2', 'tieng_an_do_2', 'tvth', 'phap_luat', 'logic']
 ACADEMIC_YEAR = 1
 
+IMPORT_CHUNK_ROWS = 5000  # Số dòng đọc mỗi lần khi import, giới hạn bộ nhớ
+IMPORT_WORKERS = max(1, min(4, (os.cpu_count() or 1) - 1))  # Số tiến trình kiểm tra + tính điểm cho file lớn
+PARALLEL_IMPORT_MIN_BYTES = 16 * 1024 ** 2  # File nhỏ hơn xử lý ngay trong tiến trình (khởi động pool mất vài giây)
+IMPORT_CACHE_KIB = 256 * 1024  # Page cache của kết nối ghi khi import lớn (chỉ kết nối riêng của job)
+IMPORT_TEXT_DTYPES = {'mssv': str, 'student_name': str, 'class_name': str, 'cohort': str}
+SCORE_RANGE = (0.0, 10.0)  # Điểm hợp lệ khi import; dòng có điểm ngoài khoảng này bị loại
+
+GPA_SUBJECTS = [key for key, info in SUBJECTS.items() if info['counts_gpa']]
+# Thứ tự cột của một bản ghi điểm dạng rộng (grades_wide, import, save_grade)
+GRADE_COLUMNS = ['mssv', 'student_name', 'class_name', 'semester'] + list(SUBJECTS.keys()) + \
+                ['diem_tb', 'xep_loai', 'academic_year', 'cohort']
+# Phần lưu trong bảng grades; điểm từng môn nằm ở bảng scores (mỗi môn một dòng)
+GRADE_HEADER_COLUMNS = [col for col in GRADE_COLUMNS if col not in SUBJECTS]
+# Khóa tự nhiên của một bản ghi điểm (UNIQUE khi dữ liệu không còn trùng) và phần nội dung được băm để so sánh
+GRADE_KEY_COLUMNS = ['mssv', 'academic_year', 'semester']
+GRADE_HASH_COLUMNS = ['student_name', 'class_name', 'cohort'] + list(SUBJECTS.keys())
+
 # ======================== CẤU HÌNH DATABASE ========================
-def init_db(db_path='student_grades.db'):
-    conn = sqlite3.connect(db_path, check_same_thread=False)
+def _py_round(value, ndigits):
+    return None if value is None else round(value, ndigits)
+
+def fold_vi(text):
+    """Bỏ dấu tiếng Việt + chữ thường để tìm kiếm: 'Nguyễn Đức' -> 'nguyen duc'"""
+    if text is None:
+        return None
+    text = unicodedata.normalize('NFD', str(text)).replace('đ', 'd').replace('Đ', 'D')
+    return ''.join(ch for ch in text if unicodedata.category(ch) != 'Mn').lower()
+
+def _register_sql_functions(conn):
+    # round() của SQLite làm tròn half-up, khác round() của Python dùng ở calculate_average
+    conn.create_function('py_round', 2, _py_round, deterministic=True)
+    # Dùng trong trigger đồng bộ chỉ mục tìm kiếm
+    conn.create_function('fold_vi', 1, fold_vi, deterministic=True)
+
+DB_PATH = 'student_grades.db'
+DB_BUSY_TIMEOUT_MS = 15000   # Chờ khóa ghi thay vì báo 'database is locked' ngay
+DB_POOL_SIZE = 8             # Số kết nối rảnh tối đa giữ lại trong pool
+
+def _connect(db_path=DB_PATH):
+    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    # WAL: người đọc không chặn người ghi; NORMAL là đủ an toàn với WAL
+    conn.execute("PRAGMA synchronous = NORMAL")
+    _register_sql_functions(conn)
+    return conn
+
+def init_db(db_path=DB_PATH):
+    """Mở một kết nối riêng và bảo đảm schema (dùng cho script ngoài Streamlit)"""
+    conn = _connect(db_path)
+    init_schema(conn)
+    return conn
+
+@st.cache_resource
+def _connection_pool(db_path=DB_PATH):
+    """Khởi tạo schema + bật WAL một lần cho mỗi tiến trình, trả về pool kết nối rảnh"""
+    conn = _connect(db_path)
+    try:
+        conn.execute("PRAGMA journal_mode = WAL")
+        init_schema(conn)
+    finally:
+        conn.close()
+    return queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+@contextmanager
+def pooled_connection(db_path=DB_PATH):
+    """Mượn một kết nối trong pool cho một lượt chạy; mỗi kết nối chỉ được một thread dùng tại một thời điểm"""
+    pool = _connection_pool(db_path)
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _connect(db_path)
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+def init_schema(conn):
     c = conn.cursor()
     
     c.execute('''CREATE TABLE IF NOT EXISTS users (
@@ -128,40 +240,373 @@ def init_db(db_path='student_grades.db'):
         student_name TEXT NOT NULL,
         class_name TEXT,
         semester INTEGER DEFAULT 1,
-        triet REAL,
-        giai_tich_1 REAL,
-        giai_tich_2 REAL,
-        tieng_an_do_1 REAL,
-        tieng_an_do_2 REAL,
-        gdtc REAL,
-        thvp REAL,
-        tvth REAL,
-        phap_luat REAL,
-        logic REAL,
         diem_tb REAL,
         xep_loai TEXT,
         academic_year INTEGER DEFAULT 1,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        import_batch TEXT,
+        cohort TEXT,
+        content_hash INTEGER
+    )''')
+    _ensure_column(c, 'grades', 'import_batch', 'TEXT')
+    _ensure_column(c, 'grades', 'cohort', 'TEXT')
+    _ensure_column(c, 'grades', 'content_hash', 'INTEGER')
+    c.execute("UPDATE grades SET academic_year = ? WHERE academic_year IS NULL", (int(ACADEMIC_YEAR),))
+    # Năm học là khóa phân vùng: mọi truy vấn của trang đang làm việc đều lọc theo năm trước
+    c.execute("DROP INDEX IF EXISTS idx_grades_class")
+    c.execute("DROP INDEX IF EXISTS idx_grades_semester")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_grades_mssv_semester ON grades (mssv, semester)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_grades_year_semester ON grades (academic_year, semester)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_grades_year_class ON grades (academic_year, class_name)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_grades_year_cohort ON grades (academic_year, cohort)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_grades_import_batch ON grades (import_batch)")
+    _init_search_index(c)
+    _init_score_storage(c)
+    _backfill_content_hashes(conn)
+    ensure_unique_term_index(conn)
+    
+    # Bảng xếp hạng dựng sẵn theo năm học: mỗi dòng là điểm xếp hạng của một SV (học kỳ: một bản ghi),
+    # làm mới theo SV trong cùng transaction với các lần ghi điểm. Hạng không lưu mà đếm trên idx_rankings_order
+    # khi đọc, nên ghi một bản ghi không phải đánh số lại cả phạm vi.
+    _drop_if_missing_column(c, 'rankings', 'grade_id')
+    c.execute('''CREATE TABLE IF NOT EXISTS rankings (
+        mssv TEXT NOT NULL,
+        academic_year INTEGER NOT NULL,
+        scope TEXT NOT NULL,
+        grade_id INTEGER NOT NULL,
+        student_name TEXT,
+        class_name TEXT,
+        cohort TEXT,
+        diem_tb REAL NOT NULL,
+        diem_tb_hk1 REAL,
+        diem_tb_hk2 REAL,
+        so_ky INTEGER,
+        xep_loai TEXT,
+        PRIMARY KEY (mssv, academic_year, scope, grade_id)
+    ) WITHOUT ROWID''')
+    c.execute(f"CREATE INDEX IF NOT EXISTS idx_rankings_order ON rankings (academic_year, scope, {RANKING_ORDER})")
+    c.execute("SELECT 1 FROM rankings LIMIT 1")
+    if not c.fetchone():
+        refresh_rankings(conn)
+    
+    # Thống kê cộng dồn theo năm học cho Dashboard/Biểu đồ, cập nhật theo từng lần ghi điểm
+    _drop_if_missing_column(c, 'grade_stats', 'academic_year')
+    c.execute('''CREATE TABLE IF NOT EXISTS grade_stats (
+        academic_year INTEGER NOT NULL,
+        dim TEXT NOT NULL,
+        bucket TEXT NOT NULL,
+        records INTEGER NOT NULL DEFAULT 0,
+        n INTEGER NOT NULL DEFAULT 0,
+        total REAL NOT NULL DEFAULT 0,
+        min_value REAL,
+        max_value REAL,
+        PRIMARY KEY (academic_year, dim, bucket)
+    ) WITHOUT ROWID''')
+    # Bản cũ giữ một dòng cho mỗi sinh viên; số SV nay đọc từ rankings
+    c.execute("DELETE FROM grade_stats WHERE dim = 'student'")
+    c.execute("SELECT 1 FROM grade_stats LIMIT 1")
+    if not c.fetchone():
+        rebuild_grade_stats(conn)
+    
+    # Công việc nền (import / làm sạch / tính lại điểm); checkpoint ghi cùng transaction với từng khối
+    c.execute('''CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        params TEXT NOT NULL DEFAULT '{}',
+        progress REAL NOT NULL DEFAULT 0,
+        checkpoint INTEGER NOT NULL DEFAULT 0,
+        report TEXT,
+        error TEXT,
+        cancel_requested INTEGER NOT NULL DEFAULT 0,
+        created_by TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )''')
     
+    # Token phiên bị thu hồi trước hạn: 'token:<jti>' (đăng xuất) hoặc 'user:<id>' (mọi token cấp trước revoked_at)
+    c.execute('''CREATE TABLE IF NOT EXISTS session_revocations (
+        key TEXT PRIMARY KEY,
+        revoked_at INTEGER NOT NULL,
+        expires INTEGER NOT NULL
+    ) WITHOUT ROWID''')
+    
     c.execute("SELECT * FROM users WHERE username = 'admin'")
     if not c.fetchone():
-        admin_pass = hashlib.sha256('admin123'.encode()).hexdigest()
+        admin_pass = hash_password('admin123')
         c.execute("INSERT INTO users (username, password, fullname, role) VALUES (?, ?, ?, ?)",
                   ('admin', admin_pass, 'Quản trị viên', 'teacher'))
     
     conn.commit()
-    return conn
 
-# ======================== HÀM TIỆN ÍCH ========================
+def _ensure_column(c, table, column, decl):
+    """Thêm cột cho DB tạo từ phiên bản cũ (CREATE TABLE IF NOT EXISTS không sửa bảng đã có).
+    Trả về True nếu vừa thêm."""
+    c.execute(f"PRAGMA table_info({table})")
+    if column in [row[1] for row in c.fetchall()]:
+        return False
+    c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return True
+
+def _drop_if_missing_column(c, table, column):
+    """Bảng dẫn xuất (dựng lại được) có khóa cũ: xóa để tạo lại theo cấu trúc mới"""
+    c.execute(f"PRAGMA table_info({table})")
+    columns = [row[1] for row in c.fetchall()]
+    if columns and column not in columns:
+        c.execute(f"DROP TABLE {table}")
+
+def _init_score_storage(c):
+    """Điểm từng môn dạng dài: scores(grade_id, mssv, academic_year, semester, subject_key, score),
+    một dòng cho mỗi ô có điểm.
+    Thêm môn mới chỉ cần khai báo trong SUBJECTS; view grades_wide dựng lại cột theo SUBJECTS mỗi lần khởi tạo."""
+    c.execute('''CREATE TABLE IF NOT EXISTS scores (
+        grade_id INTEGER NOT NULL,
+        mssv TEXT NOT NULL,
+        semester INTEGER,
+        subject_key TEXT NOT NULL,
+        score REAL NOT NULL,
+        academic_year INTEGER,
+        PRIMARY KEY (grade_id, subject_key)
+    ) WITHOUT ROWID''')
+    if _ensure_column(c, 'scores', 'academic_year', 'INTEGER'):
+        c.execute("UPDATE scores SET academic_year = (SELECT academic_year FROM grades WHERE id = scores.grade_id)")
+    # Chỉ mục phủ: thống kê theo năm / môn / học kỳ không cần đọc bảng. Điểm của một SV đọc qua grades_wide
+    # (khóa chính grade_id) nên không cần chỉ mục theo mssv
+    c.execute("DROP INDEX IF EXISTS idx_scores_subject")
+    c.execute("DROP INDEX IF EXISTS idx_scores_student")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_scores_year_subject ON scores (academic_year, subject_key, semester, score)")
+    c.execute('''CREATE TRIGGER IF NOT EXISTS grades_scores_delete AFTER DELETE ON grades BEGIN
+        DELETE FROM scores WHERE grade_id = old.id;
+    END''')
+    _migrate_wide_scores(c)
+
+    subject_cols = ',\n'.join(
+        f"(SELECT score FROM scores s WHERE s.grade_id = g.id AND s.subject_key = '{key}') AS {key}"
+        for key in SUBJECTS.keys())
+    c.execute("DROP VIEW IF EXISTS grades_wide")
+    c.execute(f'''CREATE VIEW grades_wide AS
+        SELECT g.id, g.mssv, g.student_name, g.class_name, g.semester,
+        {subject_cols},
+        g.diem_tb, g.xep_loai, g.academic_year, g.updated_at, g.import_batch, g.cohort
+        FROM grades g''')
+
+def _backfill_content_hashes(conn):
+    """Băm nội dung cho các bản ghi ghi trước khi có cột content_hash"""
+    c = conn.cursor()
+    ids = [row[0] for row in c.execute("SELECT id FROM grades WHERE content_hash IS NULL")]
+    for chunk in _chunked(ids):
+        df = _query_grades(conn, f"WHERE id IN ({', '.join('?' * len(chunk))})", chunk)
+        c.executemany("UPDATE grades SET content_hash = ? WHERE id = ?",
+                      zip(grade_content_hashes(df).tolist(), df['id'].tolist()))
+
+def has_unique_term_index(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_grades_term'").fetchone() is not None
+
+def ensure_unique_term_index(conn):
+    """Tạo UNIQUE(mssv, academic_year, semester) khi dữ liệu không còn bản ghi trùng (DB cũ cần Làm sạch trước).
+    Trả về True nếu chỉ mục đã có - khi đó import chạy theo chế độ upsert."""
+    if has_unique_term_index(conn):
+        return True
+    duplicate = conn.execute("SELECT 1 FROM grades GROUP BY mssv, academic_year, semester "
+                             "HAVING COUNT(*) > 1 LIMIT 1").fetchone()
+    if duplicate:
+        return False
+    conn.execute("CREATE UNIQUE INDEX idx_grades_term ON grades (mssv, academic_year, semester)")
+    return True
+
+def _migrate_wide_scores(c):
+    """DB cũ lưu mỗi môn một cột REAL trong grades: chép sang scores rồi bỏ các cột đó"""
+    c.execute("PRAGMA table_info(grades)")
+    wide = [row[1] for row in c.fetchall() if row[1] in SUBJECTS]
+    if not wide:
+        return
+    for key in wide:
+        c.execute(f'''INSERT OR IGNORE INTO scores (grade_id, mssv, semester, subject_key, score, academic_year)
+                      SELECT id, mssv, semester, ?, {key}, academic_year FROM grades WHERE {key} IS NOT NULL''', (key,))
+    try:
+        for key in wide:
+            c.execute(f"ALTER TABLE grades DROP COLUMN {key}")
+    except sqlite3.OperationalError:
+        # SQLite < 3.35 không có DROP COLUMN: để trống cột cũ để không chép lại lần sau
+        c.execute(f"UPDATE grades SET {', '.join(f'{key} = NULL' for key in wide)}")
+
+def _init_search_index(c):
+    """Chỉ mục FTS5 trên MSSV + họ tên (đã bỏ dấu), đồng bộ với grades bằng trigger.
+    Mọi kết nối ghi vào grades phải đăng ký hàm fold_vi (xem _register_sql_functions)."""
+    try:
+        c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS grades_fts USING fts5(
+            mssv, student_name, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3 4')''')
+    except sqlite3.OperationalError:
+        return  # SQLite không có FTS5 -> search_grades dùng LIKE
+    c.execute('''CREATE TRIGGER IF NOT EXISTS grades_fts_insert AFTER INSERT ON grades BEGIN
+        INSERT INTO grades_fts (rowid, mssv, student_name) VALUES (new.id, new.mssv, fold_vi(new.student_name));
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS grades_fts_delete AFTER DELETE ON grades BEGIN
+        DELETE FROM grades_fts WHERE rowid = old.id;
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS grades_fts_update AFTER UPDATE OF mssv, student_name ON grades BEGIN
+        UPDATE grades_fts SET mssv = new.mssv, student_name = fold_vi(new.student_name) WHERE rowid = new.id;
+    END''')
+    c.execute("SELECT 1 FROM grades_fts LIMIT 1")
+    if not c.fetchone():
+        c.execute("INSERT INTO grades_fts (rowid, mssv, student_name) "
+                  "SELECT id, mssv, fold_vi(student_name) FROM grades")
+
+# ======================== XÁC THỰC ========================
+BCRYPT_ROUNDS = 12  # ~0.25 giây mỗi lần băm; hash cũ ít vòng hơn được băm lại khi đăng nhập
+AUTH_WORKERS = 4    # Số phép băm bcrypt chạy đồng thời (bcrypt nhả GIL, nhưng tốn CPU)
+# Token phiên lưu trong cookie SESSION_COOKIE (không đặt trên URL): tải lại trang trong thời hạn này
+# không cần đăng nhập lại. Thời hạn ngắn vì token là thông tin đăng nhập dùng được cho tới khi hết hạn.
+SESSION_TTL_SECONDS = 10 * 60
+SESSION_COOKIE = 'grades_session'
+USER_COLUMNS = 'id, username, password, fullname, role, student_id, created_at'
+
+def _bcrypt_input(password):
+    # bcrypt chỉ nhận tối đa 72 byte: mật khẩu dài hơn được rút gọn bằng SHA-256 trước
+    data = password.encode()
+    return data if len(data) <= 72 else base64.b64encode(hashlib.sha256(data).digest())
+
 def hash_password(password):
+    return bcrypt.hashpw(_bcrypt_input(password), bcrypt.gensalt(BCRYPT_ROUNDS)).decode()
+
+def _legacy_hash(password):
+    # SHA-256 không salt của phiên bản cũ
     return hashlib.sha256(password.encode()).hexdigest()
 
+def check_password(password, stored):
+    """So mật khẩu với hash đã lưu (bcrypt hoặc SHA-256 cũ). Trả về (đúng mật khẩu, cần băm lại)"""
+    if stored.startswith('$2'):
+        ok = bcrypt.checkpw(_bcrypt_input(password), stored.encode())
+        return ok, ok and int(stored.split('$')[2]) < BCRYPT_ROUNDS
+    ok = hmac.compare_digest(_legacy_hash(password), stored)
+    return ok, ok
+
+@st.cache_resource
+def _auth_executor(workers):
+    """Pool thread cho phép băm bcrypt: nhiều người đăng nhập cùng lúc không chiếm hết CPU của server"""
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='auth')
+
+@st.cache_resource
+def _dummy_hash():
+    # Băm giả cho tên đăng nhập không tồn tại, để thời gian phản hồi không lộ tài khoản nào có thật
+    return hash_password(secrets.token_hex(16))
+
 def verify_user(conn, username, password):
+    """Đăng nhập: trả về dòng users (USER_COLUMNS) nếu đúng mật khẩu, ngược lại None.
+    Hash SHA-256 cũ (hoặc bcrypt ít vòng) được thay bằng bcrypt mới ngay khi đăng nhập thành công."""
     c = conn.cursor()
-    hashed = hash_password(password)
-    c.execute("SELECT * FROM users WHERE username = ? AND password = ?", (username, hashed))
-    return c.fetchone()
+    c.execute(f"SELECT {USER_COLUMNS} FROM users WHERE username = ?", (username,))
+    user = c.fetchone()
+    executor = _auth_executor(AUTH_WORKERS)
+    if user is None:
+        executor.submit(check_password, password, _dummy_hash()).result()
+        return None
+    ok, rehash = executor.submit(check_password, password, user[2]).result()
+    if not ok:
+        return None
+    if rehash:
+        new_hash = executor.submit(hash_password, password).result()
+        # Chỉ thay nếu hash chưa bị đổi bởi một lượt đăng nhập khác
+        c.execute("UPDATE users SET password = ? WHERE id = ? AND password = ?", (new_hash, user[0], user[2]))
+        conn.commit()
+        user = user[:2] + (new_hash,) + user[3:]
+    return user
+
+SESSION_FIELDS = ['username', 'user_id', 'fullname', 'role', 'student_id']
+
+@st.cache_resource
+def _session_secret():
+    """Khóa ký token phiên. Mặc định sinh ngẫu nhiên cho mỗi tiến trình (token mất hiệu lực khi khởi động lại);
+    đặt cùng SESSION_SECRET cho mọi tiến trình để token còn dùng được sau khởi động lại và giữa các tiến trình"""
+    return os.environ.get('SESSION_SECRET', '').encode() or secrets.token_bytes(32)
+
+def _sign_session(payload):
+    return hmac.new(_session_secret(), payload.encode(), hashlib.sha256).hexdigest()
+
+def issue_session_token(user_fields):
+    """Token tự chứa: thông tin user, thời điểm cấp và hết hạn, ký HMAC. Server chỉ lưu các token bị thu hồi."""
+    now = int(time.time())
+    claims = {'jti': secrets.token_urlsafe(12), 'iat': now, 'exp': now + SESSION_TTL_SECONDS,
+              'user': {key: user_fields[key] for key in SESSION_FIELDS}}
+    payload = base64.urlsafe_b64encode(json.dumps(claims, ensure_ascii=False, separators=(',', ':')).encode())
+    payload = payload.decode().rstrip('=')
+    return f"{payload}.{_sign_session(payload)}"
+
+def _session_claims(token):
+    """Nội dung của token có chữ ký đúng và còn hạn; ngược lại None (kể cả token rác / ký tự ngoài ASCII)"""
+    payload, _, signature = (token if isinstance(token, str) else '').rpartition('.')
+    # compare_digest không nhận chuỗi có ký tự ngoài ASCII -> chỉ so chữ ký đúng dạng 64 ký tự hex
+    if not payload or not re.fullmatch(r'[0-9a-f]{64}', signature):
+        return None
+    if not hmac.compare_digest(_sign_session(payload), signature):
+        return None
+    try:
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    except ValueError:
+        return None
+    return claims if claims['exp'] > time.time() else None
+
+def resolve_session_token(conn, token):
+    """Thông tin user của một token còn hạn, chữ ký đúng và chưa bị thu hồi; ngược lại None.
+    Không đọc bảng users, không băm mật khẩu - chỉ tra bảng thu hồi theo khóa chính."""
+    claims = _session_claims(token)
+    if claims is None:
+        return None
+    revoked = conn.execute("SELECT 1 FROM session_revocations WHERE key = ? OR (key = ? AND revoked_at >= ?) LIMIT 1",
+                           (f"token:{claims['jti']}", f"user:{claims['user']['user_id']}", claims['iat'])).fetchone()
+    return None if revoked else dict(claims['user'])
+
+def _revoke_sessions(conn, key, expires):
+    now = int(time.time())
+    conn.execute("DELETE FROM session_revocations WHERE expires <= ?", (now,))
+    conn.execute("INSERT OR REPLACE INTO session_revocations (key, revoked_at, expires) VALUES (?, ?, ?)",
+                 (key, now, expires))
+    conn.commit()
+
+def revoke_session_token(conn, token):
+    claims = _session_claims(token)
+    if claims:
+        _revoke_sessions(conn, f"token:{claims['jti']}", claims['exp'])
+
+def revoke_user_sessions(conn, user_id):
+    """Thu hồi mọi token đã cấp cho user (khi xóa tài khoản); giữ tới khi token cuối cùng trong số đó hết hạn"""
+    _revoke_sessions(conn, f"user:{user_id}", int(time.time()) + SESSION_TTL_SECONDS)
+
+def start_session(fields, token):
+    st.session_state['logged_in'] = True
+    st.session_state['session_token'] = token
+    for key in SESSION_FIELDS:
+        st.session_state[key] = fields[key]
+
+def set_session_cookie(token, max_age=SESSION_TTL_SECONDS):
+    """Ghi (token rỗng: xóa) cookie phiên bằng script chạy trên trình duyệt - Streamlit không có API ghi cookie.
+    Trang đọc lại cookie qua st.context.cookies ở lần tải sau."""
+    st.html(f"""<script>
+        document.cookie = "{SESSION_COOKIE}={token}; Path=/; Max-Age={max_age if token else 0}; SameSite=Strict"
+            + (location.protocol === "https:" ? "; Secure" : "");
+    </script>""", unsafe_allow_javascript=True)
+
+def restore_session(conn):
+    """Khôi phục đăng nhập từ cookie phiên khi session mới (tải lại trang); cookie hỏng / hết hạn thì xóa"""
+    st.session_state['logged_in'] = False
+    # Bản cũ để token trên URL: bỏ đi, không dùng
+    st.query_params.pop('session', None)
+    token = st.context.cookies.get(SESSION_COOKIE)
+    if not token:
+        return
+    fields = resolve_session_token(conn, token)
+    if fields:
+        start_session(fields, token)
+    else:
+        st.session_state['session_cookie'] = ''
+
+def logout(conn):
+    revoke_session_token(conn, st.session_state.get('session_token'))
+    for key in list(st.session_state.keys()):
+        del st.session_state[key]
+    st.session_state['session_cookie'] = ''
+
+# ======================== HÀM TIỆN ÍCH ========================
 
 def calculate_grade(score):
     try:
@@ -188,189 +633,1535 @@ def calculate_average(row):
                 scores.append(num)
     return round(float(np.mean(scores)), 2) if scores else 0.0
 
-def can_take_semester_2(conn, mssv):
-    df = load_grades(conn)
-    student_sem1 = df[(df['mssv'] == mssv) & (df['semester'] == 1)]
-    
-    if student_sem1.empty:
+# ======================== TÍNH ĐIỂM HÀNG LOẠT ========================
+GRADE_THRESHOLDS = np.array([4.0, 5.5, 7.0, 8.5, 9.5])
+GRADE_LABELS = np.array(['Kém', 'Yếu', 'Trung bình', 'Khá', 'Giỏi', 'Xuất sắc'], dtype=object)
+
+def classify_scores(diem_tb):
+    """Phiên bản vector của calculate_grade (giá trị không hợp lệ/NaN -> 'Kém')"""
+    s = pd.to_numeric(pd.Series(np.asarray(diem_tb, dtype=object).ravel()), errors='coerce').to_numpy(dtype=float)
+    idx = np.searchsorted(GRADE_THRESHOLDS, s, side='right')
+    idx[np.isnan(s)] = 0
+    return GRADE_LABELS[idx]
+
+def score_grades(data):
+    """Tính điểm TB + xếp loại cho cả bảng một lần.
+    data: DataFrame có các cột môn học, hoặc ma trận NumPy (n x len(GPA_SUBJECTS)) theo thứ tự GPA_SUBJECTS.
+    Trả về (diem_tb, xep_loai) dạng ndarray, khớp calculate_average + calculate_grade từng dòng."""
+    if isinstance(data, pd.DataFrame):
+        matrix = np.column_stack([
+            pd.to_numeric(data[key], errors='coerce').to_numpy(dtype=float) if key in data.columns
+            else np.full(len(data), np.nan)
+            for key in GPA_SUBJECTS
+        ]) if len(data) else np.empty((0, len(GPA_SUBJECTS)))
+    else:
+        matrix = np.asarray(data, dtype=float).reshape(-1, len(GPA_SUBJECTS))
+
+    # Bỏ điểm âm / trống; cộng tuần tự theo cột để khớp np.mean trên danh sách điểm
+    valid = matrix >= 0
+    total = np.zeros(len(matrix))
+    for j in range(matrix.shape[1]):
+        total += np.where(valid[:, j], matrix[:, j], 0.0)
+    count = valid.sum(axis=1)
+    avg = np.divide(total, count, out=np.zeros(len(matrix)), where=count > 0)
+    # Từ 8 điểm trở lên np.mean cộng theo cặp -> tính lại đúng như vậy cho (ít) dòng này
+    for i in np.flatnonzero(count >= 8):
+        avg[i] = np.mean(matrix[i][valid[i]])
+
+    # round() của Python làm tròn chính xác, np.round thì không -> giữ round() để khớp kết quả cũ
+    diem_tb = np.array([round(v, 2) for v in avg.tolist()], dtype=float)
+    return diem_tb, classify_scores(diem_tb)
+
+# ======================== ĐIỀU KIỆN HỌC TIẾP ========================
+PASS_SCORE = 4.0  # Điểm đạt một môn; cũng là ngưỡng ĐTB các môn điều kiện để học HK2
+
+def compile_course_graph(subjects=SUBJECTS, next_subjects=NEXT_SUBJECTS):
+    """Dựng đồ thị môn học (DAG) từ khóa 'prerequisite' của SUBJECTS (cạnh bắt buộc) và NEXT_SUBJECTS
+    (cạnh học tiếp). Trả về dict gồm 'order' (thứ tự topo), 'prerequisites' {môn: [môn tiên quyết]},
+    'successors' {môn: [môn tiếp theo]} và 'semester_2_gate' (các môn HK1 là tiên quyết của môn HK2).
+    Báo ValueError nếu môn tiên quyết không tồn tại hoặc đồ thị có vòng."""
+    required = {(info['prerequisite'], key) for key, info in subjects.items() if info.get('prerequisite')}
+    unknown = sorted(before for before, _ in required if before not in subjects)
+    if unknown:
+        raise ValueError(f"Môn tiên quyết không có trong SUBJECTS: {', '.join(unknown)}")
+    edges = sorted(required | set(next_subjects.items()))
+    nodes = list(dict.fromkeys(list(subjects) + [node for edge in edges for node in edge]))
+    successors = {node: [] for node in nodes}
+    indegree = dict.fromkeys(nodes, 0)
+    for before, after in edges:
+        successors[before].append(after)
+        indegree[after] += 1
+    # Kahn: môn nào còn bậc vào > 0 sau khi duyệt hết là nằm trên một vòng
+    order = [node for node in nodes if indegree[node] == 0]
+    for node in order:
+        for after in successors[node]:
+            indegree[after] -= 1
+            if indegree[after] == 0:
+                order.append(after)
+    if len(order) < len(nodes):
+        raise ValueError(f"Đồ thị môn học có vòng: {', '.join(n for n in nodes if indegree[n] > 0)}")
+    prerequisites = {key: sorted(before for before, after in required if after == key) for key in subjects}
+    gate = [key for key in subjects
+            if subjects[key]['semester'] == 1
+            and any(before == key and subjects[after]['semester'] == 2 for before, after in required)]
+    return {'order': order, 'prerequisites': prerequisites, 'successors': successors, 'semester_2_gate': gate}
+
+COURSE_GRAPH = compile_course_graph()
+# Môn HK2 có môn tiên quyết và toàn bộ các môn tiên quyết đó, theo thứ tự trong SUBJECTS
+GATED_SUBJECTS = [key for key in SEMESTER_2_SUBJECTS if COURSE_GRAPH['prerequisites'][key]]
+PREREQUISITE_SUBJECTS = [key for key in SUBJECTS
+                         if any(key in COURSE_GRAPH['prerequisites'][after] for after in GATED_SUBJECTS)]
+ELIGIBILITY_COLUMNS = ['mssv', 'student_name', 'class_name', 'cohort', 'academic_year', 'gate_avg',
+                       'eligible_sem2', 'blocked_subjects', 'reason']
+
+def _join_names(mask, keys):
+    """Mỗi dòng của mặt nạ (SV x môn) -> tên các môn được đánh dấu, nối bằng dấu phẩy"""
+    names = np.full(mask.shape[0], '', dtype=object)
+    for j, key in enumerate(keys):
+        names = np.where(mask[:, j], names + np.where(names == '', '', ', ') + SUBJECTS[key]['name'], names)
+    return names
+
+def evaluate_eligibility(sem1):
+    """Xét điều kiện học HK2 cho nhiều SV trong một lượt, từ bản ghi HK1 (mỗi SV một dòng):
+    - eligible_sem2: đủ điểm mọi môn điều kiện (COURSE_GRAPH['semester_2_gate']) và ĐTB của chúng >= 4;
+      thiếu điểm một môn điều kiện là chưa đủ điều kiện
+    - blocked_subjects: các môn HK2 còn môn tiên quyết chưa đạt (< 4 hoặc chưa có điểm)
+    Trả về DataFrame theo ELIGIBILITY_COLUMNS (cột định danh không có trong sem1 thì bỏ qua)."""
+    gate = COURSE_GRAPH['semester_2_gate']
+    gate_scores = sem1[gate].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float).reshape(len(sem1), len(gate))
+    gate_missing = np.isnan(gate_scores)
+    gate_avg = gate_scores.mean(axis=1) if gate else np.full(len(sem1), np.nan)
+    eligible = ~gate_missing.any(axis=1) & (gate_avg >= PASS_SCORE) if gate else np.ones(len(sem1), dtype=bool)
+
+    passed = (sem1[PREREQUISITE_SUBJECTS].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+              >= PASS_SCORE).reshape(len(sem1), len(PREREQUISITE_SUBJECTS))
+    position = {key: i for i, key in enumerate(PREREQUISITE_SUBJECTS)}
+    blocked = _join_names(np.column_stack(
+        [~passed[:, [position[before] for before in COURSE_GRAPH['prerequisites'][key]]].all(axis=1)
+         for key in GATED_SUBJECTS]).reshape(len(sem1), len(GATED_SUBJECTS)), GATED_SUBJECTS)
+
+    # Lý do chưa đủ điều kiện: thiếu điểm môn điều kiện nào, hoặc ĐTB dưới ngưỡng
+    missing = _join_names(gate_missing, gate)
+    below = np.char.mod(f'ĐTB môn điều kiện %.2f < {PASS_SCORE:g}', np.nan_to_num(gate_avg)).astype(object)
+    reason = np.where(eligible, '', np.where(missing != '', 'chưa có điểm ' + missing, below))
+    result = sem1[[col for col in ELIGIBILITY_COLUMNS[:5] if col in sem1.columns]].reset_index(drop=True)
+    result['gate_avg'] = gate_avg
+    result['eligible_sem2'] = eligible
+    result['blocked_subjects'] = blocked
+    result['reason'] = reason
+    return result
+
+def can_take_semester_2(conn, mssv, academic_year=None):
+    """Điều kiện học HK2 của một SV (tra chỉ mục bản ghi HK1). Trả về (đủ điều kiện, thông báo)"""
+    row = get_student_sem1(conn, mssv, academic_year)
+    
+    if row is None:
         return False, "Chưa có điểm học kỳ 1"
     
-    row = student_sem1.iloc[0]
-    try:
-        giai_tich_1 = float(row.get('giai_tich_1') or 0)
-    except Exception:
-        giai_tich_1 = 0
-    try:
-        tieng_an_do_1 = float(row.get('tieng_an_do_1') or 0)
-    except Exception:
-        tieng_an_do_1 = 0
-    avg = (giai_tich_1 + tieng_an_do_1) / 2.0
-    
-    if avg >= 4:
-        return True, f"Đủ điều kiện (TB: {avg:.2f})"
-    else:
-        return False, f"Chưa đủ điều kiện (TB: {avg:.2f} < 4)"
+    result = evaluate_eligibility(row.to_frame().T).iloc[0]
+    blocked = f"; chưa học được: {result['blocked_subjects']}" if result['blocked_subjects'] else ""
+    if result['eligible_sem2']:
+        return True, f"Đủ điều kiện (TB: {result['gate_avg']:.2f}){blocked}"
+    return False, f"Chưa đủ điều kiện ({result['reason']}){blocked}"
+
+def load_semester_2_eligibility(conn, academic_year=ACADEMIC_YEAR, class_name=None):
+    """Điều kiện học HK2 của mọi SV có điểm HK1 trong năm học (hoặc một lớp), xét trong một lượt.
+    Mỗi SV lấy bản ghi HK1 đầu tiên như get_student_sem1."""
+    where, params = _filter_clause({'academic_year': int(academic_year), 'semester': 1, 'class_name': class_name})
+    cols = ['mssv', 'student_name', 'class_name', 'cohort', 'academic_year'] + \
+        list(dict.fromkeys(COURSE_GRAPH['semester_2_gate'] + PREREQUISITE_SUBJECTS))
+    sem1 = pd.read_sql_query(f"SELECT {', '.join(cols)} FROM grades_wide {where} ORDER BY id", conn, params=params)
+    return evaluate_eligibility(sem1.drop_duplicates('mssv'))
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def _semester_2_eligibility_cached(_conn, version, academic_year, class_name):
+    return load_semester_2_eligibility(_conn, academic_year, class_name)
+
+def get_semester_2_eligibility(conn, academic_year=ACADEMIC_YEAR, class_name=None):
+    return _semester_2_eligibility_cached(conn, get_data_version(), int(academic_year), class_name)
 
 # ======================== CHỨC NĂNG DATABASE ========================
-def load_grades(conn):
+def _coerce_grade_types(df):
+    for key in SUBJECTS.keys():
+        if key in df.columns:
+            df[key] = pd.to_numeric(df[key], errors='coerce')
+    if 'diem_tb' in df.columns:
+        df['diem_tb'] = pd.to_numeric(df['diem_tb'], errors='coerce').fillna(0.0)
+    return df
+
+def _query_grades(conn, clause="", params=()):
     try:
-        df = pd.read_sql_query("SELECT * FROM grades", conn)
-        for key in SUBJECTS.keys():
-            if key in df.columns:
-                df[key] = pd.to_numeric(df[key], errors='coerce')
-        if 'diem_tb' in df.columns:
-            df['diem_tb'] = pd.to_numeric(df['diem_tb'], errors='coerce').fillna(0.0)
-        return df
+        return _coerce_grade_types(pd.read_sql_query(f"SELECT * FROM grades_wide {clause}", conn, params=params))
     except Exception:
-        cols = ['id','mssv','student_name','class_name','semester'] + list(SUBJECTS.keys()) + ['diem_tb','xep_loai','academic_year','updated_at']
+        cols = ['id'] + GRADE_COLUMNS + ['updated_at', 'import_batch']
         return pd.DataFrame(columns=cols)
 
-def get_ranking_by_semester(df, semester=None):
-    """Xếp hạng sinh viên theo điểm GPA - ĐÃ SỬA THEO YÊU CẦU"""
-    if df.empty:
-        return pd.DataFrame()
-    
-    if semester == 'all' or semester is None:
-        # Xếp hạng tổng hợp - CHỈ những sinh viên có ĐỦ CẢ 2 KỲ
-        grouped = df.groupby('mssv')
-        
-        combined_rows = []
-        for mssv, group in grouped:
-            semesters = group['semester'].unique().tolist()
-            
-            # Chỉ lấy sinh viên có cả 2 kỳ
-            if len(semesters) == 2 and 1 in semesters and 2 in semesters:
-                sem1_row = group[group['semester'] == 1].iloc[0]
-                sem2_row = group[group['semester'] == 2].iloc[0]
-                
-                diem_tb_1 = float(sem1_row['diem_tb']) if pd.notna(sem1_row['diem_tb']) else 0
-                diem_tb_2 = float(sem2_row['diem_tb']) if pd.notna(sem2_row['diem_tb']) else 0
-                diem_tb_combined = round((diem_tb_1 + diem_tb_2) / 2, 2)
-                
-                combined_rows.append({
-                    'mssv': mssv,
-                    'student_name': sem1_row['student_name'],
-                    'class_name': sem1_row['class_name'],
-                    'semester': 'Cả 2 kỳ',
-                    'diem_tb': diem_tb_combined,
-                    'xep_loai': calculate_grade(diem_tb_combined),
-                    'diem_tb_hk1': diem_tb_1,
-                    'diem_tb_hk2': diem_tb_2
-                })
-        
-        if not combined_rows:
-            return pd.DataFrame()
-        
-        result_df = pd.DataFrame(combined_rows)
-        result_df = result_df.sort_values('diem_tb', ascending=False).reset_index(drop=True)
-        result_df['xep_hang'] = range(1, len(result_df) + 1)
-        return result_df
+def get_student_grades(conn, mssv):
+    """Các bản ghi điểm của một sinh viên qua các năm học (chỉ mục mssv, semester)"""
+    return _query_grades(conn, "WHERE mssv = ? ORDER BY academic_year, id", (mssv,))
+
+def get_semester_slice(conn, semester, class_name=None, academic_year=ACADEMIC_YEAR):
+    """Các bản ghi của một học kỳ trong một năm học, có thể lọc thêm theo lớp"""
+    where, params = _filter_clause({'academic_year': int(academic_year), 'semester': int(semester),
+                                    'class_name': class_name or None})
+    return _query_grades(conn, f"{where} ORDER BY id", params)
+
+def get_student_sem1(conn, mssv, academic_year=None):
+    """Bản ghi học kỳ 1 đầu tiên của sinh viên (trong năm học đã cho, mặc định năm gần nhất), hoặc None"""
+    if academic_year is None:
+        df = _query_grades(conn, "WHERE mssv = ? AND semester = 1 ORDER BY academic_year DESC, id LIMIT 1", (mssv,))
+    else:
+        df = _query_grades(conn, "WHERE mssv = ? AND semester = 1 AND academic_year = ? ORDER BY id LIMIT 1",
+                           (mssv, int(academic_year)))
+    return None if df.empty else df.iloc[0]
+
+# ======================== DUYỆT BẢNG ĐIỂM THEO TRANG ========================
+GRADE_PAGE_SIZE = 50
+GRADE_LIST_COLUMNS = ['id', 'mssv', 'student_name', 'class_name', 'semester', 'diem_tb', 'xep_loai',
+                      'academic_year', 'cohort']
+# Chỉ cho phép sắp xếp theo các cột này (tên cột được ghép thẳng vào SQL)
+GRADE_SORT_COLUMNS = {'id': 'Thứ tự nhập', 'mssv': 'MSSV', 'student_name': 'Họ tên',
+                      'class_name': 'Lớp', 'diem_tb': 'Điểm TB'}
+COMBINED_SORT_COLUMNS = {'xep_hang': 'Xếp hạng', 'mssv': 'MSSV', 'student_name': 'Họ tên',
+                         'class_name': 'Lớp', 'diem_tb': 'Điểm TB'}
+
+def _filter_clause(filters):
+    clauses, params = [], []
+    for col, value in filters.items():
+        if value is not None:
+            clauses.append(f"{col} = ?")
+            params.append(value)
+    return ("WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+def query_grades_page(conn, academic_year=ACADEMIC_YEAR, semester=None, class_name=None, xep_loai=None,
+                      cohort=None, sort_by='id', descending=False, page=1, page_size=GRADE_PAGE_SIZE):
+    """Một trang bản ghi điểm của một năm học (LIMIT/OFFSET trong SQLite).
+    Trả về (DataFrame của trang, tổng số bản ghi)"""
+    if sort_by not in GRADE_SORT_COLUMNS:
+        raise ValueError(f"Không hỗ trợ sắp xếp theo {sort_by}")
+    where, params = _filter_clause({'academic_year': int(academic_year), 'semester': semester,
+                                    'class_name': class_name, 'xep_loai': xep_loai, 'cohort': cohort})
+    total = conn.execute(f"SELECT COUNT(*) FROM grades {where}", params).fetchone()[0]
+    order = 'DESC' if descending else 'ASC'
+    page_df = pd.read_sql_query(
+        f"SELECT {', '.join(GRADE_LIST_COLUMNS)} FROM grades {where} "
+        f"ORDER BY {sort_by} {order}, id {order} LIMIT ? OFFSET ?",
+        conn, params=params + [page_size, (max(page, 1) - 1) * page_size])
+    return page_df, total
+
+def query_combined_page(conn, academic_year=ACADEMIC_YEAR, class_name=None, xep_loai=None, cohort=None,
+                        sort_by='xep_hang', descending=False, page=1, page_size=GRADE_PAGE_SIZE):
+    """Một trang bảng tổng hợp 2 kỳ của một năm học, đọc từ bảng rankings dựng sẵn"""
+    if sort_by not in COMBINED_SORT_COLUMNS:
+        raise ValueError(f"Không hỗ trợ sắp xếp theo {sort_by}")
+    where, params = _filter_clause({'academic_year': int(academic_year), 'scope': 'all',
+                                    'class_name': class_name, 'xep_loai': xep_loai, 'cohort': cohort})
+    total = conn.execute(f"SELECT COUNT(*) FROM rankings {where}", params).fetchone()[0]
+    if sort_by == 'xep_hang':
+        order_by = 'diem_tb ASC, grade_id DESC, mssv DESC' if descending else RANKING_ORDER
     else:
-        # Xếp hạng theo kỳ cụ thể - CHỈ lấy điểm của kỳ đó
-        semester_df = df[df['semester'] == semester].copy()
-        if semester_df.empty:
-            return pd.DataFrame()
-        semester_df = semester_df.sort_values('diem_tb', ascending=False).reset_index(drop=True)
-        semester_df['xep_hang'] = range(1, len(semester_df) + 1)
-        return semester_df
+        order_by = f"{sort_by} {'DESC' if descending else 'ASC'}, {RANKING_ORDER}"
+    page_df = pd.read_sql_query(
+        f"SELECT grade_id, mssv, student_name, class_name, diem_tb_hk1, diem_tb_hk2, diem_tb, xep_loai "
+        f"FROM rankings {where} ORDER BY {order_by} LIMIT ? OFFSET ?",
+        conn, params=params + [page_size, (max(page, 1) - 1) * page_size])
+    return _with_positions(conn, page_df, academic_year, 'all'), total
+
+def list_grade_classes(conn, academic_year=ACADEMIC_YEAR):
+    return [r[0] for r in conn.execute(
+        "SELECT DISTINCT class_name FROM grades WHERE academic_year = ? AND class_name IS NOT NULL "
+        "ORDER BY class_name", (int(academic_year),))]
+
+def list_cohorts(conn, academic_year=ACADEMIC_YEAR):
+    return [r[0] for r in conn.execute(
+        "SELECT DISTINCT cohort FROM grades WHERE academic_year = ? AND cohort IS NOT NULL ORDER BY cohort",
+        (int(academic_year),))]
+
+def list_academic_years(conn):
+    """Các năm học đang có dữ liệu (đọc từ grade_stats, mỗi năm một dòng)"""
+    return [r[0] for r in conn.execute(
+        "SELECT academic_year FROM grade_stats WHERE dim = 'overall' AND bucket = '' ORDER BY academic_year")]
+
+def search_grades(conn, term, limit=200):
+    """Tìm bản ghi theo tiền tố MSSV/họ tên, không phân biệt dấu ("nguyen" khớp "Nguyễn").
+    Dùng chỉ mục FTS5, kết quả xếp theo độ liên quan (bm25) và giới hạn số dòng."""
+    tokens = re.findall(r'\w+', fold_vi(term) or '')
+    if not tokens:
+        return pd.DataFrame(columns=GRADE_LIST_COLUMNS)
+    cols = ', '.join(f"g.{col}" for col in GRADE_LIST_COLUMNS)
+    try:
+        return pd.read_sql_query(
+            f"SELECT {cols} FROM grades_fts JOIN grades g ON g.id = grades_fts.rowid "
+            f"WHERE grades_fts MATCH ? ORDER BY grades_fts.rank, g.id LIMIT ?",
+            conn, params=(' '.join(f'"{t}"*' for t in tokens), limit))
+    except (sqlite3.OperationalError, pd.errors.DatabaseError):
+        # Không có FTS5: quét LIKE (chậm, vẫn phân biệt dấu)
+        pattern = f"%{term}%"
+        return pd.read_sql_query(
+            f"SELECT {cols} FROM grades g WHERE g.mssv LIKE ? OR g.student_name LIKE ? ORDER BY g.id LIMIT ?",
+            conn, params=(pattern, pattern, limit))
+
+# ======================== CACHE DỮ LIỆU ========================
+@st.cache_resource
+def _data_version_state():
+    """Bộ đếm phiên bản dữ liệu, dùng chung cho mọi session trong tiến trình"""
+    return {'version': 0, 'lock': threading.Lock()}
+
+def get_data_version():
+    return _data_version_state()['version']
+
+def bump_data_version():
+    """Gọi sau mỗi lần ghi bảng grades để vô hiệu hóa cache"""
+    state = _data_version_state()
+    with state['lock']:
+        state['version'] += 1
+
+# ======================== TỔNG HỢP CHO BIỂU ĐỒ ========================
+HISTOGRAM_BINS = np.linspace(0, 10, 21)  # 20 khoảng điểm TB, mỗi khoảng 0.5
+UNCLASSIFIED_LABEL = 'Chưa xếp loại'
+
+# Chiều thống kê có theo dõi min/max -> truy vấn tính lại biên khi xóa đúng giá trị min/max
+# (tham số: năm học, rồi bucket nếu có)
+STATS_EXTREMES = {
+    'overall': "SELECT MIN(COALESCE(diem_tb, 0)), MAX(COALESCE(diem_tb, 0)) FROM grades WHERE academic_year = ?",
+    'class': "SELECT MIN(COALESCE(diem_tb, 0)), MAX(COALESCE(diem_tb, 0)) FROM grades "
+             "WHERE academic_year = ? AND class_name = ?",
+    'semester': "SELECT MIN(COALESCE(diem_tb, 0)), MAX(COALESCE(diem_tb, 0)) FROM grades "
+                "WHERE academic_year = ? AND semester = ?",
+    'subject': "SELECT MIN(score), MAX(score) FROM scores WHERE academic_year = ? AND subject_key = ?",
+}
 
-def save_grade(conn, data):
+def _grade_stats_deltas(frame):
+    """Gom một nhóm dòng điểm thành các dòng (academic_year, dim, bucket, records, n, total, min, max)
+    của grade_stats"""
+    if frame is None or frame.empty:
+        return []
+    years = pd.to_numeric(frame['academic_year'], errors='coerce').fillna(ACADEMIC_YEAR).astype(int)
+    return [(int(year),) + delta
+            for year, part in frame.groupby(years.to_numpy())
+            for delta in _year_stats_deltas(part)]
+
+def _year_stats_deltas(frame):
+    diem_tb = pd.to_numeric(frame['diem_tb'], errors='coerce').fillna(0.0).to_numpy(dtype=float)
+    bins = np.minimum(np.searchsorted(HISTOGRAM_BINS, np.clip(diem_tb, 0, 10), side='right') - 1,
+                      len(HISTOGRAM_BINS) - 2)
+    semester = pd.to_numeric(frame['semester'], errors='coerce')
+    groups = [
+        ('overall', pd.Series('', index=frame.index), diem_tb, True),
+        ('class', frame['class_name'], diem_tb, True),
+        ('semester', semester.map(lambda v: str(int(v)), na_action='ignore'), diem_tb, True),
+        ('xep_loai', frame['xep_loai'].fillna(UNCLASSIFIED_LABEL), diem_tb, False),
+        ('bin', pd.Series(bins.astype(str), index=frame.index), diem_tb, False),
+    ]
+    deltas = []
+    for dim, keys, values, extremes in groups:
+        agg = (pd.DataFrame({'key': keys.to_numpy(dtype=object), 'v': values})
+               .groupby('key')['v'].agg(['size', 'count', 'sum', 'min', 'max']))
+        lows = agg['min'].tolist() if extremes else [None] * len(agg)
+        highs = agg['max'].tolist() if extremes else [None] * len(agg)
+        deltas.extend(
+            (dim, str(key), size, count, total, lo if pd.notna(lo) else None, hi if pd.notna(hi) else None)
+            for key, size, count, total, lo, hi in zip(agg.index.tolist(), agg['size'].tolist(), agg['count'].tolist(),
+                                                       agg['sum'].tolist(), lows, highs))
+    for key in SUBJECTS.keys():
+        scores = pd.to_numeric(frame[key], errors='coerce')
+        count = int(scores.count())
+        deltas.append(('subject', key, len(scores), count, float(scores.sum()),
+                       float(scores.min()) if count else None, float(scores.max()) if count else None))
+    return deltas
+
+STATS_SOURCE_COLUMNS = ', '.join(['id', 'mssv', 'class_name', 'semester'] + list(SUBJECTS.keys()) +
+                                 ['diem_tb', 'xep_loai', 'academic_year'])
+
+def _grade_stats_rows(conn, grade_ids):
+    """Đọc các cột cần cho thống kê của những dòng sắp bị xóa/sửa"""
+    parts = [pd.read_sql_query(f"SELECT {STATS_SOURCE_COLUMNS} FROM grades_wide WHERE id IN ({', '.join('?' * len(ids))})",
+                               conn, params=ids)
+             for ids in _chunked(grade_ids)]
+    return pd.concat(parts, ignore_index=True) if parts else None
+
+def update_grade_stats(conn, added=None, removed=None):
+    """Cập nhật grade_stats theo các dòng vừa thêm (added) / đã xóa (removed) bằng tổng và đếm cộng dồn.
+    Gọi sau khi đã ghi vào grades; xóa đúng giá trị min/max thì tính lại biên từ grades. Không commit."""
     c = conn.cursor()
+    c.executemany('''INSERT INTO grade_stats (academic_year, dim, bucket, records, n, total, min_value, max_value)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                     ON CONFLICT (academic_year, dim, bucket) DO UPDATE SET
+                         records = records + excluded.records, n = n + excluded.n, total = total + excluded.total,
+                         min_value = COALESCE(MIN(min_value, excluded.min_value), min_value, excluded.min_value),
+                         max_value = COALESCE(MAX(max_value, excluded.max_value), max_value, excluded.max_value)''',
+                  _grade_stats_deltas(added))
+
+    removals = _grade_stats_deltas(removed)
+    if not removals:
+        return
+    # Biên hiện tại của các chiều có min/max trong các năm bị ảnh hưởng (số dòng ~ số lớp + số môn)
+    years = sorted({year for year, *_ in removals})
+    bounds = {(year, dim, key): (lo, hi) for year, dim, key, lo, hi in c.execute(
+        f"SELECT academic_year, dim, bucket, min_value, max_value FROM grade_stats "
+        f"WHERE academic_year IN ({', '.join('?' * len(years))}) AND dim IN ({', '.join('?' * len(STATS_EXTREMES))})",
+        years + list(STATS_EXTREMES))}
+    stale = []
+    for year, dim, key, _, _, _, lo, hi in removals:
+        current = bounds.get((year, dim, key))
+        if lo is not None and current is not None and ((current[0] is not None and lo <= current[0]) or
+                                                       (current[1] is not None and hi >= current[1])):
+            stale.append((year, dim, key))
+    c.executemany('''UPDATE grade_stats SET records = records - ?, n = n - ?,
+                         total = CASE WHEN n - ? > 0 THEN total - ? ELSE 0 END
+                     WHERE academic_year = ? AND dim = ? AND bucket = ?''',
+                  [(records, n, n, total, year, dim, key) for year, dim, key, records, n, total, _, _ in removals])
+    c.execute("DELETE FROM grade_stats WHERE records <= 0")
+
+    for year, dim, key in stale:
+        query = STATS_EXTREMES[dim]
+        c.execute(query, (year, key) if query.count('?') == 2 else (year,))
+        lo, hi = c.fetchone()
+        c.execute("UPDATE grade_stats SET min_value = ?, max_value = ? "
+                  "WHERE academic_year = ? AND dim = ? AND bucket = ?", (lo, hi, year, dim, key))
+
+def rebuild_grade_stats(conn):
+    """Dựng lại grade_stats từ toàn bộ bảng grades theo từng khối (khởi tạo / sửa sai lệch). Không commit."""
+    conn.execute("DELETE FROM grade_stats")
+    for chunk in pd.read_sql_query(f"SELECT {STATS_SOURCE_COLUMNS} FROM grades_wide", conn,
+                                   chunksize=IMPORT_CHUNK_ROWS):
+        update_grade_stats(conn, added=chunk)
+
+def read_grade_aggregates(conn, academic_year=ACADEMIC_YEAR):
+    """Các bảng tổng hợp nhỏ của một năm học cho Dashboard, Biểu đồ và Thống kê chung, đọc từ grade_stats
+    (số dòng đọc tỉ lệ với số lớp + số môn, không phụ thuộc kích thước bảng điểm).
+    Trả về None nếu năm đó chưa có dữ liệu."""
+    academic_year = int(academic_year)
+    stats = pd.read_sql_query("SELECT dim, bucket, records, n, total, min_value, max_value FROM grade_stats "
+                              "WHERE academic_year = ? ORDER BY dim, bucket", conn,
+                              params=(academic_year,))
+    overall = stats[stats['dim'] == 'overall']
+    if overall.empty or overall['records'].iloc[0] <= 0:
+        return None
+    stats['mean'] = np.where(stats['n'] > 0, stats['total'] / stats['n'].where(stats['n'] > 0, 1), np.nan)
+    overall = stats[stats['dim'] == 'overall'].iloc[0]
+    by_dim = {dim: part for dim, part in stats.groupby('dim')}
+    empty = stats.iloc[0:0]
+
+    xep_loai = by_dim.get('xep_loai', empty).sort_values(['records', 'bucket'], ascending=[False, True], kind='mergesort')
+    excellent = int(xep_loai.loc[xep_loai['bucket'].isin(['Giỏi', 'Xuất sắc']), 'records'].sum())
+
+    subjects = by_dim.get('subject', empty).set_index('bucket')
+    subject_avg = [
+        {'Môn': info['name'], 'Điểm TB': float(subjects.at[key, 'mean'])}
+        for key, info in SUBJECTS.items()
+        if info['counts_gpa'] and key in subjects.index and subjects.at[key, 'n'] > 0
+    ]
+
+    semesters = by_dim.get('semester', empty).assign(bucket=lambda d: d['bucket'].astype(int)).sort_values('bucket')
+    semester_avg = pd.DataFrame({
+        'semester': semesters['bucket'].map({1: 'Học kỳ 1', 2: 'Học kỳ 2'}).to_numpy(),
+        'diem_tb': semesters['mean'].to_numpy(),
+    })
+    classes = by_dim.get('class', empty)
+
+    bins = by_dim.get('bin', empty).set_index('bucket')['records']
+    edges = HISTOGRAM_BINS
+    # Mỗi SV có điểm trong năm có đúng một dòng xếp hạng tích lũy của năm đó (đếm trên idx_rankings_order)
+    students = conn.execute("SELECT COUNT(*) FROM rankings WHERE academic_year = ? AND scope = 'cum'",
+                            (academic_year,)).fetchone()[0]
+
+    return {
+        'overview': {
+            'students': int(students),
+            'records': int(overall['records']),
+            'classes': len(classes),
+            'mean': float(overall['mean']),
+            'max': float(overall['max_value']),
+            'min': float(overall['min_value']),
+            'excellent_rate': float(excellent / overall['records'] * 100),
+        },
+        'semester_counts': dict(zip(semesters['bucket'].tolist(), semesters['records'].astype(int).tolist())),
+        'xep_loai_counts': pd.DataFrame({'xep_loai': xep_loai['bucket'].to_numpy(),
+                                         'count': xep_loai['records'].astype(int).to_numpy()}),
+        'class_avg': pd.DataFrame({'class_name': classes['bucket'].to_numpy(), 'diem_tb': classes['mean'].to_numpy()}),
+        'subject_avg': pd.DataFrame(subject_avg, columns=['Môn', 'Điểm TB']),
+        'semester_avg': semester_avg,
+        'histogram': pd.DataFrame({
+            'Khoảng điểm': [f"{lo:.1f}-{hi:.1f}" for lo, hi in zip(edges[:-1], edges[1:])],
+            'Số lượng': [int(bins.get(str(i), 0)) for i in range(len(edges) - 1)],
+        }),
+    }
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def _grade_aggregates_cached(_conn, version, academic_year):
+    return read_grade_aggregates(_conn, academic_year)
+
+def get_grade_aggregates(conn, academic_year=ACADEMIC_YEAR):
+    """Bảng tổng hợp của một năm học, đọc một lần cho mỗi phiên bản dữ liệu"""
+    return _grade_aggregates_cached(conn, get_data_version(), academic_year)
+
+def query_subject_stats(conn, academic_year=ACADEMIC_YEAR, semester=None):
+    """Thống kê từng môn theo học kỳ của một năm học bằng GROUP BY trên scores
+    (chỉ quét phần idx_scores_year_subject của năm đó)"""
+    where, params = _filter_clause({'academic_year': int(academic_year),
+                                    'semester': int(semester) if semester is not None else None})
+    df = pd.read_sql_query(f'''SELECT subject_key, semester, COUNT(*) AS n, AVG(score) AS mean,
+                                     MIN(score) AS min, MAX(score) AS max
+                              FROM scores {where} GROUP BY subject_key, semester''', conn, params=params)
+    order = {key: i for i, key in enumerate(SUBJECTS.keys())}
+    df['subject_name'] = df['subject_key'].map(lambda key: SUBJECTS.get(key, {}).get('name', key))
+    return (df.assign(_order=df['subject_key'].map(order).fillna(len(order)))
+              .sort_values(['semester', '_order', 'subject_key']).drop(columns='_order').reset_index(drop=True))
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def _subject_stats_cached(_conn, version, academic_year):
+    return query_subject_stats(_conn, academic_year)
+
+def get_subject_stats(conn, academic_year=ACADEMIC_YEAR):
+    return _subject_stats_cached(conn, get_data_version(), academic_year)
+
+# Cách xử lý đồng điểm khi xếp hạng (ROW_NUMBER / RANK / DENSE_RANK, xem RANK_WINDOWS)
+RANK_METHODS = {
+    'first': 'Theo thứ tự (1, 2, 3)',
+    'min': 'Đồng hạng kiểu thi đấu (1, 1, 3)',
+    'dense': 'Đồng hạng liên tiếp (1, 1, 2)',
+}
+
+# ======================== BẢNG XẾP HẠNG DỰNG SẴN ========================
+RANKING_SCOPES = ('1', '2', 'all', 'cum')
+# Thứ tự xếp hạng trong một phạm vi; đồng điểm: 'first' theo id bản ghi (học kỳ) rồi MSSV ('all', 'cum': grade_id = 0)
+RANKING_ORDER = 'diem_tb DESC, grade_id, mssv'
+RANK_WINDOWS = {
+    'first': f'ROW_NUMBER() OVER (ORDER BY {RANKING_ORDER})',
+    'min': 'RANK() OVER (ORDER BY diem_tb DESC)',
+    'dense': 'DENSE_RANK() OVER (ORDER BY diem_tb DESC)',
+}
+
+def _ranking_label_sql(expr):
+    # Cùng ngưỡng với calculate_grade
+    return (f"CASE WHEN {expr} >= 9.5 THEN 'Xuất sắc' WHEN {expr} >= 8.5 THEN 'Giỏi' "
+            f"WHEN {expr} >= 7.0 THEN 'Khá' WHEN {expr} >= 5.5 THEN 'Trung bình' "
+            f"WHEN {expr} >= 4.0 THEN 'Yếu' ELSE 'Kém' END")
+
+def refresh_rankings(conn, students=None):
+    """Tính lại các dòng của bảng rankings ('1', '2', 'all', 'cum') theo từng năm học.
+    students=None: dựng lại cả bảng; nếu chỉ định (dãy MSSV) thì chỉ thay các dòng của những SV đó, ở mọi năm
+    và mọi phạm vi - 'cum' cũng chỉ cộng dồn lịch sử của họ. Không commit - chạy trong transaction của lần ghi."""
+    c = conn.cursor()
+    if students is None:
+        c.execute("DELETE FROM rankings")
+        where = ""
+    else:
+        c.execute("CREATE TEMP TABLE IF NOT EXISTS ranking_students (mssv TEXT PRIMARY KEY)")
+        c.execute("DELETE FROM temp.ranking_students")
+        c.executemany("INSERT OR IGNORE INTO temp.ranking_students VALUES (?)", ((str(m),) for m in students))
+        where = "WHERE mssv IN (SELECT mssv FROM temp.ranking_students)"
+        c.execute(f"DELETE FROM rankings {where}")
+    columns = 'academic_year, scope, mssv, grade_id, student_name, class_name, cohort, diem_tb'
+    # Mỗi (SV, năm, kỳ) lấy bản ghi đầu tiên (DB cũ chưa làm sạch có thể còn trùng)
+    first_rows = f'''first_rows AS (
+                    SELECT mssv, academic_year, semester, student_name, class_name, cohort, COALESCE(diem_tb, 0) AS d,
+                           ROW_NUMBER() OVER (PARTITION BY mssv, academic_year, semester ORDER BY id) AS rn
+                    FROM grades {where}
+                )'''
+
+    c.execute(f'''
+        INSERT INTO rankings ({columns}, xep_loai)
+        SELECT academic_year, CAST(semester AS TEXT), mssv, id, student_name, class_name, cohort,
+               COALESCE(diem_tb, 0), xep_loai
+        FROM grades WHERE semester IN (1, 2) {where.replace("WHERE", "AND")}''')
+    c.execute(f'''
+        WITH {first_rows}, pivoted AS (
+            SELECT academic_year, mssv,
+                   MAX(CASE WHEN semester = 1 THEN student_name END) AS student_name,
+                   MAX(CASE WHEN semester = 1 THEN class_name END) AS class_name,
+                   MAX(CASE WHEN semester = 1 THEN cohort END) AS cohort,
+                   MAX(CASE WHEN semester = 1 THEN d END) AS d1,
+                   MAX(CASE WHEN semester = 2 THEN d END) AS d2
+            FROM first_rows WHERE rn = 1 GROUP BY academic_year, mssv
+            HAVING COUNT(*) = 2 AND SUM(semester IN (1, 2)) = 2
+        ), combined AS (
+            SELECT *, py_round((d1 + d2) / 2.0, 2) AS d FROM pivoted
+        )
+        INSERT INTO rankings ({columns}, diem_tb_hk1, diem_tb_hk2, xep_loai)
+        SELECT academic_year, 'all', mssv, 0, student_name, class_name, cohort, d, d1, d2, {_ranking_label_sql('d')}
+        FROM combined''')
+    # ĐTB tích lũy: cộng theo đơn vị 0.01 (số nguyên) để tránh sai số làm tròn;
+    # cột trần student_name/class_name/cohort lấy theo dòng có MAX(kỳ) - kỳ gần nhất
+    c.execute(f'''
+        WITH {first_rows}, terms AS (
+            SELECT *, CAST(ROUND(d * 100) AS INTEGER) AS h FROM first_rows WHERE rn = 1
+        ), targets AS (
+            SELECT DISTINCT academic_year AS y, mssv FROM terms
+        ), cumulative AS (
+            SELECT t.y, f.mssv, MAX(f.academic_year * 10 + f.semester) AS last_term,
+                   f.student_name, f.class_name, f.cohort,
+                   py_round(SUM(f.h) / (100.0 * COUNT(*)), 2) AS d, COUNT(*) AS so_ky
+            FROM targets t JOIN terms f ON f.mssv = t.mssv AND f.academic_year <= t.y
+            GROUP BY t.y, f.mssv
+        )
+        INSERT INTO rankings ({columns}, so_ky, xep_loai)
+        SELECT y, 'cum', mssv, 0, student_name, class_name, cohort, d, so_ky, {_ranking_label_sql('d')}
+        FROM cumulative''')
+
+def refresh_rankings_for_rows(conn, rows):
+    """Làm mới xếp hạng chỉ cho các SV có trong rows - các dòng vừa xóa / sửa, đọc trước khi ghi (cần cột mssv).
+    Như save_grade nhưng cho nhiều bản ghi. Không commit."""
+    if rows is None or rows.empty:
+        return
+    refresh_rankings(conn, rows['mssv'].dropna().unique().tolist())
+
+def ranking_positions(conn, academic_year, scope, entries):
+    """Hạng của các dòng entries = [(diem_tb, grade_id, mssv), ...] trong một phạm vi xếp hạng, theo cả ba cách
+    ({'first', 'min', 'dense'} cho mỗi dòng). Đếm trên idx_rankings_order: số dòng điểm cao hơn (một lần cho
+    dòng cao nhất, rồi cộng dồn theo từng mức điểm tới dòng thấp nhất) và số dòng đồng điểm đứng trước."""
+    if not entries:
+        return []
+    key = (int(academic_year), str(scope))
+    values = [d for d, _, _ in entries]
+    above, above_distinct = conn.execute(
+        "SELECT COUNT(*), COUNT(DISTINCT diem_tb) FROM rankings WHERE academic_year = ? AND scope = ? AND diem_tb > ?",
+        (*key, max(values))).fetchone()
+    start, dense, ties = {}, {}, {}
+    levels = conn.execute("SELECT diem_tb, COUNT(*) FROM rankings WHERE academic_year = ? AND scope = ? "
+                          "AND diem_tb BETWEEN ? AND ? GROUP BY diem_tb ORDER BY diem_tb DESC",
+                          (*key, min(values), max(values))).fetchall()
+    for i, (value, count) in enumerate(levels):
+        start[value], dense[value], ties[value] = above + 1, above_distinct + i + 1, count
+        above += count
+    positions = []
+    for d, grade_id, mssv in entries:
+        first = start[d]
+        if ties[d] > 1:
+            first += conn.execute("SELECT COUNT(*) FROM rankings WHERE academic_year = ? AND scope = ? "
+                                  "AND diem_tb = ? AND (grade_id, mssv) < (?, ?)",
+                                  (*key, d, grade_id, mssv)).fetchone()[0]
+        positions.append({'first': first, 'min': start[d], 'dense': dense[d]})
+    return positions
+
+def _with_positions(conn, page_df, academic_year, scope, rank_method='first'):
+    """Thay cột grade_id của một trang rankings bằng cột xep_hang (đứng đầu)"""
+    positions = ranking_positions(conn, academic_year, scope, list(zip(
+        page_df['diem_tb'].tolist(), page_df['grade_id'].tolist(), page_df['mssv'].tolist())))
+    page_df = page_df.drop(columns='grade_id')
+    page_df.insert(0, 'xep_hang', [position[rank_method] for position in positions])
+    return page_df
+
+def get_student_positions(conn, mssv, academic_year, rank_method='first'):
+    """Vị trí của một SV ở mọi phạm vi xếp hạng của một năm học: các dòng của SV đọc theo khóa chính,
+    hạng và tổng số đếm trên idx_rankings_order. Trả về {phạm vi: (hạng, tổng số, điểm TB)};
+    phạm vi SV không có mặt thì không có khóa"""
+    best = {}
+    # Xếp theo thứ tự hạng để dòng có hạng tốt nhất (nếu trùng) đứng đầu mỗi phạm vi
+    for scope, diem_tb, grade_id in conn.execute("SELECT scope, diem_tb, grade_id FROM rankings "
+                                                 "WHERE mssv = ? AND academic_year = ? ORDER BY diem_tb, grade_id DESC",
+                                                 (mssv, int(academic_year))):
+        best[scope] = (diem_tb, grade_id)
+    positions = {}
+    for scope, (diem_tb, grade_id) in best.items():
+        rank = ranking_positions(conn, academic_year, scope, [(diem_tb, grade_id, mssv)])[0][rank_method]
+        total = conn.execute("SELECT COUNT(*) FROM rankings WHERE academic_year = ? AND scope = ?",
+                             (int(academic_year), scope)).fetchone()[0]
+        positions[scope] = (rank, total, diem_tb)
+    return positions
+
+def query_ranking_page(conn, scope, academic_year=ACADEMIC_YEAR, rank_method='first', xep_loai=None, cohort=None,
+                       search=None, page=1, page_size=GRADE_PAGE_SIZE):
+    """Một trang bảng xếp hạng dựng sẵn (theo thứ tự xếp hạng), lọc theo xếp loại / khóa / MSSV hoặc họ tên
+    (không phân biệt dấu). Trả về (DataFrame của trang, tổng số dòng khớp bộ lọc)"""
+    where, params = _filter_clause({'academic_year': int(academic_year), 'scope': str(scope),
+                                    'xep_loai': xep_loai, 'cohort': cohort})
+    if search:
+        where += " AND (mssv LIKE ? OR fold_vi(student_name) LIKE ?)"
+        params += [f"%{search}%", f"%{fold_vi(search)}%"]
+    total = conn.execute(f"SELECT COUNT(*) FROM rankings {where}", params).fetchone()[0]
+    page_df = pd.read_sql_query(
+        f"SELECT grade_id, {', '.join(RANKING_COLUMNS)} FROM rankings {where} "
+        f"ORDER BY {RANKING_ORDER} LIMIT ? OFFSET ?",
+        conn, params=params + [page_size, (max(page, 1) - 1) * page_size])
+    return _with_positions(conn, page_df, academic_year, scope, rank_method), total
+
+def ranking_summary(conn, scope, academic_year=ACADEMIC_YEAR):
+    """Thống kê một phạm vi xếp hạng của một năm học: số SV, ĐTB cao / thấp nhất, số SV theo xếp loại"""
+    rows = conn.execute('''SELECT xep_loai, COUNT(*), MAX(diem_tb), MIN(diem_tb) FROM rankings
+                           WHERE academic_year = ? AND scope = ? GROUP BY xep_loai''',
+                        (int(academic_year), str(scope))).fetchall()
+    counts = {label: count for label, count, _, _ in rows}
+    return {
+        'total': sum(counts.values()),
+        'max': max((high for _, _, high, _ in rows if high is not None), default=None),
+        'min': min((low for _, _, _, low in rows if low is not None), default=None),
+        # Từ cao xuống thấp, chỉ các xếp loại đang có
+        'xep_loai': {label: counts[label] for label in GRADE_LABELS[::-1] if label in counts},
+    }
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def _ranking_summary_cached(_conn, version, scope, academic_year):
+    return ranking_summary(_conn, scope, academic_year)
+
+def get_ranking_summary(conn, scope, academic_year=ACADEMIC_YEAR):
+    return _ranking_summary_cached(conn, get_data_version(), str(scope), int(academic_year))
+
+RANKING_COLUMNS = ['mssv', 'student_name', 'class_name', 'cohort', 'diem_tb', 'diem_tb_hk1', 'diem_tb_hk2',
+                   'so_ky', 'xep_loai']
+
+def save_grade(conn, data):
+    """Ghi một bản ghi điểm (tuple theo GRADE_COLUMNS); chỉ làm mới các dòng xếp hạng của SV đó"""
+    record = dict(zip(GRADE_COLUMNS, data))
     try:
-        c.execute('''INSERT INTO grades (mssv, student_name, class_name, semester, 
-                     triet, giai_tich_1, giai_tich_2, tieng_an_do_1, tieng_an_do_2,
-                     gdtc, thvp, tvth, phap_luat, logic,
-                     diem_tb, xep_loai, academic_year)
-                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', data)
+        insert_grades(conn, pd.DataFrame([data], columns=GRADE_COLUMNS))
+        refresh_rankings(conn, [record['mssv']])
         conn.commit()
+        bump_data_version()
         return True, None
+    except sqlite3.IntegrityError:
+        conn.rollback()
+        return False, f"MSSV {record['mssv']} đã có điểm học kỳ {record['semester']} năm học {record['academic_year']}"
     except Exception as e:
         conn.rollback()
         return False, str(e)
 
+def grade_content_hashes(frame):
+    """Băm họ tên, lớp, khóa và điểm từng môn của mỗi dòng thành số nguyên 64-bit (theo cột, không lặp Python).
+    Cùng nội dung -> cùng giá trị, dù frame đọc từ file import hay từ grades_wide."""
+    text_columns = ['student_name', 'class_name', 'cohort']
+    content = pd.DataFrame(index=frame.index)
+    for col in text_columns:
+        values = frame[col] if col in frame.columns else pd.Series(None, index=frame.index, dtype=object)
+        content[col] = values.astype(object).where(values.notna(), '').astype(str)
+    for key in SUBJECTS.keys():
+        content[key] = pd.to_numeric(frame[key], errors='coerce').astype(float) if key in frame.columns else np.nan
+    return pd.util.hash_pandas_object(content[GRADE_HASH_COLUMNS], index=False).to_numpy().view(np.int64)
+
+def _insert_scores(c, grade_ids, frame):
+    """Ghi điểm môn của các dòng frame (grade_ids cùng thứ tự): chỉ các ô có điểm, mỗi ô một dòng trong scores"""
+    subject_keys = [key for key in SUBJECTS.keys() if key in frame.columns]
+    matrix = np.column_stack([pd.to_numeric(frame[key], errors='coerce').to_numpy(dtype=float)
+                              for key in subject_keys]) if subject_keys else np.empty((len(frame), 0))
+    rows, cols = np.nonzero(~np.isnan(matrix))
+    c.executemany("INSERT INTO scores (grade_id, mssv, semester, subject_key, score, academic_year) "
+                  "VALUES (?, ?, ?, ?, ?, ?)",
+                  zip(np.asarray(grade_ids)[rows].tolist(), frame['mssv'].to_numpy(dtype=object)[rows].tolist(),
+                      frame['semester'].to_numpy(dtype=object)[rows].tolist(), np.array(subject_keys)[cols].tolist(),
+                      matrix[rows, cols].tolist(), frame['academic_year'].to_numpy(dtype=object)[rows].tolist()))
+
+def insert_grades(conn, frame, import_batch=None):
+    """Ghi hàng loạt các dòng đã tính điểm (cột theo GRADE_COLUMNS): phần chung vào grades,
+    điểm từng môn vào scores, bằng executemany; cập nhật grade_stats cùng lúc. import_batch: mã đợt import gắn vào từng dòng (để xóa cả đợt).
+    Không commit - người gọi quyết định phạm vi transaction."""
+    if frame.empty:
+        return 0
+    values = _grade_header_values(frame, import_batch)
+    c = conn.cursor()
+    c.executemany(f'''INSERT INTO grades ({', '.join(values.columns)})
+                      VALUES ({', '.join('?' * len(values.columns))})''',
+                  values.itertuples(index=False, name=None))
+    # Transaction đang giữ khóa ghi và id AUTOINCREMENT tăng dần -> len(frame) id lớn nhất là của các dòng vừa ghi
+    c.execute("SELECT id FROM grades ORDER BY id DESC LIMIT ?", (len(frame),))
+    grade_ids = np.array([row[0] for row in c.fetchall()][::-1])
+
+    _insert_scores(c, grade_ids, frame)
+    update_grade_stats(conn, added=frame)
+    return len(frame)
+
+def _grade_header_values(frame, import_batch=None):
+    """Các cột ghi vào grades (None thay cho NA), kèm mã đợt import và content_hash"""
+    values = frame[GRADE_HEADER_COLUMNS].astype(object).where(frame[GRADE_HEADER_COLUMNS].notna(), None)
+    values['import_batch'] = import_batch
+    values['content_hash'] = grade_content_hashes(frame)
+    return values
+
+def _existing_grade_keys(conn, frame):
+    """id và content_hash hiện có của các khóa (mssv, năm học, học kỳ) trong frame, theo chỉ mục idx_grades_term"""
+    found = []
+    for mssvs in _chunked(frame['mssv'].astype(str).unique().tolist()):
+        found += conn.execute(f"SELECT id, mssv, academic_year, semester, content_hash FROM grades "
+                              f"WHERE mssv IN ({', '.join('?' * len(mssvs))})", mssvs).fetchall()
+    # object: giữ nguyên số nguyên 64-bit khi merge (cột số có NaN sẽ bị đổi sang float)
+    return pd.DataFrame(found, columns=['id'] + GRADE_KEY_COLUMNS + ['old_hash']).astype({'old_hash': object})
+
+def upsert_grades(conn, frame, import_batch=None):
+    """Ghi theo khóa (mssv, năm học, học kỳ) - cần chỉ mục idx_grades_term (xem ensure_unique_term_index).
+    Khóa mới được thêm như insert_grades; khóa đã có chỉ được ghi lại khi content_hash khác, bằng một lần
+    INSERT ... ON CONFLICT DO UPDATE hàng loạt (giữ id và đợt import cũ); dòng không đổi không bị chạm tới.
+    Trong frame, dòng sau cùng của một khóa thắng. Không commit.
+    Trả về dict số dòng inserted / updated / unchanged / duplicates (dòng trùng khóa trong frame bị bỏ)."""
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'duplicates': 0}
+    if frame.empty:
+        return counts
+    deduped = frame.drop_duplicates(GRADE_KEY_COLUMNS, keep='last').reset_index(drop=True)
+    counts['duplicates'] = len(frame) - len(deduped)
+    keys = deduped[GRADE_KEY_COLUMNS].astype({'mssv': str, 'academic_year': int, 'semester': int})
+    matched = keys.merge(_existing_grade_keys(conn, deduped), how='left', on=GRADE_KEY_COLUMNS)
+    hashes = grade_content_hashes(deduped)
+
+    is_new = matched['id'].isna().to_numpy()
+    is_changed = ~is_new & np.array([old != new for old, new in zip(matched['old_hash'].tolist(), hashes.tolist())],
+                                    dtype=bool)
+    counts['inserted'] = insert_grades(conn, deduped[is_new], import_batch)
+    counts['unchanged'] = int((~is_new & ~is_changed).sum())
+
+    changed = deduped[is_changed]
+    if not changed.empty:
+        grade_ids = matched.loc[is_changed, 'id'].astype(int).to_numpy()
+        removed = _grade_stats_rows(conn, grade_ids.tolist())
+        values = _grade_header_values(changed, import_batch)
+        updates = [col for col in values.columns if col not in GRADE_KEY_COLUMNS + ['import_batch']]
+        c = conn.cursor()
+        c.executemany(f'''INSERT INTO grades ({', '.join(values.columns)})
+                          VALUES ({', '.join('?' * len(values.columns))})
+                          ON CONFLICT (mssv, academic_year, semester) DO UPDATE SET
+                          {', '.join(f"{col} = excluded.{col}" for col in updates)}, updated_at = CURRENT_TIMESTAMP
+                          WHERE grades.content_hash IS NOT excluded.content_hash''',
+                      values.itertuples(index=False, name=None))
+        for ids in _chunked(grade_ids.tolist()):
+            c.execute(f"DELETE FROM scores WHERE grade_id IN ({', '.join('?' * len(ids))})", ids)
+        _insert_scores(c, grade_ids, changed)
+        update_grade_stats(conn, added=changed, removed=removed)
+        counts['updated'] = len(changed)
+    return counts
+
 def delete_grade(conn, grade_id):
+    removed = _grade_stats_rows(conn, [grade_id])
     c = conn.cursor()
     c.execute("DELETE FROM grades WHERE id = ?", (grade_id,))
+    update_grade_stats(conn, removed=removed)
+    refresh_rankings_for_rows(conn, removed)
     conn.commit()
+    bump_data_version()
 
 def delete_grades_batch(conn, grade_ids):
+    """Xóa nhiều bản ghi theo id: mỗi khối SQL_IN_CHUNK id là một câu DELETE ... WHERE id IN (...),
+    tất cả trong một transaction. Trả về số dòng đã xóa."""
+    grade_ids = [int(grade_id) for grade_id in grade_ids]
+    if not grade_ids:
+        return 0
     c = conn.cursor()
-    for grade_id in grade_ids:
-        c.execute("DELETE FROM grades WHERE id = ?", (grade_id,))
-    conn.commit()
+    deleted = 0
+    try:
+        removed = _grade_stats_rows(conn, grade_ids)
+        for ids in _chunked(grade_ids):
+            c.execute(f"DELETE FROM grades WHERE id IN ({', '.join('?' * len(ids))})", ids)
+            deleted += c.rowcount
+        update_grade_stats(conn, removed=removed)
+        refresh_rankings_for_rows(conn, removed)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    bump_data_version()
+    return deleted
+
+def _grade_predicate(class_name=None, semester=None, import_batch=None, academic_year=None, cohort=None):
+    where, params = _filter_clause({
+        'academic_year': int(academic_year) if academic_year is not None else None,
+        'class_name': class_name,
+        'semester': int(semester) if semester is not None else None,
+        'import_batch': import_batch,
+        'cohort': cohort,
+    })
+    if not where:
+        raise ValueError("Cần ít nhất một điều kiện (năm học, lớp, học kỳ, khóa hoặc đợt import)")
+    return where, params
+
+def count_grades_where(conn, **predicate):
+    where, params = _grade_predicate(**predicate)
+    return conn.execute(f"SELECT COUNT(*) FROM grades {where}", params).fetchone()[0]
+
+def delete_grades_where(conn, **predicate):
+    """Xóa cả nhóm bản ghi theo năm học / lớp / học kỳ / khóa / đợt import bằng một câu DELETE.
+    Các điều kiện (tham số tên như _grade_predicate) được kết hợp bằng AND; phải có ít nhất một.
+    Trả về số dòng đã xóa."""
+    where, params = _grade_predicate(**predicate)
+    c = conn.cursor()
+    try:
+        removed = pd.read_sql_query(f"SELECT {STATS_SOURCE_COLUMNS} FROM grades_wide {where}", conn, params=params)
+        c.execute(f"DELETE FROM grades {where}", params)
+        deleted = c.rowcount
+        update_grade_stats(conn, removed=removed)
+        refresh_rankings_for_rows(conn, removed)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    bump_data_version()
+    return deleted
 
-def clean_data(conn):
-    df = load_grades(conn)
+def list_import_batches(conn):
+    """Các đợt import còn dữ liệu, mới nhất trước: (mã đợt, số bản ghi)"""
     c = conn.cursor()
-    
-    original_count = len(df)
-    if original_count == 0:
-        return 0, 0, 0
-    
-    # Chuyển về numeric
+    c.execute('''SELECT import_batch, COUNT(*) FROM grades WHERE import_batch IS NOT NULL
+                 GROUP BY import_batch ORDER BY MAX(id) DESC''')
+    return c.fetchall()
+
+SQL_IN_CHUNK = 500  # Số tham số tối đa cho mỗi mệnh đề IN (...), dưới giới hạn biến của SQLite
+
+def _chunked(items, size=SQL_IN_CHUNK):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def plan_clean_data(conn):
+    """Tính trước các thay đổi của bước làm sạch, không ghi gì vào DB.
+    Trả về dict gồm id cần xóa, các ô điểm âm cần đặt NULL và điểm TB mới của các dòng bị ảnh hưởng."""
+    subject_cols = ', '.join(SUBJECTS.keys())
+    df = pd.read_sql_query(f"SELECT id, mssv, student_name, academic_year, semester, {subject_cols}, diem_tb, "
+                           f"xep_loai FROM grades_wide ORDER BY id", conn)
     for key in SUBJECTS.keys():
-        if key in df.columns:
-            df[key] = pd.to_numeric(df[key], errors='coerce')
+        df[key] = pd.to_numeric(df[key], errors='coerce')
+
+    # Trùng MSSV + năm học + học kỳ: giữ bản ghi đầu tiên
+    dup_mask = df.duplicated(subset=['mssv', 'academic_year', 'semester'], keep='first')
+    duplicate_ids = df.loc[dup_mask, 'id'].tolist()
+    remaining = df[~dup_mask]
+
+    # MSSV có nhiều tên: giữ tên xuất hiện nhiều nhất (hòa thì lấy tên đứng trước theo thứ tự chữ cái)
+    name_counts = remaining.groupby(['mssv', 'student_name']).size().reset_index(name='n')
+    kept_names = (name_counts.sort_values(['mssv', 'n', 'student_name'], ascending=[True, False, True])
+                             .drop_duplicates('mssv').set_index('mssv')['student_name'])
+    conflict_mask = remaining['student_name'] != remaining['mssv'].map(kept_names)
+    name_conflict_ids = remaining.loc[conflict_mask, 'id'].tolist()
+    survivors = remaining[~conflict_mask]
+
+    # Điểm âm -> NULL (chỉ trên các dòng còn giữ lại)
+    negative = survivors[list(SUBJECTS.keys())] < 0
+    null_cells = {key: survivors.loc[negative[key], 'id'].tolist() for key in SUBJECTS.keys() if negative[key].any()}
+    negative_fixed = int(negative.to_numpy().sum())
+
+    # Chỉ tính lại điểm TB cho các dòng có ô bị đặt NULL
+    affected = survivors[negative.any(axis=1)].copy()
+    affected[list(SUBJECTS.keys())] = affected[list(SUBJECTS.keys())].mask(negative[negative.any(axis=1)])
+    new_tb, new_loai = score_grades(affected)
+    rescored = pd.DataFrame({
+        'id': affected['id'].to_numpy(),
+        'mssv': affected['mssv'].to_numpy(),
+        'diem_tb_cu': affected['diem_tb'].to_numpy(),
+        'diem_tb': new_tb,
+        'xep_loai': new_loai,
+    })
+
+    return {
+        'duplicate_ids': duplicate_ids,
+        'name_conflict_ids': name_conflict_ids,
+        'null_cells': null_cells,
+        'rescored': rescored,
+        'removed_semester': len(duplicate_ids),
+        'removed_name_conflict': len(name_conflict_ids),
+        'negative_fixed': negative_fixed,
+    }
+
+def clean_data(conn, dry_run=False):
+    """Làm sạch bằng các câu lệnh theo tập hợp: DELETE ... WHERE id IN, UPDATE ô điểm âm,
+    cập nhật điểm TB cho các dòng bị ảnh hưởng. dry_run=True chỉ trả về kế hoạch."""
+    plan = plan_clean_data(conn)
+    if dry_run:
+        return plan
+
+    try:
+        apply_clean_plan(conn, plan, clean_plan_ids(plan))
+        # Hết bản ghi trùng -> bật UNIQUE(mssv, academic_year, semester) để các lần import sau chạy upsert
+        ensure_unique_term_index(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    bump_data_version()
     
-    # Xử lý điểm âm → NaN
-    negative_fixed = 0
+    return plan
+
+def clean_plan_ids(plan):
+    """Các id bản ghi bị kế hoạch làm sạch chạm tới (xóa hoặc tính lại điểm), theo thứ tự tăng dần"""
+    return sorted(set(plan['duplicate_ids']) | set(plan['name_conflict_ids']) | set(plan['rescored']['id'].tolist()))
+
+def apply_clean_plan(conn, plan, grade_ids):
+    """Áp dụng phần kế hoạch làm sạch thuộc grade_ids, giữ grade_stats và xếp hạng của các SV bị chạm tới khớp.
+    Không commit - gọi theo từng nhóm id để chia việc làm sạch thành nhiều transaction nhỏ.
+    Trả về các dòng bị chạm tới (trước khi sửa)."""
+    wanted = set(grade_ids)
+    deleted_ids = [i for i in plan['duplicate_ids'] + plan['name_conflict_ids'] if i in wanted]
+    rescored = plan['rescored'][plan['rescored']['id'].isin(wanted)]
+    c = conn.cursor()
+    removed = _grade_stats_rows(conn, deleted_ids + rescored['id'].tolist())
+    for ids in _chunked(deleted_ids):
+        c.execute(f"DELETE FROM grades WHERE id IN ({', '.join('?' * len(ids))})", ids)
+    for key, cell_ids in plan['null_cells'].items():
+        for ids in _chunked([i for i in cell_ids if i in wanted]):
+            c.execute(f"DELETE FROM scores WHERE subject_key = ? AND score < 0 "
+                      f"AND grade_id IN ({', '.join('?' * len(ids))})", [key] + ids)
+    c.executemany("UPDATE grades SET diem_tb = ?, xep_loai = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                  zip(rescored['diem_tb'].tolist(), rescored['xep_loai'].tolist(), rescored['id'].tolist()))
+    update_grade_stats(conn, added=_grade_stats_rows(conn, rescored['id'].tolist()), removed=removed)
+    refresh_rankings_for_rows(conn, removed)
+    return removed
+
+def recompute_grades_chunk(conn, after_id=0, limit=IMPORT_CHUNK_ROWS, academic_year=None):
+    """Tính lại điểm TB / xếp loại từ bảng scores cho tối đa limit bản ghi có id > after_id.
+    Chỉ ghi các dòng thay đổi (kèm grade_stats và xếp hạng của các SV đó). Không commit.
+    Trả về (id cuối đã xét hoặc None nếu hết, số dòng đã xét, số dòng cập nhật)"""
+    where, params = _filter_clause({'academic_year': int(academic_year) if academic_year is not None else None})
+    where = f"{where} AND id > ?" if where else "WHERE id > ?"
+    df = _query_grades(conn, f"{where} ORDER BY id LIMIT ?", params + [int(after_id), int(limit)])
+    if df.empty:
+        return None, 0, 0
+    diem_tb, xep_loai = score_grades(df)
+    old_tb = pd.to_numeric(df['diem_tb'], errors='coerce').to_numpy(dtype=float)
+    changed = ~np.isclose(old_tb, diem_tb, equal_nan=True) | (df['xep_loai'].to_numpy(dtype=object) != xep_loai)
+    ids = df.loc[changed, 'id'].astype(int).tolist()
+    if ids:
+        removed = _grade_stats_rows(conn, ids)
+        conn.executemany("UPDATE grades SET diem_tb = ?, xep_loai = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                         zip(diem_tb[changed].tolist(), xep_loai[changed].tolist(), ids))
+        update_grade_stats(conn, added=_grade_stats_rows(conn, ids), removed=removed)
+        refresh_rankings_for_rows(conn, removed)
+    return int(df['id'].iloc[-1]), len(df), len(ids)
+
+# ======================== IMPORT HÀNG LOẠT ========================
+def prepare_import_frame(df, option="Cả hai kỳ", academic_year=ACADEMIC_YEAR):
+    """Chuẩn hóa, kiểm tra, lọc học kỳ và tính điểm cho cả DataFrame bằng phép toán theo cột.
+    Năm học lấy từ cột academic_year nếu file có, ô trống dùng academic_year truyền vào.
+    Dòng bị loại: thiếu MSSV/họ tên, học kỳ không hợp lệ, hoặc có điểm ngoài SCORE_RANGE / không phải số.
+    Trả về (frame theo GRADE_COLUMNS, số dòng bị loại, số dòng khác học kỳ đã chọn,
+    số dòng bị loại vì điểm không hợp lệ)"""
+    frame = pd.DataFrame(index=df.index)
+    for col in ['mssv', 'student_name', 'class_name', 'cohort']:
+        if col in df.columns:
+            frame[col] = df[col].astype('string').str.strip().replace('', pd.NA)
+        else:
+            frame[col] = pd.Series(pd.NA, index=df.index, dtype='string')
+    frame['semester'] = pd.to_numeric(df['semester'], errors='coerce') if 'semester' in df.columns else 1
+    low, high = SCORE_RANGE
+    bad_scores = pd.Series(False, index=df.index)
     for key in SUBJECTS.keys():
-        if key in df.columns:
-            count = int((df[key] < 0).sum())
-            negative_fixed += count
-            df.loc[df[key] < 0, key] = np.nan
-    
-    # Xóa MSSV + học kỳ
-    df_clean = df.drop_duplicates(subset=['mssv', 'semester'], keep='first')
-    removed_semester = original_count - len(df_clean)
-
-    # Lọc MSSV trùng nhưng tên khác
-    before = len(df_clean)
-    df_clean = (
-        df_clean.sort_values(["mssv", "student_name"])
-                .groupby("mssv", as_index=False)
-                .first()
-    )
-    removed_name_conflict = before - len(df_clean)
-    
-    # Ghi lại DB
-    try:
-        c.execute("DELETE FROM grades")
-        for _, row in df_clean.iterrows():
-            diem_tb = calculate_average(row)
-            xep_loai = calculate_grade(diem_tb)
-
-            def safe_val(k):
-                v = row.get(k)
-                if pd.isna(v):
-                    return None
-                return float(v) if v != '' else None
-
-            params = (
-                row.get('mssv', ''), row.get('student_name', ''), row.get('class_name', None),
-                int(row.get('semester', 1)) if not pd.isna(row.get('semester', 1)) else 1,
-                safe_val('triet'), safe_val('giai_tich_1'), safe_val('giai_tich_2'),
-                safe_val('tieng_an_do_1'), safe_val('tieng_an_do_2'),
-                safe_val('gdtc'), safe_val('thvp'), safe_val('tvth'),
-                safe_val('phap_luat'), safe_val('logic'),
-                float(diem_tb), xep_loai, int(ACADEMIC_YEAR)
-            )
+        if key not in df.columns:
+            frame[key] = np.nan
+            continue
+        scores = pd.to_numeric(df[key], errors='coerce')
+        # Ô có chữ nhưng không đọc được thành số (ô trống / chỉ có khoảng trắng vẫn là "chưa có điểm")
+        unparsed = scores.isna() & df[key].notna()
+        if unparsed.any():
+            unparsed[unparsed] = df.loc[unparsed, key].astype(str).str.strip() != ''
+        bad_scores |= unparsed | (scores < low) | (scores > high)
+        frame[key] = scores
+
+    # Loại dòng thiếu MSSV/họ tên, học kỳ không hợp lệ hoặc có điểm không hợp lệ
+    identified = frame['mssv'].notna() & frame['student_name'].notna() & frame['semester'].isin([1, 2])
+    valid = identified & ~bad_scores
+    rejected = int((~valid).sum())
+    invalid_scores = int((identified & bad_scores).sum())
+    frame = frame[valid]
 
-            c.execute(
-                '''INSERT INTO grades (mssv, student_name, class_name, semester,
-                triet, giai_tich_1, giai_tich_2, tieng_an_do_1, tieng_an_do_2,
-                gdtc, thvp, tvth, phap_luat, logic,
-                diem_tb, xep_loai, academic_year)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', 
-                params
-            )
+    if option == "Học kỳ 1":
+        keep = frame['semester'] == 1
+    elif option == "Học kỳ 2":
+        keep = frame['semester'] == 2
+    else:
+        keep = pd.Series(True, index=frame.index)
+    skipped = int((~keep).sum())
+    frame = frame[keep].copy()
+
+    frame['semester'] = frame['semester'].astype(int)
+    frame['diem_tb'], frame['xep_loai'] = score_grades(frame)
+    if 'academic_year' in df.columns:
+        years = pd.to_numeric(df.loc[frame.index, 'academic_year'], errors='coerce')
+        frame['academic_year'] = years.fillna(int(academic_year)).astype(int)
+    else:
+        frame['academic_year'] = int(academic_year)
+    return frame[GRADE_COLUMNS], rejected, skipped, invalid_scores
+
+def _upload_size(uploaded_file):
+    size = getattr(uploaded_file, 'size', None)
+    if size is None:
+        pos = uploaded_file.tell()
+        size = uploaded_file.seek(0, 2)
+        uploaded_file.seek(pos)
+    return size or 0
+
+def _iter_csv_chunks(uploaded_file, chunksize):
+    size = _upload_size(uploaded_file)
+    with pd.read_csv(uploaded_file, dtype=IMPORT_TEXT_DTYPES, chunksize=chunksize) as reader:
+        for chunk in reader:
+            yield chunk, min(uploaded_file.tell() / size, 1.0) if size else 1.0
+
+def _iter_xlsx_chunks(uploaded_file, chunksize):
+    # read_only: openpyxl duyệt từng dòng, không dựng cả workbook trong bộ nhớ
+    wb = openpyxl.load_workbook(uploaded_file, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        total_rows = max((ws.max_row or 1) - 1, 1)
+        rows = ws.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [str(h).strip() if h is not None else f"col_{i}" for i, h in enumerate(header)]
+        buffer, seen = [], 0
+        for values in rows:
+            if all(v is None for v in values):
+                continue
+            buffer.append(values)
+            if len(buffer) >= chunksize:
+                seen += len(buffer)
+                yield pd.DataFrame(buffer, columns=columns).astype(
+                    {c: 'string' for c in IMPORT_TEXT_DTYPES if c in columns}), min(seen / total_rows, 1.0)
+                buffer = []
+        if buffer:
+            yield pd.DataFrame(buffer, columns=columns).astype(
+                {c: 'string' for c in IMPORT_TEXT_DTYPES if c in columns}), 1.0
+    finally:
+        wb.close()
+
+def iter_upload_chunks(uploaded_file, chunksize=IMPORT_CHUNK_ROWS):
+    """Đọc file CSV/XLSX theo từng khối cố định. Yield (DataFrame, tỷ lệ đã đọc 0..1)"""
+    uploaded_file.seek(0)
+    name = getattr(uploaded_file, 'name', '') or ''
+    if name.lower().endswith('.xlsx'):
+        yield from _iter_xlsx_chunks(uploaded_file, chunksize)
+    else:
+        yield from _iter_csv_chunks(uploaded_file, chunksize)
+
+def read_upload_preview(uploaded_file, nrows=10):
+    """Xem trước: chỉ đọc khối đầu tiên của file"""
+    first = next(iter_upload_chunks(uploaded_file, chunksize=nrows), None)
+    uploaded_file.seek(0)
+    return first[0] if first is not None else pd.DataFrame()
+
+def _importable_app_module():
+    """Module của file này import được theo tên. Streamlit chạy file như __main__, nên hàm của nó không pickle
+    được sang tiến trình con; khi đó nạp file dưới tên thật (app1) để tiến trình con import lại theo tên."""
+    name = os.path.splitext(os.path.basename(__file__))[0]
+    if __name__ == name:
+        return sys.modules[__name__]
+    directory = os.path.dirname(os.path.abspath(__file__))
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    return importlib.import_module(name)
+
+def import_workers_for(size_bytes, workers=IMPORT_WORKERS):
+    """Số tiến trình nên dùng cho một file theo kích thước"""
+    return workers if size_bytes >= PARALLEL_IMPORT_MIN_BYTES else 1
+
+def prepare_import_chunks(chunks, option="Cả hai kỳ", academic_year=ACADEMIC_YEAR, workers=1):
+    """Chuẩn hóa + tính điểm từng khối, yield (frame, số dòng loại, số dòng bỏ qua, số dòng điểm không hợp lệ,
+    tiến độ) theo đúng thứ tự đọc.
+    workers > 1: các khối được xử lý song song trong ProcessPoolExecutor (spawn - không fork tiến trình Streamlit
+    đang có nhiều thread), tối đa 2 * workers khối đang chờ để giới hạn bộ nhớ; người gọi là nơi ghi DB duy nhất."""
+    if workers <= 1:
+        for chunk, fraction in chunks:
+            yield (*prepare_import_frame(chunk, option, academic_year), fraction)
+        return
 
+    prepare = _importable_app_module().prepare_import_frame
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    pending = deque()
+    try:
+        for chunk, fraction in chunks:
+            pending.append((pool.submit(prepare, chunk, option, academic_year), fraction))
+            if len(pending) >= 2 * workers:
+                future, done = pending.popleft()
+                yield (*future.result(), done)
+        while pending:
+            future, done = pending.popleft()
+            yield (*future.result(), done)
+    finally:
+        # Người gọi dừng sớm (hủy / lỗi ghi) -> bỏ các khối chưa chạy
+        pool.shutdown(wait=True, cancel_futures=True)
+
+IMPORT_MODES = {
+    'upsert': 'Cập nhật theo MSSV + năm học + học kỳ (dòng không đổi được bỏ qua)',
+    'append': 'Thêm mới mọi dòng',
+}
+IMPORT_COUNT_KEYS = ('inserted', 'updated', 'unchanged', 'duplicates')
+
+def default_import_mode(conn):
+    """upsert khi đã có UNIQUE(mssv, academic_year, semester), ngược lại append (DB cũ còn bản ghi trùng)"""
+    return 'upsert' if has_unique_term_index(conn) else 'append'
+
+def write_import_frame(conn, frame, mode, import_batch=None):
+    """Ghi một khối đã chuẩn hóa theo chế độ import, rồi làm mới xếp hạng của các SV trong khối (cùng transaction,
+    nên xếp hạng luôn khớp với điểm đã commit). Trả về số dòng theo IMPORT_COUNT_KEYS. Không commit."""
+    if mode == 'upsert':
+        counts = upsert_grades(conn, frame, import_batch)
+    elif mode == 'append':
+        counts = {'inserted': insert_grades(conn, frame, import_batch), 'updated': 0, 'unchanged': 0, 'duplicates': 0}
+    else:
+        raise ValueError(f"Không hỗ trợ chế độ import {mode}")
+    refresh_rankings_for_rows(conn, frame)
+    return counts
+
+def import_grades_chunks(conn, chunks, option="Cả hai kỳ", on_progress=None, import_batch=None,
+                         academic_year=ACADEMIC_YEAR, workers=1, mode=None):
+    """Kiểm tra, tính điểm và ghi từng khối trong một transaction duy nhất.
+    chunks: iterable (DataFrame, tỷ lệ tiến độ). Mọi dòng mới được gắn mã đợt import_batch
+    (mặc định theo thời điểm import). workers: số tiến trình tính điểm (xem prepare_import_chunks).
+    mode: một khóa của IMPORT_MODES, mặc định theo default_import_mode.
+    Trả về báo cáo số dòng (thêm / cập nhật / không đổi / trùng trong file) và tốc độ."""
+    started = time.perf_counter()
+    import_batch = import_batch or datetime.now().strftime('%Y%m%d-%H%M%S')
+    mode = mode or default_import_mode(conn)
+    counts = dict.fromkeys(IMPORT_COUNT_KEYS, 0)
+    rejected = skipped = invalid_scores = 0
+    try:
+        for frame, chunk_rejected, chunk_skipped, chunk_invalid, fraction in prepare_import_chunks(
+                chunks, option, academic_year, workers):
+            for key, value in write_import_frame(conn, frame, mode, import_batch).items():
+                counts[key] += value
+            rejected += chunk_rejected
+            skipped += chunk_skipped
+            invalid_scores += chunk_invalid
+            if on_progress:
+                on_progress(fraction, counts['inserted'] + counts['updated'])
         conn.commit()
     except Exception:
         conn.rollback()
         raise
-    
-    return removed_semester, removed_name_conflict, negative_fixed
+    bump_data_version()
+    elapsed = time.perf_counter() - started
+    processed = counts['inserted'] + counts['updated'] + counts['unchanged']
+    return {
+        'import_batch': import_batch,
+        'mode': mode,
+        **counts,
+        'rejected': rejected,
+        'invalid_scores': invalid_scores,
+        'skipped': skipped,
+        'seconds': elapsed,
+        'rows_per_sec': processed / elapsed if elapsed > 0 else float(processed),
+    }
+
+# ======================== XUẤT DỮ LIỆU ========================
+EXPORT_CHUNK_ROWS = 20000  # Số dòng đọc từ SQLite mỗi lần khi export
+EXPORT_SPOOL_BYTES = 32 * 1024 ** 2  # File export nhỏ hơn giữ trong RAM, lớn hơn tự chuyển sang file tạm trên đĩa
+# định dạng -> (nhãn, MIME, đuôi file); Parquet chỉ có khi cài pyarrow
+EXPORT_FORMATS = {
+    'csv': ('CSV', 'text/csv', 'csv'),
+    'xlsx': ('Excel (.xlsx)', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'),
+}
+if pq is not None:
+    EXPORT_FORMATS['parquet'] = ('Parquet', 'application/vnd.apache.parquet', 'parquet')
+EXPORT_GRADE_COLUMNS = ['id'] + GRADE_COLUMNS + ['import_batch', 'updated_at']
+EXPORT_RANKING_COLUMNS = ['xep_hang'] + RANKING_COLUMNS
+# Kiểu cột cố định cho Parquet (một khối toàn ô trống không được đổi kiểu cột)
+EXPORT_INT_COLUMNS = {'id', 'semester', 'academic_year', 'xep_hang', 'so_ky'}
+EXPORT_FLOAT_COLUMNS = set(SUBJECTS) | {'diem_tb', 'diem_tb_hk1', 'diem_tb_hk2'}
+
+def export_query(source, columns, academic_year=ACADEMIC_YEAR, semester=None, class_name=None, cohort=None,
+                 rank_method='first'):
+    """Câu SQL + tham số cho export của một năm học.
+    source = 'grades' (bảng điểm, lọc được theo học kỳ) hoặc một phạm vi trong RANKING_SCOPES (bảng rankings)"""
+    allowed = EXPORT_GRADE_COLUMNS if source == 'grades' else EXPORT_RANKING_COLUMNS
+    if source != 'grades' and source not in RANKING_SCOPES:
+        raise ValueError(f"Không hỗ trợ export {source}")
+    unknown = [col for col in columns if col not in allowed]
+    if unknown or not columns:
+        raise ValueError(f"Cột không hợp lệ: {', '.join(unknown) or '(trống)'}")
+    if source == 'grades':
+        where, params = _filter_clause({'academic_year': int(academic_year),
+                                        'semester': int(semester) if semester is not None else None,
+                                        'class_name': class_name, 'cohort': cohort})
+        return f"SELECT {', '.join(columns)} FROM grades_wide {where} ORDER BY id", params
+    # Hạng tính trên cả phạm vi rồi mới lọc lớp / khóa, như trên trang Xếp hạng
+    where, params = _filter_clause({'academic_year': int(academic_year), 'scope': source})
+    outer, outer_params = _filter_clause({'class_name': class_name, 'cohort': cohort})
+    return (f"SELECT {', '.join(columns)} FROM (SELECT *, {RANK_WINDOWS[rank_method]} AS xep_hang "
+            f"FROM rankings {where}) {outer} ORDER BY {RANKING_ORDER}", params + outer_params)
+
+def _write_csv(chunks, columns, f):
+    # BOM một lần ở đầu file để Excel đọc đúng tiếng Việt
+    f.write(pd.DataFrame(columns=columns).to_csv(index=False).encode('utf-8-sig'))
+    for chunk in chunks:
+        f.write(chunk.to_csv(index=False, header=False).encode('utf-8'))
+
+def _write_xlsx(chunks, columns, f):
+    # write_only: openpyxl ghi từng dòng ra file tạm thay vì giữ cả workbook
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Dữ liệu")
+    ws.append(columns)
+    for chunk in chunks:
+        for row in chunk.astype(object).where(chunk.notna(), None).itertuples(index=False, name=None):
+            ws.append(row)
+    wb.save(f)
+
+def _write_parquet(chunks, columns, f):
+    schema = pyarrow.schema([
+        (col, pyarrow.int64() if col in EXPORT_INT_COLUMNS
+         else pyarrow.float64() if col in EXPORT_FLOAT_COLUMNS else pyarrow.string())
+        for col in columns])
+    with pq.ParquetWriter(f, schema) as writer:
+        for chunk in chunks:
+            writer.write_table(pyarrow.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+EXPORT_WRITERS = {'csv': _write_csv, 'xlsx': _write_xlsx, 'parquet': _write_parquet}
+
+def export_grades(conn, fmt='csv', source='grades', columns=None, chunksize=EXPORT_CHUNK_ROWS, **filters):
+    """Đọc kết quả export từ SQLite theo từng khối và ghi thẳng vào một SpooledTemporaryFile,
+    không dựng cả bảng / cả chuỗi CSV trong bộ nhớ. filters: như export_query.
+    Trả về (file đã tua về đầu, báo cáo {'rows', 'bytes', 'seconds'}); người gọi đóng file."""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Không hỗ trợ định dạng {fmt}")
+    if columns is None:
+        columns = GRADE_COLUMNS if source == 'grades' else EXPORT_RANKING_COLUMNS
+    columns = list(columns)
+    sql, params = export_query(source, columns, **filters)
+    report = {'rows': 0, 'bytes': 0, 'seconds': 0.0}
+    started = time.perf_counter()
+
+    def chunks():
+        for chunk in pd.read_sql_query(sql, conn, params=params, chunksize=chunksize):
+            report['rows'] += len(chunk)
+            yield chunk
+
+    f = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    try:
+        EXPORT_WRITERS[fmt](chunks(), columns, f)
+        report['bytes'] = f.seek(0, os.SEEK_END)
+        f.seek(0)
+    except Exception:
+        f.close()
+        raise
+    report['seconds'] = time.perf_counter() - started
+    return f, report
+
+# ======================== CÔNG VIỆC NỀN ========================
+JOB_DIR = 'jobs'   # File upload được giữ lại để job import chạy nền và chạy tiếp sau khi gián đoạn
+JOB_WORKERS = 1    # Các job đều ghi DB -> chạy tuần tự, không tranh khóa ghi với nhau
+JOB_UPLOAD_DAYS = 7   # File của job import dừng giữa chừng quá số ngày này bị xóa, job không chạy tiếp được nữa
+JOB_KINDS = {'import': 'Import dữ liệu', 'clean': 'Làm sạch dữ liệu', 'recompute': 'Tính lại điểm TB'}
+JOB_STATUSES = {
+    'queued': 'Đang chờ',
+    'running': 'Đang chạy',
+    'done': 'Hoàn thành',
+    'cancelled': 'Đã hủy',
+    'failed': 'Lỗi',
+    'interrupted': 'Bị gián đoạn',
+    'discarded': 'Đã bỏ',
+}
+JOB_ACTIVE = ('queued', 'running')
+JOB_RESUMABLE = ('cancelled', 'failed', 'interrupted')
+
+@st.cache_resource
+def _job_executor(db_path=DB_PATH):
+    """Một pool thread cho mỗi tiến trình. Job còn dở của tiến trình trước được đánh dấu gián đoạn để chạy tiếp;
+    file upload của job bỏ dở quá lâu được dọn."""
+    conn = _connect(db_path)
+    try:
+        conn.execute("UPDATE jobs SET status = 'interrupted', updated_at = CURRENT_TIMESTAMP "
+                     "WHERE status IN ('queued', 'running')")
+        conn.commit()
+        prune_job_uploads(conn)
+    finally:
+        conn.close()
+    return ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='grades-job')
+
+def _set_job(conn, job_id, **fields):
+    """Cập nhật các cột của job (report tự chuyển sang JSON). Không commit: checkpoint đi cùng transaction dữ liệu."""
+    if 'report' in fields:
+        fields['report'] = json.dumps(fields['report'], ensure_ascii=False)
+    assignments = ', '.join(f"{col} = ?" for col in fields)
+    conn.execute(f"UPDATE jobs SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                 list(fields.values()) + [job_id])
+
+def _job_from_row(row, columns):
+    job = dict(zip(columns, row))
+    job['params'] = json.loads(job['params'] or '{}')
+    job['report'] = json.loads(job['report']) if job['report'] else {}
+    return job
+
+def get_job(conn, job_id):
+    c = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+    row = c.fetchone()
+    return _job_from_row(row, [d[0] for d in c.description]) if row else None
+
+def list_jobs(conn, limit=20):
+    """Các job gần nhất, mới nhất trước"""
+    c = conn.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,))
+    columns = [d[0] for d in c.description]
+    return [_job_from_row(row, columns) for row in c.fetchall()]
+
+def create_job(conn, kind, params, created_by=None):
+    if kind not in JOB_KINDS:
+        raise ValueError(f"Không hỗ trợ công việc {kind}")
+    c = conn.execute("INSERT INTO jobs (kind, params, created_by) VALUES (?, ?, ?)",
+                     (kind, json.dumps(params, ensure_ascii=False), created_by))
+    conn.commit()
+    return c.lastrowid
+
+def submit_job(job_id, db_path=DB_PATH):
+    _job_executor(db_path).submit(run_job, job_id, db_path)
+
+def start_job(conn, kind, params, created_by=None, db_path=DB_PATH):
+    """Tạo job và đưa vào hàng đợi; trả về id để theo dõi ở trang Công việc nền"""
+    _job_executor(db_path)  # khởi tạo trước khi ghi job mới, tránh bị đánh dấu gián đoạn
+    job_id = create_job(conn, kind, params, created_by)
+    submit_job(job_id, db_path)
+    return job_id
+
+def cancel_job(conn, job_id):
+    """Yêu cầu hủy: job đang chạy dừng sau khối hiện tại (các khối đã commit được giữ), job đang chờ hủy ngay"""
+    conn.execute("UPDATE jobs SET cancel_requested = 1, updated_at = CURRENT_TIMESTAMP "
+                 "WHERE id = ? AND status IN ('queued', 'running')", (job_id,))
+    conn.execute("UPDATE jobs SET status = 'cancelled' WHERE id = ? AND status = 'queued'", (job_id,))
+    conn.commit()
+
+def resume_job(conn, job_id, db_path=DB_PATH):
+    """Chạy tiếp job đã hủy / lỗi / gián đoạn từ khối cuối cùng đã commit"""
+    _job_executor(db_path)
+    c = conn.execute("UPDATE jobs SET status = 'queued', cancel_requested = 0, error = NULL, "
+                     "updated_at = CURRENT_TIMESTAMP WHERE id = ? AND status IN ('cancelled', 'failed', 'interrupted')",
+                     (job_id,))
+    conn.commit()
+    if c.rowcount:
+        submit_job(job_id, db_path)
+    return bool(c.rowcount)
+
+def _remove_job_upload(path):
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def discard_job(conn, job_id):
+    """Bỏ hẳn job đã hủy / lỗi / gián đoạn: không chạy tiếp được nữa và xóa file upload của nó"""
+    job = get_job(conn, job_id)
+    c = conn.execute("UPDATE jobs SET status = 'discarded', updated_at = CURRENT_TIMESTAMP "
+                     "WHERE id = ? AND status IN ('cancelled', 'failed', 'interrupted')", (job_id,))
+    conn.commit()
+    if c.rowcount and job:
+        _remove_job_upload(job['params'].get('path'))
+    return bool(c.rowcount)
+
+def prune_job_uploads(conn, days=JOB_UPLOAD_DAYS):
+    """Bỏ các job dừng giữa chừng quá days ngày (xóa file upload của chúng) và xóa file trong JOB_DIR
+    không còn job nào cần - ví dụ file của job đã bỏ hoặc lưu xong nhưng chưa kịp tạo job."""
+    stale = conn.execute("SELECT id FROM jobs WHERE status IN ('cancelled', 'failed', 'interrupted') "
+                         "AND updated_at < datetime('now', ?)", (f"-{int(days)} days",)).fetchall()
+    for (job_id,) in stale:
+        discard_job(conn, job_id)
+    if not os.path.isdir(JOB_DIR):
+        return
+    rows = conn.execute("SELECT params FROM jobs WHERE kind = 'import' AND status IN "
+                        "('queued', 'running', 'cancelled', 'failed', 'interrupted')").fetchall()
+    needed = {os.path.abspath(path) for path in (json.loads(params or '{}').get('path') for (params,) in rows) if path}
+    cutoff = time.time() - days * 86400
+    for name in os.listdir(JOB_DIR):
+        path = os.path.abspath(os.path.join(JOB_DIR, name))
+        if path not in needed and os.path.isfile(path) and os.path.getmtime(path) < cutoff:
+            _remove_job_upload(path)
+
+def _job_cancel_requested(conn, job_id):
+    return bool(conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()[0])
+
+def _run_import_job(conn, job):
+    """Import theo từng khối của file đã lưu; mỗi khối commit cùng checkpoint (số khối đã ghi) và báo cáo cộng dồn"""
+    params = job['params']
+    mode = params.get('mode') or default_import_mode(conn)
+    report = {**dict.fromkeys(IMPORT_COUNT_KEYS, 0), 'rejected': 0, 'invalid_scores': 0, 'skipped': 0, 'seconds': 0.0,
+              **job['report']}
+    # Ghi chỉ mục grades/scores là phần chậm nhất; cache lớn giảm đọc lại trang B-tree
+    conn.execute(f"PRAGMA cache_size = -{IMPORT_CACHE_KIB}")
+    with open(params['path'], 'rb') as f:
+        reader = iter_upload_chunks(f)
+        # Bỏ qua các khối đã commit ở lần chạy trước
+        prepared = prepare_import_chunks(itertools.islice(reader, job['checkpoint'], None),
+                                         params['option'], params['academic_year'], params.get('workers', 1))
+        last = time.perf_counter()
+        try:
+            for index, (frame, rejected, skipped, invalid_scores, fraction) in enumerate(prepared,
+                                                                                          start=job['checkpoint']):
+                if _job_cancel_requested(conn, job['id']):
+                    return False
+                written = write_import_frame(conn, frame, mode, params['import_batch'])
+                for key, value in written.items():
+                    report[key] += value
+                report['rejected'] += rejected
+                report['invalid_scores'] += invalid_scores
+                report['skipped'] += skipped
+                now = time.perf_counter()
+                report['seconds'] += now - last
+                last = now
+                _set_job(conn, job['id'], checkpoint=index + 1, progress=fraction, report=report)
+                conn.commit()
+                bump_data_version()
+        finally:
+            # Đóng pool và trình đọc file trước khi đóng file (kể cả khi hủy / lỗi)
+            prepared.close()
+            reader.close()
+    _remove_job_upload(params['path'])
+    return True
+
+def _run_clean_job(conn, job):
+    """Làm sạch theo từng nhóm id. Kế hoạch được tính lại khi chạy tiếp - phần đã commit không còn trong kế hoạch."""
+    plan = plan_clean_data(conn)
+    report = job['report'] or {key: plan[key] for key in ('removed_semester', 'removed_name_conflict', 'negative_fixed')}
+    ids = clean_plan_ids(plan)
+    done = job['checkpoint']
+    total = done + len(ids)
+    # Lưu báo cáo ngay cả khi kế hoạch không còn id nào (dữ liệu đã sạch)
+    _set_job(conn, job['id'], report=report)
+    conn.commit()
+    for group in _chunked(ids, IMPORT_CHUNK_ROWS):
+        if _job_cancel_requested(conn, job['id']):
+            return False
+        apply_clean_plan(conn, plan, group)
+        done += len(group)
+        _set_job(conn, job['id'], checkpoint=done, progress=done / total, report=report)
+        conn.commit()
+        bump_data_version()
+    ensure_unique_term_index(conn)
+    return True
+
+def _run_recompute_job(conn, job):
+    """Tính lại điểm TB từ bảng scores theo khối id tăng dần; checkpoint là id cuối đã xử lý"""
+    academic_year = job['params'].get('academic_year')
+    where, params = _filter_clause({'academic_year': academic_year})
+    report = job['report'] or {'total': conn.execute(f"SELECT COUNT(*) FROM grades {where}", params).fetchone()[0],
+                               'checked': 0, 'updated': 0}
+    last_id = job['checkpoint']
+    while True:
+        if _job_cancel_requested(conn, job['id']):
+            return False
+        last_id, checked, updated = recompute_grades_chunk(conn, last_id, academic_year=academic_year)
+        if last_id is None:
+            return True
+        report['checked'] += checked
+        report['updated'] += updated
+        _set_job(conn, job['id'], checkpoint=last_id,
+                 progress=min(report['checked'] / max(report['total'], 1), 1.0), report=report)
+        conn.commit()
+        bump_data_version()
+
+JOB_RUNNERS = {'import': _run_import_job, 'clean': _run_clean_job, 'recompute': _run_recompute_job}
+
+def run_job(job_id, db_path=DB_PATH):
+    """Chạy một job trên kết nối riêng (gọi trong thread nền). Chỉ chạy khi giành được job ở trạng thái chờ,
+    nên gửi trùng một job là vô hại. Mỗi khối của job tự làm mới xếp hạng của các SV nó ghi, trong transaction
+    của khối đó - hủy hoặc lỗi giữa chừng không để lại xếp hạng lệch với điểm."""
+    conn = _connect(db_path)
+    try:
+        claimed = conn.execute("UPDATE jobs SET status = 'running', updated_at = CURRENT_TIMESTAMP "
+                               "WHERE id = ? AND status = 'queued'", (job_id,)).rowcount
+        conn.commit()
+        if not claimed:
+            return
+        job = get_job(conn, job_id)
+        try:
+            finished = JOB_RUNNERS[job['kind']](conn, job)
+            status, error = ('done', None) if finished else ('cancelled', None)
+        except Exception:
+            conn.rollback()
+            status, error = 'failed', traceback.format_exc(limit=5)
+        _set_job(conn, job_id, status=status, error=error, **({'progress': 1.0} if status == 'done' else {}))
+        conn.commit()
+        bump_data_version()
+    finally:
+        conn.close()
+
+def save_job_upload(uploaded_file):
+    """Lưu file upload vào JOB_DIR (job đọc lại theo khối khi chạy / chạy tiếp). Trả về đường dẫn."""
+    os.makedirs(JOB_DIR, exist_ok=True)
+    name = re.sub(r'[^\w.-]+', '_', getattr(uploaded_file, 'name', '') or 'upload.csv')
+    path = os.path.join(JOB_DIR, f"{datetime.now():%Y%m%d-%H%M%S-%f}_{name}")
+    uploaded_file.seek(0)
+    with open(path, 'wb') as f:
+        # Chép theo từng đoạn, không tạo thêm một bản cả file trong bộ nhớ
+        shutil.copyfileobj(uploaded_file, f)
+    uploaded_file.seek(0)
+    return path
 
 # ======================== QUẢN LÝ USER ========================
 def create_user(conn, username, password, fullname, role, student_id=None):
@@ -391,55 +2182,104 @@ def delete_user(conn, user_id):
     c = conn.cursor()
     c.execute("DELETE FROM users WHERE id = ? AND username != 'admin'", (user_id,))
     conn.commit()
+    if c.rowcount:
+        revoke_user_sessions(conn, user_id)
 
 # ======================== GỢI Ý HỌC TẬP ========================
-def generate_study_suggestions(row, semester):
-    """Tạo gợi ý học tập dựa trên điểm số"""
-    suggestions = {
-        'hoc_lai': [],      # Điểm < 4
-        'cai_thien': [],    # Điểm 4-6
-        'can_hoc': [],      # Chưa có điểm
-        'hoc_tiep': []      # Đủ điều kiện học tiếp
-    }
-    
-    current_subjects = SEMESTER_1_SUBJECTS if semester == 1 else SEMESTER_2_SUBJECTS
-    
-    for key in current_subjects:
-        info = SUBJECTS[key]
-        score = row.get(key)
-        
-        try:
-            score_val = float(score) if pd.notna(score) else None
-        except:
-            score_val = None
-        
-        if score_val is None:
-            suggestions['can_hoc'].append(info['name'])
-        elif score_val < 4:
-            suggestions['hoc_lai'].append(f"{info['name']} ({score_val:.1f})")
-        elif score_val < 6:
-            suggestions['cai_thien'].append(f"{info['name']} ({score_val:.1f})")
-        
-        # Gợi ý học tiếp nếu đạt >= 4
-        if score_val is not None and score_val >= 4 and key in NEXT_SUBJECTS:
-            next_subject = NEXT_SUBJECTS[key]
-            if semester == 1:
-                # HK1: gợi ý các môn HK2
-                next_name = {
-                    'phap_luat': 'Pháp luật',
-                    'giai_tich_2': 'Giải tích 2',
-                    'tieng_an_do_2': 'Tiếng Ấn Độ 2'
-                }.get(next_subject, next_subject)
+SUGGESTION_KINDS = {
+    'hoc_lai': 'Cần học lại (điểm < 4)',
+    'cai_thien': 'Nên cải thiện (điểm 4-6)',
+    'can_hoc': 'Cần phải học (chưa có điểm)',
+    'hoc_tiep': 'Đủ điều kiện học tiếp',
+}
+SEMESTER_SUBJECTS = {1: SEMESTER_1_SUBJECTS, 2: SEMESTER_2_SUBJECTS}
+# Đồ thị môn học dựng một lần: môn -> tên môn học tiếp theo
+NEXT_SUBJECT_NAMES = {key: SUBJECTS[nxt]['name'] if nxt in SUBJECTS else NEXT_YEAR_SUBJECT_NAMES.get(nxt, nxt)
+                      for key, nxt in NEXT_SUBJECTS.items()}
+SUGGESTION_ID_COLUMNS = ['id', 'mssv', 'student_name', 'class_name', 'cohort', 'academic_year', 'semester']
+
+def classify_study_suggestions(df):
+    """Gợi ý học tập cho mọi bản ghi x môn của học kỳ tương ứng trong một lượt bằng mặt nạ NumPy:
+    điểm < 4 -> học lại, 4-6 -> cải thiện, trống -> cần học, >= 4 và có môn tiếp theo -> học tiếp.
+    Trả về bảng dài, mỗi dòng một gợi ý: các cột định danh có trong df + subject, score, kind, label;
+    thứ tự theo bản ghi, loại gợi ý rồi thứ tự môn trong học kỳ."""
+    id_cols = [col for col in SUGGESTION_ID_COLUMNS if col in df.columns]
+    is_first = pd.to_numeric(df['semester'], errors='coerce').to_numpy() == 1
+    parts = []
+    for semester, rows in ((1, np.flatnonzero(is_first)), (2, np.flatnonzero(~is_first))):
+        if not len(rows):
+            continue
+        subjects = SEMESTER_SUBJECTS[semester]
+        scores = df[subjects].iloc[rows].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+        has_next = np.array([key in NEXT_SUBJECTS for key in subjects])
+        masks = {
+            'hoc_lai': scores < 4,
+            'cai_thien': (scores >= 4) & (scores < 6),
+            'can_hoc': np.isnan(scores),
+            'hoc_tiep': (scores >= 4) & has_next,
+        }
+        names = np.array([SUBJECTS[key]['name'] for key in subjects], dtype=object)
+        next_names = np.array([NEXT_SUBJECT_NAMES.get(key, '') for key in subjects], dtype=object)
+        for order, (kind, mask) in enumerate(masks.items()):
+            row, col = np.nonzero(mask)
+            score = scores[row, col]
+            if kind == 'hoc_tiep':
+                label = next_names[col]
+            elif kind == 'can_hoc':
+                label = names[col]
             else:
-                # HK2: gợi ý các môn năm sau
-                next_name = {
-                    'tu_tuong': 'Tư tưởng (Năm 2)',
-                    'giai_tich_3': 'Giải tích 3 (Năm 2)',
-                    'tieng_an_do_3': 'Tiếng Ấn Độ 3 (Năm 2)'
-                }.get(next_subject, next_subject)
-            suggestions['hoc_tiep'].append(f"{next_name}")
-    
-    return suggestions
+                label = names[col] + ' (' + np.char.mod('%.1f', score).astype(object) + ')'
+            parts.append(pd.DataFrame({'_row': rows[row], '_order': order, '_col': col,
+                                       'subject': np.array(subjects, dtype=object)[col], 'score': score,
+                                       'kind': kind, 'label': label}))
+    columns = id_cols + ['subject', 'score', 'kind', 'label']
+    if not parts:
+        return pd.DataFrame(columns=columns)
+    found = pd.concat(parts, ignore_index=True).sort_values(['_row', '_order', '_col'], kind='stable')
+    result = df[id_cols].iloc[found['_row'].to_numpy()].reset_index(drop=True)
+    for col in ['subject', 'score', 'label']:
+        result[col] = found[col].to_numpy()
+    result['kind'] = pd.Categorical(found['kind'].to_numpy(), categories=list(SUGGESTION_KINDS))
+    return result[columns]
+
+def generate_study_suggestions(row, semester):
+    """Tạo gợi ý học tập dựa trên điểm số của một bản ghi (cùng quy tắc với classify_study_suggestions)"""
+    semester = 1 if semester == 1 else 2
+    frame = pd.DataFrame([{key: row.get(key) for key in SEMESTER_SUBJECTS[semester]}]).assign(semester=semester)
+    found = classify_study_suggestions(frame)
+    return {kind: found.loc[found['kind'] == kind, 'label'].tolist() for kind in SUGGESTION_KINDS}
+
+def load_study_suggestions(conn, academic_year=ACADEMIC_YEAR, class_name=None):
+    """Gợi ý học tập của cả năm học hoặc một lớp (chỉ mục năm học + lớp)"""
+    where, params = _filter_clause({'academic_year': int(academic_year), 'class_name': class_name})
+    return classify_study_suggestions(_query_grades(conn, f"{where} ORDER BY id", params))
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def _study_suggestions_cached(_conn, version, academic_year, class_name):
+    return load_study_suggestions(_conn, academic_year, class_name)
+
+def get_study_suggestions(conn, academic_year=ACADEMIC_YEAR, class_name=None):
+    return _study_suggestions_cached(conn, get_data_version(), int(academic_year), class_name)
+
+def summarize_study_suggestions(suggestions):
+    """Một dòng cho mỗi bản ghi có gợi ý (cần cột id): các gợi ý của từng loại nối bằng dấu phẩy,
+    dùng để xem hoặc gửi thông báo hàng loạt"""
+    info_cols = [col for col in SUGGESTION_ID_COLUMNS if col in suggestions.columns and col != 'id']
+    if suggestions.empty:
+        return pd.DataFrame(columns=['id'] + info_cols + list(SUGGESTION_KINDS))
+    ids = suggestions['id'].to_numpy()
+    kinds = pd.Categorical(suggestions['kind'], categories=list(SUGGESTION_KINDS)).codes
+    # Sắp (id, loại) ổn định rồi nối từng đoạn liên tiếp; groupby().agg(', '.join) chậm hơn hàng chục lần
+    order = np.lexsort((kinds, ids))
+    ids, kinds = ids[order], kinds[order]
+    labels = suggestions['label'].to_numpy()[order].tolist()
+    starts = np.flatnonzero(np.r_[True, (ids[1:] != ids[:-1]) | (kinds[1:] != kinds[:-1])])
+    ends = np.r_[starts[1:], len(ids)]
+    joined = pd.DataFrame({'id': ids[starts], 'kind': np.array(list(SUGGESTION_KINDS))[kinds[starts]],
+                           'label': [', '.join(labels[a:b]) for a, b in zip(starts, ends)]})
+    table = joined.pivot(index='id', columns='kind', values='label').reindex(columns=list(SUGGESTION_KINDS))
+    info = suggestions.drop_duplicates('id').set_index('id')[info_cols]
+    return info.join(table.fillna('')).reset_index()
 
 def display_study_suggestions(suggestions, semester):
     """Hiển thị gợi ý học tập"""
@@ -520,12 +2360,12 @@ def login_page(conn):
         if st.button("Đăng nhập", use_container_width=True):
             user = verify_user(conn, username, password)
             if user:
-                st.session_state['logged_in'] = True
-                st.session_state['username'] = username
-                st.session_state['user_id'] = user[0]
-                st.session_state['fullname'] = user[3]
-                st.session_state['role'] = user[4]
-                st.session_state['student_id'] = user[5]
+                fields = {'username': user[1], 'user_id': user[0], 'fullname': user[3], 'role': user[4],
+                          'student_id': user[5]}
+                token = issue_session_token(fields)
+                start_session(fields, token)
+                # Tải lại trang (mất session_state) vẫn giữ đăng nhập trong thời hạn của token
+                st.session_state['session_cookie'] = token
                 st.rerun()
             else:
                 st.error("Sai tên đăng nhập hoặc mật khẩu!")
@@ -535,8 +2375,7 @@ def teacher_dashboard(conn):
     st.sidebar.write("Vai trò: **Giáo viên**")
     
     if st.sidebar.button("Đăng xuất", type = "primary"):
-        for key in list(st.session_state.keys()):
-            del st.session_state[key]
+        logout(conn)
         st.rerun()
     
     menu = st.sidebar.radio("Menu", [
@@ -548,66 +2387,81 @@ def teacher_dashboard(conn):
         "Export dữ liệu",
         "Làm sạch dữ liệu",
         "Quản lý tài khoản",
-        "Biểu đồ phân tích"
+        "Biểu đồ phân tích",
+        "Gợi ý học tập",
+        "Điều kiện học kỳ 2",
+        "Công việc nền"
     ])
     
-    df = load_grades(conn)
+    academic_year = select_academic_year(conn)
     
     if menu == "Dashboard":
-        show_dashboard(df)
+        show_dashboard(conn, academic_year)
     elif menu == "Quản lý điểm":
-        manage_grades_new(conn, df)
+        manage_grades_new(conn, academic_year)
     elif menu == "Xếp hạng theo GPA":
-        show_ranking(df)
+        show_ranking(conn, academic_year)
     elif menu == "Thêm điểm":
-        add_grade_form(conn)
+        add_grade_form(conn, academic_year)
     elif menu == "Import dữ liệu":
-        import_data(conn)
+        import_data(conn, academic_year)
     elif menu == "Export dữ liệu":
-        export_data(df)
+        export_data(conn, academic_year)
     elif menu == "Làm sạch dữ liệu":
-        clean_data_page(conn, df)
+        clean_data_page(conn)
     elif menu == "Quản lý tài khoản":
         manage_users(conn)
     elif menu == "Biểu đồ phân tích":
-        show_charts(df)
+        show_charts(conn, academic_year)
+    elif menu == "Gợi ý học tập":
+        study_advisor_page(conn, academic_year)
+    elif menu == "Điều kiện học kỳ 2":
+        eligibility_page(conn, academic_year)
+    elif menu == "Công việc nền":
+        jobs_page(conn, academic_year)
+
+def select_academic_year(conn):
+    """Chọn năm học đang xem ở sidebar; mặc định năm gần nhất có dữ liệu"""
+    years = list_academic_years(conn) or [int(ACADEMIC_YEAR)]
+    if st.session_state.get('academic_year') not in years:
+        st.session_state['academic_year'] = years[-1]
+    return st.sidebar.selectbox("Năm học", years, key='academic_year')
+
+RANKING_VIEWS = {
+    "Tổng hợp (cả 2 kỳ)": ('all', "Chưa có sinh viên nào hoàn thành đủ cả 2 học kỳ."),
+    "Học kỳ 1": ('1', "Không có dữ liệu điểm Học kỳ 1."),
+    "Học kỳ 2": ('2', "Không có dữ liệu điểm Học kỳ 2."),
+    "Tích lũy các năm": ('cum', "Chưa có dữ liệu điểm tích lũy."),
+}
 
-def show_ranking(df):
-    """Hiển thị bảng xếp hạng theo GPA - ĐÃ SỬA"""
+def show_ranking(conn, academic_year=ACADEMIC_YEAR):
+    """Hiển thị bảng xếp hạng theo GPA của một năm học. Top 3, trang đang xem và thống kê đều là truy vấn
+    trên bảng rankings dựng sẵn, không tải cả bảng xếp hạng"""
     st.title("Xếp hạng theo điểm GPA")
     
-    if df.empty:
+    if conn.execute("SELECT 1 FROM rankings WHERE academic_year = ? LIMIT 1", (int(academic_year),)).fetchone() is None:
         st.warning("Chưa có dữ liệu để xếp hạng.")
         return
     
-    semester_option = st.radio(
-        "Chọn học kỳ",
-        ["Tổng hợp (cả 2 kỳ)", "Học kỳ 1", "Học kỳ 2"],
-        horizontal=True
-    )
+    semester_option = st.radio("Chọn học kỳ", list(RANKING_VIEWS.keys()), horizontal=True)
+    rank_method = st.radio("Cách xếp hạng khi đồng điểm", list(RANK_METHODS.keys()),
+                           format_func=RANK_METHODS.get, horizontal=True, key='rank_method')
     
-    if semester_option == "Học kỳ 1":
-        ranking_df = get_ranking_by_semester(df, semester=1)
-        if ranking_df.empty:
-            st.info("Không có dữ liệu điểm Học kỳ 1.")
-            return
-        display_cols = ['xep_hang', 'mssv', 'student_name', 'class_name', 'diem_tb', 'xep_loai']
-    elif semester_option == "Học kỳ 2":
-        ranking_df = get_ranking_by_semester(df, semester=2)
-        if ranking_df.empty:
-            st.info("Không có dữ liệu điểm Học kỳ 2.")
-            return
-        display_cols = ['xep_hang', 'mssv', 'student_name', 'class_name', 'diem_tb', 'xep_loai']
-    else:
-        ranking_df = get_ranking_by_semester(df, semester='all')
-        if ranking_df.empty:
-            st.info("Chưa có sinh viên nào hoàn thành đủ cả 2 học kỳ.")
-            return
+    scope, empty_message = RANKING_VIEWS[semester_option]
+    summary = get_ranking_summary(conn, scope, academic_year)
+    if summary['total'] == 0:
+        st.info(empty_message)
+        return
+    if scope == 'all':
         display_cols = ['xep_hang', 'mssv', 'student_name', 'class_name', 'diem_tb_hk1', 'diem_tb_hk2', 'diem_tb', 'xep_loai']
+    elif scope == 'cum':
+        display_cols = ['xep_hang', 'mssv', 'student_name', 'class_name', 'so_ky', 'diem_tb', 'xep_loai']
+    else:
+        display_cols = ['xep_hang', 'mssv', 'student_name', 'class_name', 'diem_tb', 'xep_loai']
     
     # Hiển thị top 3
     st.subheader("Top 3 sinh viên xuất sắc")
-    top3 = ranking_df.head(3)
+    top3, _ = query_ranking_page(conn, scope, academic_year, rank_method, page_size=3)
     
     cols = st.columns(3)
     medals = ["🥇", "🥈", "🥉"]
@@ -630,87 +2484,99 @@ def show_ranking(df):
     st.subheader("Bảng xếp hạng đầy đủ")
     
     # Bộ lọc
-    col1, col2 = st.columns(2)
+    col1, col2, col3 = st.columns(3)
     with col1:
         search = st.text_input("Tìm kiếm (MSSV/Tên)", key="ranking_search")
     with col2:
         xep_loai_filter = st.selectbox("Lọc theo xếp loại", 
-                                       ['Tất cả'] + list(ranking_df['xep_loai'].dropna().unique()))
-    
-    filtered_df = ranking_df.copy()
-    if search:
-        filtered_df = filtered_df[
-            filtered_df['mssv'].astype(str).str.contains(search, case=False, na=False) |
-            filtered_df['student_name'].str.contains(search, case=False, na=False)
-        ]
-    if xep_loai_filter != 'Tất cả':
-        filtered_df = filtered_df[filtered_df['xep_loai'] == xep_loai_filter]
+                                       ['Tất cả'] + list(summary['xep_loai'].keys()))
+    with col3:
+        cohort_filter = st.selectbox("Khóa", ['Tất cả'] + list_cohorts(conn, academic_year), key="ranking_cohort")
+    
+    page = st.session_state.get('ranking_page', 1)
+    page_df, total = query_ranking_page(conn, scope, academic_year, rank_method,
+                                        xep_loai=None if xep_loai_filter == 'Tất cả' else xep_loai_filter,
+                                        cohort=None if cohort_filter == 'Tất cả' else cohort_filter,
+                                        search=search.strip() or None, page=page)
+    page_count = max((total + GRADE_PAGE_SIZE - 1) // GRADE_PAGE_SIZE, 1)
+    if page > page_count:
+        # Bộ lọc thay đổi làm số trang giảm -> quay về trang cuối hợp lệ
+        st.session_state['ranking_page'] = page_count
+        st.rerun()
     
     # Rename columns cho dễ đọc
-    display_df = filtered_df[display_cols].copy()
-    if semester_option == "Tổng hợp (cả 2 kỳ)":
+    display_df = page_df[display_cols].copy()
+    if scope == 'all':
         display_df.columns = ['Xếp hạng', 'MSSV', 'Họ tên', 'Lớp', 'ĐTB HK1', 'ĐTB HK2', 'Điểm TB', 'Xếp loại']
+    elif scope == 'cum':
+        display_df.columns = ['Xếp hạng', 'MSSV', 'Họ tên', 'Lớp', 'Số kỳ', 'Điểm TB tích lũy', 'Xếp loại']
     else:
         display_df.columns = ['Xếp hạng', 'MSSV', 'Họ tên', 'Lớp', 'Điểm TB', 'Xếp loại']
     
-    st.dataframe(display_df, use_container_width=True, hide_index=True)
+    if total:
+        st.dataframe(display_df, use_container_width=True, hide_index=True)
+        st.number_input("Trang", min_value=1, max_value=page_count, step=1, key='ranking_page')
+        st.caption(f"Trang {page}/{page_count} - {total} sinh viên")
+    else:
+        st.info("Không có sinh viên phù hợp.")
     
     # Thống kê
     st.subheader("Thống kê xếp hạng")
     col1, col2, col3, col4 = st.columns(4)
     with col1:
-        st.metric("Tổng số SV", len(ranking_df))
+        st.metric("Tổng số SV", summary['total'])
     with col2:
-        st.metric("Điểm TB cao nhất", f"{ranking_df['diem_tb'].max():.2f}")
+        st.metric("Điểm TB cao nhất", f"{summary['max']:.2f}")
     with col3:
-        st.metric("Điểm TB thấp nhất", f"{ranking_df['diem_tb'].min():.2f}")
+        st.metric("Điểm TB thấp nhất", f"{summary['min']:.2f}")
     with col4:
-        excellent_count = len(ranking_df[ranking_df['xep_loai'].isin(['Giỏi', 'Xuất sắc'])])
+        excellent_count = summary['xep_loai'].get('Giỏi', 0) + summary['xep_loai'].get('Xuất sắc', 0)
         st.metric("Số SV Giỏi/Xuất sắc", excellent_count)
 
-def show_dashboard(df):
+def show_dashboard(conn, academic_year=ACADEMIC_YEAR):
     st.title("Dashboard Tổng quan")
+    st.caption(f"Năm học {academic_year}")
     
-    if df.empty:
+    stats = get_grade_aggregates(conn, academic_year)
+    if stats is None:
         st.warning("Chưa có dữ liệu. Vui lòng import hoặc thêm dữ liệu.")
         return
+    overview = stats['overview']
     
     col1, col2, col3, col4 = st.columns(4)
     with col1:
-        st.metric("Tổng sinh viên", df['mssv'].nunique())
+        st.metric("Tổng sinh viên", overview['students'])
     with col2:
-        st.metric("Điểm TB", f"{df['diem_tb'].mean():.2f}")
+        st.metric("Điểm TB", f"{overview['mean']:.2f}")
     with col3:
-        st.metric("Cao nhất", f"{df['diem_tb'].max():.2f}")
+        st.metric("Cao nhất", f"{overview['max']:.2f}")
     with col4:
-        st.metric("Thấp nhất", f"{df['diem_tb'].min():.2f}")
+        st.metric("Thấp nhất", f"{overview['min']:.2f}")
     
     st.subheader("Thống kê theo học kỳ")
     col1, col2 = st.columns(2)
     with col1:
-        sem1_count = len(df[df['semester'] == 1])
-        st.metric("Học kỳ 1", f"{sem1_count} bản ghi")
+        st.metric("Học kỳ 1", f"{stats['semester_counts'].get(1, 0)} bản ghi")
     with col2:
-        sem2_count = len(df[df['semester'] == 2])
-        st.metric("Học kỳ 2", f"{sem2_count} bản ghi")
+        st.metric("Học kỳ 2", f"{stats['semester_counts'].get(2, 0)} bản ghi")
     
     st.subheader("Thống kê theo xếp loại")
-    xep_loai_counts = df['xep_loai'].fillna('Chưa xếp loại').value_counts()
+    xep_loai_counts = stats['xep_loai_counts']
     col1, col2 = st.columns(2)
     with col1:
-        fig = px.pie(values=xep_loai_counts.values, names=xep_loai_counts.index, 
+        fig = px.pie(xep_loai_counts, values='count', names='xep_loai', 
                     title='Phân bố xếp loại')
         st.plotly_chart(fig, use_container_width=True)
     with col2:
-        fig = px.bar(x=xep_loai_counts.index, y=xep_loai_counts.values,
-                    title='Số lượng theo xếp loại', labels={'x': 'Xếp loại', 'y': 'Số lượng'})
+        fig = px.bar(xep_loai_counts, x='xep_loai', y='count',
+                    title='Số lượng theo xếp loại', labels={'xep_loai': 'Xếp loại', 'count': 'Số lượng'})
         st.plotly_chart(fig, use_container_width=True)
 
-def manage_grades_new(conn, df):
-    """Quản lý điểm - chỉ XEM & XÓA (đã bỏ sửa điểm)"""
+def manage_grades_new(conn, academic_year=ACADEMIC_YEAR):
+    """Quản lý điểm của một năm học - chỉ XEM & XÓA (đã bỏ sửa điểm), phân trang trong SQLite"""
     st.title("Quản lý điểm sinh viên")
 
-    if df.empty:
+    if conn.execute("SELECT 1 FROM grades WHERE academic_year = ? LIMIT 1", (int(academic_year),)).fetchone() is None:
         st.warning("Chưa có dữ liệu điểm.")
         return
 
@@ -720,50 +2586,57 @@ def manage_grades_new(conn, df):
         ['Tất cả từng kỳ', 'Học kỳ 1', 'Học kỳ 2', 'Tổng hợp'],
         horizontal=True
     )
+    combined = semester_filter == 'Tổng hợp'
+    sort_columns = COMBINED_SORT_COLUMNS if combined else GRADE_SORT_COLUMNS
 
-    # Lọc dữ liệu
-    if semester_filter == 'Học kỳ 1':
-        filtered_df = df[df['semester'] == 1].copy()
-    elif semester_filter == 'Học kỳ 2':
-        filtered_df = df[df['semester'] == 2].copy()
-    elif semester_filter == 'Tổng hợp':
-        combined_rows = []
-        for mssv, group in df.groupby('mssv'):
-            if set(group['semester']) == {1, 2}:
-                sem1 = group[group['semester'] == 1].iloc[0]
-                sem2 = group[group['semester'] == 2].iloc[0]
-                dtb = round((sem1['diem_tb'] + sem2['diem_tb']) / 2, 2)
-
-                combined_rows.append({
-                    'mssv': mssv,
-                    'student_name': sem1['student_name'],
-                    'class_name': sem1['class_name'],
-                    'diem_tb_hk1': sem1['diem_tb'],
-                    'diem_tb_hk2': sem2['diem_tb'],
-                    'diem_tb': dtb,
-                    'xep_loai': calculate_grade(dtb)
-                })
-
-        filtered_df = pd.DataFrame(combined_rows)
+    col1, col2, col3, col4, col5 = st.columns(5)
+    with col1:
+        class_filter = st.selectbox("Lớp", ['Tất cả'] + list_grade_classes(conn, academic_year))
+    with col2:
+        cohort_filter = st.selectbox("Khóa", ['Tất cả'] + list_cohorts(conn, academic_year))
+    with col3:
+        xep_loai_filter = st.selectbox("Xếp loại", ['Tất cả'] + list(GRADE_LABELS[::-1]))
+    with col4:
+        sort_by = st.selectbox("Sắp xếp theo", list(sort_columns.keys()), format_func=sort_columns.get)
+    with col5:
+        descending = st.checkbox("Giảm dần", value=(sort_by == 'diem_tb'))
+
+    filters = {
+        'academic_year': academic_year,
+        'class_name': None if class_filter == 'Tất cả' else class_filter,
+        'cohort': None if cohort_filter == 'Tất cả' else cohort_filter,
+        'xep_loai': None if xep_loai_filter == 'Tất cả' else xep_loai_filter,
+    }
+    page = st.session_state.get('grades_page', 1)
+    if combined:
+        page_df, total = query_combined_page(conn, sort_by=sort_by, descending=descending, page=page, **filters)
     else:
-        filtered_df = df.copy()
+        semester = {'Học kỳ 1': 1, 'Học kỳ 2': 2}.get(semester_filter)
+        page_df, total = query_grades_page(conn, semester=semester, sort_by=sort_by, descending=descending,
+                                           page=page, **filters)
+    page_count = max((total + GRADE_PAGE_SIZE - 1) // GRADE_PAGE_SIZE, 1)
+    if page > page_count:
+        # Bộ lọc thay đổi làm số trang giảm -> quay về trang cuối hợp lệ
+        st.session_state['grades_page'] = page_count
+        st.rerun()
 
     # Hiển thị bảng
-    if not filtered_df.empty:
-        if semester_filter == 'Tổng hợp':
-            display_df = filtered_df[
-                ['mssv', 'student_name', 'class_name',
+    if not page_df.empty:
+        if combined:
+            display_df = page_df[
+                ['xep_hang', 'mssv', 'student_name', 'class_name',
                  'diem_tb_hk1', 'diem_tb_hk2', 'diem_tb', 'xep_loai']
             ]
-            display_df.columns = ['MSSV', 'Họ tên', 'Lớp', 'ĐTB HK1', 'ĐTB HK2', 'Điểm TB', 'Xếp loại']
+            display_df.columns = ['Xếp hạng', 'MSSV', 'Họ tên', 'Lớp', 'ĐTB HK1', 'ĐTB HK2', 'Điểm TB', 'Xếp loại']
         else:
-            display_df = filtered_df[
+            display_df = page_df[
                 ['mssv', 'student_name', 'class_name', 'semester', 'diem_tb', 'xep_loai']
             ]
             display_df.columns = ['MSSV', 'Họ tên', 'Lớp', 'Học kỳ', 'Điểm TB', 'Xếp loại']
 
         st.dataframe(display_df, use_container_width=True, hide_index=True)
-        st.caption(f"Tổng số: {len(display_df)} bản ghi")
+        st.number_input("Trang", min_value=1, max_value=page_count, step=1, key='grades_page')
+        st.caption(f"Trang {page}/{page_count} - Tổng số: {total} bản ghi")
     else:
         st.info("Không có dữ liệu phù hợp.")
 
@@ -778,32 +2651,39 @@ def manage_grades_new(conn, df):
 
     # Kết quả tìm kiếm
     if search_term:
-        search_results = df[
-            df['mssv'].astype(str).str.contains(search_term, case=False, na=False) |
-            df['student_name'].str.contains(search_term, case=False, na=False)
-        ]
+        search_results = search_grades(conn, search_term)
 
         if not search_results.empty:
             st.success(f"Tìm thấy {len(search_results)} bản ghi")
             result_df = search_results[
-                ['mssv', 'student_name', 'class_name', 'semester', 'diem_tb', 'xep_loai']
+                ['mssv', 'student_name', 'class_name', 'academic_year', 'semester', 'diem_tb', 'xep_loai']
             ]
-            result_df.columns = ['MSSV', 'Họ tên', 'Lớp', 'Học kỳ', 'Điểm TB', 'Xếp loại']
+            result_df.columns = ['MSSV', 'Họ tên', 'Lớp', 'Năm học', 'Học kỳ', 'Điểm TB', 'Xếp loại']
             st.dataframe(result_df, use_container_width=True, hide_index=True)
         else:
             st.warning("Không tìm thấy sinh viên phù hợp.")
 
-    # XÓA ĐIỂM
+    # XÓA ĐIỂM - từng bản ghi trong trang đang xem, hoặc cả nhóm theo điều kiện
     if show_delete:
         st.divider()
         st.subheader("Xóa điểm sinh viên")
 
+        delete_mode = st.radio("Chế độ xóa", ["Xóa 1", "Xóa nhiều", "Xóa theo điều kiện"], horizontal=True)
+
+        if delete_mode == "Xóa theo điều kiện":
+            delete_by_predicate(conn, academic_year)
+            return
+        if combined:
+            st.info("Chọn chế độ xem theo kỳ để xóa từng bản ghi.")
+            return
+        if page_df.empty:
+            return
+
         delete_options = {
-            row['id']: f"{row['mssv']} - {row['student_name']} - HK{int(row['semester'])} - ĐTB {row['diem_tb']:.2f}"
-            for _, row in df.iterrows()
+            row.id: f"{row.mssv} - {row.student_name} - HK{int(row.semester)} - ĐTB {row.diem_tb or 0:.2f}"
+            for row in page_df.itertuples(index=False)
         }
-
-        delete_mode = st.radio("Chế độ xóa", ["Xóa 1", "Xóa nhiều"], horizontal=True)
+        st.caption(f"Các bản ghi của trang {page}")
 
         if delete_mode == "Xóa 1":
             del_id = st.selectbox("Chọn bản ghi", delete_options.keys(), format_func=lambda x: delete_options[x])
@@ -817,11 +2697,49 @@ def manage_grades_new(conn, df):
                                      format_func=lambda x: delete_options[x])
             if del_ids and st.checkbox("Xác nhận xóa tất cả"):
                 if st.button("Xóa tất cả", type="primary"):
-                    delete_grades_batch(conn, del_ids)
-                    st.success(f"Đã xóa {len(del_ids)} bản ghi!")
+                    deleted = delete_grades_batch(conn, del_ids)
+                    st.success(f"Đã xóa {deleted} bản ghi!")
                     st.rerun()
 
-def add_grade_form(conn):
+def delete_by_predicate(conn, academic_year=ACADEMIC_YEAR):
+    """Xóa cả lớp / học kỳ / khóa / đợt import bằng một câu lệnh; lớp, học kỳ và khóa tính trong năm học đang xem"""
+    deleted = st.session_state.pop('predicate_deleted', None)
+    if deleted is not None:
+        st.success(f"Đã xóa {deleted} bản ghi!")
+
+    batches = dict(list_import_batches(conn))
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        class_name = st.selectbox("Lớp cần xóa", ['Tất cả'] + list_grade_classes(conn, academic_year))
+    with col2:
+        semester = st.selectbox("Học kỳ cần xóa", ['Tất cả', 1, 2])
+    with col3:
+        cohort = st.selectbox("Khóa cần xóa", ['Tất cả'] + list_cohorts(conn, academic_year))
+    with col4:
+        batch = st.selectbox("Đợt import", ['Tất cả'] + list(batches.keys()),
+                             format_func=lambda b: b if b == 'Tất cả' else f"{b} ({batches[b]} bản ghi)")
+
+    predicate = {
+        'class_name': None if class_name == 'Tất cả' else class_name,
+        'semester': None if semester == 'Tất cả' else semester,
+        'cohort': None if cohort == 'Tất cả' else cohort,
+        'import_batch': None if batch == 'Tất cả' else batch,
+    }
+    if all(value is None for value in predicate.values()):
+        st.info("Chọn ít nhất một điều kiện để xóa.")
+        return
+    if predicate['import_batch'] is None:
+        # Đợt import có thể trải nhiều năm; các điều kiện còn lại chỉ áp dụng cho năm học đang xem
+        predicate['academic_year'] = academic_year
+
+    matched = count_grades_where(conn, **predicate)
+    st.warning(f"Sẽ xóa {matched} bản ghi thỏa điều kiện.")
+    if matched and st.checkbox("Xác nhận xóa theo điều kiện"):
+        if st.button("Xóa theo điều kiện", type="primary"):
+            st.session_state['predicate_deleted'] = delete_grades_where(conn, **predicate)
+            st.rerun()
+
+def add_grade_form(conn, academic_year=ACADEMIC_YEAR):
     st.title("Thêm điểm sinh viên")
     
     semester = st.radio("Chọn học kỳ", [1, 2], horizontal=True)
@@ -831,10 +2749,12 @@ def add_grade_form(conn):
         mssv = st.text_input("MSSV *")
         student_name = st.text_input("Họ tên *")
         class_name = st.text_input("Lớp")
+    with col2:
+        cohort = st.text_input("Khóa")
     
     can_sem2 = True
     if semester == 2 and mssv:
-        can_sem2, message = can_take_semester_2(conn, mssv)
+        can_sem2, message = can_take_semester_2(conn, mssv, academic_year)
         if can_sem2:
             st.success(f"{message}")
         else:
@@ -856,33 +2776,22 @@ def add_grade_form(conn):
                 label += " *"
             subject_scores[key] = st.number_input(label, 0.0, 10.0, 0.0, key=f"add_{key}")
     
-    st.info(f"Năm học: **{ACADEMIC_YEAR}** (cố định)")
+    st.info(f"Năm học: **{academic_year}** (đổi ở thanh bên)")
     
     if st.button("Thêm điểm", type="primary", disabled=(semester == 2 and not can_sem2)):
         if mssv and student_name:
-            scores_for_avg = {k: v for k, v in subject_scores.items() 
-                           if SUBJECTS[k]['counts_gpa'] and v > 0}
-            diem_tb = round(np.mean(list(scores_for_avg.values())), 2) if scores_for_avg else 0.0
-            xep_loai = calculate_grade(diem_tb)
+            # Trên form, điểm 0 nghĩa là chưa nhập -> không lưu, không tính vào điểm TB
+            entered = {k: (float(v) if v > 0 else None) for k, v in subject_scores.items()}
+            diem_tbs, xep_loais = score_grades(pd.DataFrame([entered], dtype=float))
+            diem_tb, xep_loai = float(diem_tbs[0]), xep_loais[0]
             
-            all_scores = {k: None for k in SUBJECTS.keys()}
-            all_scores.update(subject_scores)
+            record = {k: None for k in SUBJECTS.keys()}
+            record.update(entered)
+            record.update(mssv=mssv, student_name=student_name, class_name=class_name, semester=int(semester),
+                          diem_tb=float(diem_tb), xep_loai=xep_loai, academic_year=int(academic_year),
+                          cohort=cohort or None)
             
-            params = (
-                mssv, student_name, class_name, int(semester),
-                float(all_scores['triet']) if all_scores['triet'] is not None else None,
-                float(all_scores['giai_tich_1']) if all_scores['giai_tich_1'] is not None else None,
-                float(all_scores['giai_tich_2']) if all_scores['giai_tich_2'] is not None else None,
-                float(all_scores['tieng_an_do_1']) if all_scores['tieng_an_do_1'] is not None else None,
-                float(all_scores['tieng_an_do_2']) if all_scores['tieng_an_do_2'] is not None else None,
-                float(all_scores['gdtc']) if all_scores['gdtc'] is not None else None,
-                float(all_scores['thvp']) if all_scores['thvp'] is not None else None,
-                float(all_scores['tvth']) if all_scores['tvth'] is not None else None,
-                float(all_scores['phap_luat']) if all_scores['phap_luat'] is not None else None,
-                float(all_scores['logic']) if all_scores['logic'] is not None else None,
-                float(diem_tb), xep_loai, int(ACADEMIC_YEAR)
-            )
-            ok, err = save_grade(conn, params)
+            ok, err = save_grade(conn, tuple(record[col] for col in GRADE_COLUMNS))
             if ok:
                 st.success(f"Đã thêm điểm cho {student_name} - ĐTB: {diem_tb} - Xếp loại: {xep_loai}")
             else:
@@ -890,32 +2799,27 @@ def add_grade_form(conn):
         else:
             st.error("Vui lòng nhập MSSV và Họ tên!")
 
-def clean_data_page(conn, df):
+def clean_data_page(conn):
     st.title("Làm sạch dữ liệu")
+
+    job_id = st.session_state.pop('clean_job', None)
+    if job_id:
+        st.success(f"Đã đưa việc làm sạch vào hàng đợi: công việc #{job_id}. Theo dõi ở trang **Công việc nền**.")
     
     st.subheader("Phân tích dữ liệu hiện tại")
     
-    # Đếm trùng MSSV + học kỳ
-    duplicate_semester = int(df.duplicated(subset=['mssv', 'semester'], keep='first').sum()) if not df.empty else 0
-    
-    # Đếm MSSV trùng nhưng TÊN KHÁC nhau
-    duplicate_name = 0
-    if not df.empty:
-        name_conflict_groups = df.groupby("mssv")["student_name"].nunique()
-        duplicate_name = int((name_conflict_groups > 1).sum())   # số MSSV có nhiều tên
-    
-    # Điểm âm
-    negative_count = 0
-    for key in SUBJECTS.keys():
-        if key in df.columns:
-            negative_count += int((pd.to_numeric(df[key], errors='coerce') < 0).sum())
+    # Chạy thử (không ghi) để biết chính xác những gì sẽ thay đổi
+    plan = clean_data(conn, dry_run=True)
+    duplicate_semester = plan['removed_semester']
+    duplicate_name = plan['removed_name_conflict']
+    negative_count = plan['negative_fixed']
     
     col1, col2 = st.columns(2)
     with col1:
         if duplicate_semester > 0 or duplicate_name > 0:
             st.error(
                 f"- {duplicate_semester} bản ghi trùng **MSSV + Học kỳ**\n"
-                f"- {duplicate_name} MSSV có **nhiều tên khác nhau**"
+                f"- {duplicate_name} bản ghi của MSSV có **nhiều tên khác nhau**"
             )
         else:
             st.success("Không có bản ghi trùng lặp")
@@ -925,6 +2829,13 @@ def clean_data_page(conn, df):
             st.error(f"Có **{negative_count}** điểm âm (không hợp lệ)")
         else:
             st.success("Không có điểm âm")
+
+    if duplicate_semester or duplicate_name or negative_count:
+        with st.expander("Xem trước thay đổi"):
+            st.write(f"ID bản ghi sẽ xóa: {plan['duplicate_ids'] + plan['name_conflict_ids']}")
+            if not plan['rescored'].empty:
+                st.write("Điểm TB được tính lại:")
+                st.dataframe(plan['rescored'], hide_index=True)
     
     st.divider()
     
@@ -933,25 +2844,16 @@ def clean_data_page(conn, df):
     st.write("- Xóa các bản ghi trùng **MSSV + Học kỳ** (giữ bản ghi đầu tiên)")
     st.write("- Xóa các bản ghi **MSSV có nhiều tên**, giữ tên xuất hiện nhiều nhất")
     st.write("- Xóa các điểm có giá trị âm")
-    st.write("- Tính lại điểm TB và xếp loại")
+    st.write("- Tính lại điểm TB và xếp loại của các bản ghi bị sửa")
     
     if st.button(
         "Làm sạch dữ liệu", type="primary", 
         disabled=(duplicate_semester == 0 and duplicate_name == 0 and negative_count == 0)
     ):
-        try:
-            duplicates_removed, name_removed, negatives_fixed = clean_data(conn)
-            st.success(
-                f"Hoàn thành!\n"
-                f"- Xóa {duplicates_removed} bản ghi trùng MSSV + học kỳ\n"
-                f"- Xóa {name_removed} bản ghi do **MSSV có nhiều tên**\n"
-                f"- Sửa {negatives_fixed} điểm âm."
-            )
-            st.rerun()
-        except Exception as e:
-            st.error(f"Lỗi khi làm sạch: {e}")
+        st.session_state['clean_job'] = start_job(conn, 'clean', {}, st.session_state.get('username'))
+        st.rerun()
 
-def import_data(conn):
+def import_data(conn, academic_year=ACADEMIC_YEAR):
     st.title("Import dữ liệu")
 
     # ==========================
@@ -987,95 +2889,194 @@ CSV cho cả hai kỳ:
 - mssv, student_name, class_name, semester
 - Điểm theo từng kỳ được lưu 2 dòng khác nhau
         """)
+    st.caption(f"Cột tùy chọn: academic_year (ô trống hoặc không có cột -> năm học {academic_year}), "
+               f"cohort (khóa)")
+
+    if ensure_unique_term_index(conn):
+        conn.commit()
+    mode = default_import_mode(conn)
+    if mode == 'upsert':
+        st.caption("Dòng đã có (cùng MSSV + năm học + học kỳ) chỉ được ghi lại khi nội dung thay đổi; "
+                   "import lại cùng một file không tạo bản ghi trùng.")
+    else:
+        st.warning("Dữ liệu đang có bản ghi trùng MSSV + năm học + học kỳ nên import sẽ thêm mới mọi dòng. "
+                   "Chạy **Làm sạch dữ liệu** để bật chế độ cập nhật.")
 
     # ==========================
     #       UPLOAD FILE
     # ==========================
-    uploaded_file = st.file_uploader("Chọn file CSV", type=['csv'])
+    job_id = st.session_state.pop('import_job', None)
+    if job_id:
+        st.success(f"Đã đưa file vào hàng đợi import: công việc #{job_id}. Theo dõi ở trang **Công việc nền**.")
+
+    uploaded_file = st.file_uploader("Chọn file CSV/XLSX", type=['csv', 'xlsx'])
 
     if uploaded_file:
         try:
-            df = pd.read_csv(uploaded_file)
             st.write("Xem trước dữ liệu:")
-            st.dataframe(df.head(10))
+            st.dataframe(read_upload_preview(uploaded_file))
 
             # ==========================
             #       IMPORT BUTTON
             # ==========================
             if st.button("Import vào database"):
-                c = conn.cursor()
-
-                # Đảm bảo tất cả môn đều tồn tại trong DataFrame
-                for key in SUBJECTS.keys():
-                    if key not in df.columns:
-                        df[key] = np.nan
-                    else:
-                        df[key] = pd.to_numeric(df[key], errors='coerce')
-
-                count_inserted = 0
-
-                # ==========================
-                #       IMPORT LOGIC
-                # ==========================
-                for _, row in df.iterrows():
-
-                    semester = int(row.get("semester", 1))
-
-                    # Lọc đúng theo lựa chọn
-                    if option == "Học kỳ 1" and semester != 1:
-                        continue
-                    if option == "Học kỳ 2" and semester != 2:
-                        continue
-
-                    # Tính điểm trung bình + xếp loại
-                    diem_tb = calculate_average(row)
-                    xep_loai = calculate_grade(diem_tb)
-
-                    params = (
-                        row.get('mssv', ''), row.get('student_name', ''), row.get('class_name', ''),
-                        semester,
-                        None if pd.isna(row['triet']) else float(row['triet']),
-                        None if pd.isna(row['giai_tich_1']) else float(row['giai_tich_1']),
-                        None if pd.isna(row['giai_tich_2']) else float(row['giai_tich_2']),
-                        None if pd.isna(row['tieng_an_do_1']) else float(row['tieng_an_do_1']),
-                        None if pd.isna(row['tieng_an_do_2']) else float(row['tieng_an_do_2']),
-                        None if pd.isna(row['gdtc']) else float(row['gdtc']),
-                        None if pd.isna(row['thvp']) else float(row['thvp']),
-                        None if pd.isna(row['tvth']) else float(row['tvth']),
-                        None if pd.isna(row['phap_luat']) else float(row['phap_luat']),
-                        None if pd.isna(row['logic']) else float(row['logic']),
-                        float(diem_tb),
-                        xep_loai,
-                        int(ACADEMIC_YEAR)
-                    )
-
-                    try:
-                        c.execute('''INSERT INTO grades (mssv, student_name, class_name, semester,
-                                     triet, giai_tich_1, giai_tich_2, tieng_an_do_1, tieng_an_do_2,
-                                     gdtc, thvp, tvth, phap_luat, logic,
-                                     diem_tb, xep_loai, academic_year)
-                                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', params)
-                        count_inserted += 1
-                    except Exception as e:
-                        print("Lỗi khi insert:", e)
-
-                conn.commit()
-                st.success(f"Đã import {count_inserted} bản ghi thành công!")
+                path = save_job_upload(uploaded_file)
+                params = {
+                    'path': path,
+                    'name': uploaded_file.name,
+                    'workers': import_workers_for(os.path.getsize(path)),
+                    'option': option,
+                    'mode': mode,
+                    'academic_year': int(academic_year),
+                    'import_batch': f"{datetime.now():%Y%m%d-%H%M%S} {uploaded_file.name}",
+                }
+                st.session_state['import_job'] = start_job(conn, 'import', params, st.session_state.get('username'))
                 st.rerun()
 
         except Exception as e:
             st.error(f"Lỗi khi đọc file: {e}")
 
 
-def export_data(df):
+def export_data(conn, academic_year=ACADEMIC_YEAR):
+    """Export bảng điểm / bảng xếp hạng của một năm học; file được ghi theo khối (xem export_grades)"""
     st.title("Export dữ liệu")
+    st.caption(f"Năm học {academic_year}")
     
-    if df.empty:
+    if count_grades_where(conn, academic_year=academic_year) == 0:
         st.warning("Không có dữ liệu để export.")
         return
     
-    csv = df.to_csv(index=False).encode('utf-8-sig')
-    st.download_button("Tải file CSV", csv, "student_grades.csv", "text/csv")
+    sources = {"Bảng điểm": 'grades'}
+    sources.update({f"Xếp hạng - {label}": scope for label, (scope, _) in RANKING_VIEWS.items()})
+    col1, col2 = st.columns(2)
+    with col1:
+        source = sources[st.selectbox("Dữ liệu", list(sources.keys()), key="export_source")]
+    with col2:
+        fmt = st.selectbox("Định dạng", list(EXPORT_FORMATS.keys()),
+                           format_func=lambda key: EXPORT_FORMATS[key][0], key="export_format")
+    
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        class_name = st.selectbox("Lớp", ['Tất cả'] + list_grade_classes(conn, academic_year), key="export_class")
+    with col2:
+        cohort = st.selectbox("Khóa", ['Tất cả'] + list_cohorts(conn, academic_year), key="export_cohort")
+    with col3:
+        semester = st.selectbox("Học kỳ", ['Tất cả', 1, 2], key="export_semester", disabled=source != 'grades')
+    
+    filters = {
+        'academic_year': academic_year,
+        'class_name': None if class_name == 'Tất cả' else class_name,
+        'cohort': None if cohort == 'Tất cả' else cohort,
+    }
+    if source == 'grades':
+        available, default = EXPORT_GRADE_COLUMNS, GRADE_COLUMNS
+        filters['semester'] = None if semester == 'Tất cả' else semester
+    else:
+        available = default = EXPORT_RANKING_COLUMNS
+        filters['rank_method'] = st.radio("Cách xếp hạng khi đồng điểm", list(RANK_METHODS.keys()),
+                                          format_func=RANK_METHODS.get, horizontal=True, key="export_rank_method")
+    columns = st.multiselect("Cột", available, default=default, key=f"export_columns_{source}")
+    
+    if st.button("Tạo file export", type="primary", disabled=not columns):
+        previous = st.session_state.pop('export_file', None)
+        if previous:
+            previous['file'].close()
+        with st.spinner("Đang ghi file..."):
+            f, report = export_grades(conn, fmt, source, columns, **filters)
+        name = 'student_grades' if source == 'grades' else f"ranking_{source}"
+        st.session_state['export_file'] = {
+            'file': f, 'report': report, 'mime': EXPORT_FORMATS[fmt][1],
+            'name': f"{name}_nam{academic_year}.{EXPORT_FORMATS[fmt][2]}",
+        }
+    
+    export = st.session_state.get('export_file')
+    if export:
+        report = export['report']
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Số dòng", f"{report['rows']:,}")
+        col2.metric("Kích thước", f"{report['bytes'] / 1024 ** 2:.2f} MB")
+        col3.metric("Thời gian", f"{report['seconds']:.2f} giây")
+        
+        def read_export(f=export['file']):
+            # Chỉ đọc file khi người dùng bấm tải
+            f.seek(0)
+            return f.read()
+        
+        st.download_button(f"Tải {export['name']}", read_export, export['name'], export['mime'])
+
+def describe_job(job):
+    """Tóm tắt báo cáo của một job để hiển thị"""
+    report = job['report']
+    if job['kind'] == 'import':
+        processed = sum(report.get(key, 0) for key in ('inserted', 'updated', 'unchanged'))
+        rate = processed / report['seconds'] if report.get('seconds') else 0
+        workers = job['params'].get('workers', 1)
+        speed = f"{rate:,.0f} dòng/giây" + (f", {workers} tiến trình" if workers > 1 else "")
+        return (f"{job['params'].get('name', '')}: thêm {report.get('inserted', 0):,}, "
+                f"cập nhật {report.get('updated', 0):,}, không đổi {report.get('unchanged', 0):,} ({speed}); "
+                f"bỏ qua {report.get('rejected', 0)} dòng lỗi ({report.get('invalid_scores', 0)} dòng có điểm ngoài "
+                f"{SCORE_RANGE[0]:g}-{SCORE_RANGE[1]:g} hoặc không phải số), {report.get('skipped', 0)} dòng khác học kỳ, "
+                f"{report.get('duplicates', 0)} dòng trùng trong file - mã đợt: {job['params'].get('import_batch')}")
+    if job['kind'] == 'clean':
+        if not report:
+            return ""
+        return (f"Xóa {report['removed_semester']} bản ghi trùng, {report['removed_name_conflict']} bản ghi "
+                f"MSSV nhiều tên; sửa {report['negative_fixed']} điểm âm")
+    year = job['params'].get('academic_year')
+    scope = f"năm học {year}" if year is not None else "mọi năm học"
+    return f"{scope}: đã xét {report.get('checked', 0):,}/{report.get('total', 0):,}, cập nhật {report.get('updated', 0):,}"
+
+def jobs_page(conn, academic_year=ACADEMIC_YEAR):
+    """Theo dõi, hủy và chạy tiếp các công việc nền; bảng tự làm mới khi còn job đang chạy"""
+    st.title("Công việc nền")
+
+    col1, col2 = st.columns([2, 1])
+    with col1:
+        recompute_all = st.checkbox("Tính lại cho mọi năm học", value=False)
+    with col2:
+        if st.button("Tính lại điểm TB", type="primary"):
+            params = {'academic_year': None if recompute_all else int(academic_year)}
+            job_id = start_job(conn, 'recompute', params, st.session_state.get('username'))
+            st.success(f"Đã đưa vào hàng đợi: công việc #{job_id}")
+
+    st.divider()
+    _job_executor()  # job còn dở của tiến trình trước hiện là "Bị gián đoạn"
+    active = conn.execute("SELECT 1 FROM jobs WHERE status IN ('queued', 'running') LIMIT 1").fetchone()
+
+    @st.fragment(run_every=2 if active else None)
+    def job_list():
+        # Fragment chạy lại độc lập với lượt chạy của trang -> mượn kết nối riêng
+        with pooled_connection() as fragment_conn:
+            jobs = list_jobs(fragment_conn)
+            if not jobs:
+                st.info("Chưa có công việc nào.")
+                return
+            for job in jobs:
+                with st.container(border=True):
+                    col1, col2 = st.columns([4, 1])
+                    with col1:
+                        st.markdown(f"**#{job['id']} - {JOB_KINDS[job['kind']]}** · {JOB_STATUSES[job['status']]} · "
+                                    f"{job['created_by'] or ''} {job['created_at']}")
+                        st.progress(min(max(job['progress'], 0.0), 1.0), text=describe_job(job))
+                        if job['error']:
+                            with st.expander("Chi tiết lỗi"):
+                                st.code(job['error'])
+                    with col2:
+                        if job['status'] in JOB_ACTIVE:
+                            if st.button("Hủy", key=f"job_cancel_{job['id']}",
+                                         disabled=bool(job['cancel_requested'])):
+                                cancel_job(fragment_conn, job['id'])
+                                st.rerun()
+                        elif job['status'] in JOB_RESUMABLE:
+                            if st.button("Chạy tiếp", key=f"job_resume_{job['id']}"):
+                                resume_job(fragment_conn, job['id'])
+                                st.rerun()
+                            if st.button("Bỏ", key=f"job_discard_{job['id']}",
+                                         help="Không chạy tiếp nữa và xóa file upload của job"):
+                                discard_job(fragment_conn, job['id'])
+                                st.rerun()
+
+    job_list()
 
 def manage_users(conn):
     st.title("Quản lý tài khoản")
@@ -1130,55 +3131,134 @@ def manage_users(conn):
             else:
                 st.error("Username đã tồn tại!")
 
-def show_charts(df):
+def show_charts(conn, academic_year=ACADEMIC_YEAR):
     st.title("Biểu đồ phân tích")
+    st.caption(f"Năm học {academic_year}")
     
-    if df.empty:
+    stats = get_grade_aggregates(conn, academic_year)
+    if stats is None:
         st.warning("Chưa có dữ liệu để phân tích.")
         return
     
     st.subheader("Điểm trung bình theo lớp")
-    class_avg = df.groupby('class_name')['diem_tb'].mean().reset_index()
-    fig1 = px.bar(class_avg, x='class_name', y='diem_tb', 
+    fig1 = px.bar(stats['class_avg'], x='class_name', y='diem_tb', 
                   title='Điểm TB theo lớp', color='diem_tb',
                   labels={'class_name': 'Lớp', 'diem_tb': 'Điểm TB'})
     st.plotly_chart(fig1, use_container_width=True)
     
     st.subheader("Phân bố xếp loại")
-    fig2 = px.pie(df, names='xep_loai', title='Tỷ lệ xếp loại học lực')
+    fig2 = px.pie(stats['xep_loai_counts'], values='count', names='xep_loai', title='Tỷ lệ xếp loại học lực')
     st.plotly_chart(fig2, use_container_width=True)
     
     st.subheader("Điểm trung bình các môn học")
-    subject_avg = []
-    for key, info in SUBJECTS.items():
-        if info['counts_gpa'] and key in df.columns:
-            avg = pd.to_numeric(df[key], errors='coerce').mean()
-            if pd.notna(avg):
-                subject_avg.append({'Môn': info['name'], 'Điểm TB': float(avg)})
-    
-    if subject_avg:
-        subject_df = pd.DataFrame(subject_avg)
+    subject_df = stats['subject_avg']
+    if not subject_df.empty:
         fig3 = px.line(subject_df, x='Môn', y='Điểm TB', markers=True, title='Điểm TB các môn')
         st.plotly_chart(fig3, use_container_width=True)
+    subject_stats = get_subject_stats(conn, academic_year)
+    if not subject_stats.empty:
+        with st.expander("Chi tiết theo môn và học kỳ"):
+            table = subject_stats[['subject_name', 'semester', 'n', 'mean', 'min', 'max']]
+            table.columns = ['Môn', 'Học kỳ', 'Số điểm', 'Điểm TB', 'Thấp nhất', 'Cao nhất']
+            st.dataframe(table.round(2), use_container_width=True, hide_index=True)
     
     st.subheader("So sánh theo học kỳ")
-    semester_avg = df.groupby('semester')['diem_tb'].mean().reset_index()
-    semester_avg['semester'] = semester_avg['semester'].map({1: 'Học kỳ 1', 2: 'Học kỳ 2'})
-    fig4 = px.bar(semester_avg, x='semester', y='diem_tb', 
+    fig4 = px.bar(stats['semester_avg'], x='semester', y='diem_tb', 
                   title='Điểm TB theo học kỳ', color='diem_tb')
     st.plotly_chart(fig4, use_container_width=True)
     
     st.subheader("Phân bố điểm trung bình")
-    fig5 = px.histogram(df, x='diem_tb', nbins=20, title='Phân bố điểm TB')
+    fig5 = px.bar(stats['histogram'], x='Khoảng điểm', y='Số lượng', title='Phân bố điểm TB')
     st.plotly_chart(fig5, use_container_width=True)
 
+def study_advisor_page(conn, academic_year=ACADEMIC_YEAR):
+    """Gợi ý học tập cho cả lớp / cả năm học, dành cho cố vấn học tập và thông báo hàng loạt"""
+    st.title("Gợi ý học tập theo lớp")
+    st.caption(f"Năm học {academic_year}")
+    
+    classes = list_grade_classes(conn, academic_year)
+    if not classes:
+        st.warning("Chưa có dữ liệu điểm.")
+        return
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        class_filter = st.selectbox("Lớp", ['Tất cả'] + classes, key="advisor_class")
+    with col2:
+        semester_filter = st.selectbox("Học kỳ", ['Tất cả', 1, 2], key="advisor_semester")
+    kinds = st.multiselect("Loại gợi ý", list(SUGGESTION_KINDS.keys()), default=list(SUGGESTION_KINDS.keys()),
+                           format_func=SUGGESTION_KINDS.get, key="advisor_kinds")
+    
+    suggestions = get_study_suggestions(conn, academic_year, None if class_filter == 'Tất cả' else class_filter)
+    if semester_filter != 'Tất cả':
+        suggestions = suggestions[suggestions['semester'] == semester_filter]
+    suggestions = suggestions[suggestions['kind'].isin(kinds)]
+    if suggestions.empty:
+        st.success("Không có gợi ý nào cho lựa chọn này.")
+        return
+    
+    # Số SV theo từng loại gợi ý
+    students = suggestions.groupby('kind', observed=False)['mssv'].nunique()
+    cols = st.columns(len(kinds))
+    for col, kind in zip(cols, kinds):
+        col.metric(SUGGESTION_KINDS[kind], f"{students.get(kind, 0)} SV")
+    
+    st.subheader("Theo môn học")
+    by_subject = pd.crosstab(suggestions['subject'].map(lambda key: SUBJECTS[key]['name']),
+                             suggestions['kind']).reindex(columns=kinds, fill_value=0)
+    by_subject.index.name = 'Môn'
+    by_subject.columns = [SUGGESTION_KINDS[kind] for kind in kinds]
+    st.dataframe(by_subject, use_container_width=True)
+    
+    st.subheader("Theo sinh viên")
+    summary = summarize_study_suggestions(suggestions)
+    display_df = summary[['mssv', 'student_name', 'class_name', 'semester'] + kinds]
+    display_df.columns = ['MSSV', 'Họ tên', 'Lớp', 'Học kỳ'] + [SUGGESTION_KINDS[kind] for kind in kinds]
+    st.dataframe(display_df, use_container_width=True, hide_index=True)
+    name = 'tat_ca' if class_filter == 'Tất cả' else class_filter
+    st.download_button("Tải danh sách (CSV)", display_df.to_csv(index=False).encode('utf-8-sig'),
+                       f"goi_y_hoc_tap_{name}_nam{academic_year}.csv", "text/csv")
+
+def eligibility_page(conn, academic_year=ACADEMIC_YEAR):
+    """Danh sách SV chưa đủ điều kiện học HK2 / còn môn HK2 bị chặn bởi môn tiên quyết"""
+    st.title("Điều kiện học kỳ 2")
+    st.caption(f"Năm học {academic_year} - điều kiện: ĐTB "
+               + " + ".join(SUBJECTS[key]['name'] for key in COURSE_GRAPH['semester_2_gate'])
+               + f" >= {PASS_SCORE:g}; môn HK2 cần đạt môn tiên quyết")
+    
+    classes = list_grade_classes(conn, academic_year)
+    class_filter = st.selectbox("Lớp", ['Tất cả'] + classes, key="eligibility_class")
+    result = get_semester_2_eligibility(conn, academic_year, None if class_filter == 'Tất cả' else class_filter)
+    if result.empty:
+        st.warning("Chưa có điểm học kỳ 1.")
+        return
+    
+    not_eligible = result[~result['eligible_sem2']]
+    partly_blocked = result[result['eligible_sem2'] & (result['blocked_subjects'] != '')]
+    col1, col2, col3 = st.columns(3)
+    col1.metric("SV có điểm HK1", len(result))
+    col2.metric("Chưa đủ điều kiện HK2", len(not_eligible))
+    col3.metric("Đủ điều kiện, còn môn bị chặn", len(partly_blocked))
+    
+    show_all = st.checkbox("Hiện cả SV đủ điều kiện nhưng còn môn bị chặn", key="eligibility_partly")
+    report = pd.concat([not_eligible, partly_blocked]) if show_all else not_eligible
+    if report.empty:
+        st.success("Tất cả sinh viên đều đủ điều kiện học kỳ 2.")
+        return
+    display_df = report[['mssv', 'student_name', 'class_name', 'gate_avg', 'eligible_sem2', 'reason',
+                         'blocked_subjects']].copy()
+    display_df['gate_avg'] = display_df['gate_avg'].round(2)
+    display_df.columns = ['MSSV', 'Họ tên', 'Lớp', 'ĐTB môn điều kiện', 'Đủ điều kiện', 'Lý do', 'Môn HK2 bị chặn']
+    st.dataframe(display_df, use_container_width=True, hide_index=True)
+    st.download_button("Tải danh sách (CSV)", display_df.to_csv(index=False).encode('utf-8-sig'),
+                       f"dieu_kien_hk2_nam{academic_year}.csv", "text/csv")
+
 def student_dashboard(conn):
     st.sidebar.title(f"{st.session_state.get('fullname','')}")
     st.sidebar.write("Vai trò: **Học sinh**")
     
     if st.sidebar.button("Đăng xuất"):
-        for key in list(st.session_state.keys()):
-            del st.session_state[key]
+        logout(conn)
         st.rerun()
     
     # Đổi thứ tự menu: Tra cứu điểm lên trước Xếp hạng theo GPA
@@ -1189,17 +3269,17 @@ def student_dashboard(conn):
         "Thống kê chung"
     ])
     
-    df = load_grades(conn)
+    academic_year = select_academic_year(conn)
     student_id = st.session_state.get('student_id', '')
     
     if menu == "Bảng điểm của tôi":
         st.title("Bảng điểm của tôi")
-        my_grades = df[df['mssv'] == student_id]
+        my_grades = get_student_grades(conn, student_id)
         
         if not my_grades.empty:
             for _, row in my_grades.iterrows():
                 semester = int(row.get('semester', 1))
-                st.subheader(f"Học kỳ {semester}")
+                st.subheader(f"Năm học {int(row['academic_year'])} - Học kỳ {semester}")
                 
                 current_subjects = SEMESTER_1_SUBJECTS if semester == 1 else SEMESTER_2_SUBJECTS
                 cols = st.columns(5)
@@ -1226,70 +3306,68 @@ def student_dashboard(conn):
         st.title("Tra cứu điểm sinh viên")
         search_term = st.text_input("Nhập MSSV hoặc tên sinh viên")
         if search_term:
-            results = df[df['mssv'].str.contains(search_term, case=False, na=False) | 
-                        df['student_name'].str.contains(search_term, case=False, na=False)]
+            results = search_grades(conn, search_term)
             if not results.empty:
-                st.dataframe(results[['mssv', 'student_name', 'class_name', 'semester', 'diem_tb', 'xep_loai']], 
+                st.dataframe(results[['mssv', 'student_name', 'class_name', 'academic_year', 'semester',
+                                      'diem_tb', 'xep_loai']], 
                            use_container_width=True)
             else:
                 st.info("Không tìm thấy kết quả.")
     
     elif menu == "Xếp hạng theo GPA":
-        show_ranking(df)
+        show_ranking(conn, academic_year)
         
         # Hiển thị vị trí của sinh viên hiện tại
         if student_id:
             st.divider()
             st.subheader("Vị trí của bạn")
             
-            for sem_name, sem_val in [("Học kỳ 1", 1), ("Học kỳ 2", 2), ("Tổng hợp", 'all')]:
-                ranking_df = get_ranking_by_semester(df, semester=sem_val)
-                if not ranking_df.empty:
-                    student_rank = ranking_df[ranking_df['mssv'] == student_id]
-                    
-                    if not student_rank.empty:
-                        rank = student_rank['xep_hang'].values[0]
-                        total = len(ranking_df)
-                        gpa = student_rank['diem_tb'].values[0]
-                        st.info(f"**{sem_name}:** Xếp hạng **{rank}/{total}** - Điểm TB: **{gpa:.2f}**")
-                    else:
-                        if sem_val == 'all':
-                            st.warning(f"**{sem_name}:** Bạn chưa hoàn thành đủ 2 học kỳ")
-                        else:
-                            st.warning(f"**{sem_name}:** Chưa có điểm")
+            rank_method = st.session_state.get('rank_method', 'first')
+            positions = get_student_positions(conn, student_id, academic_year, rank_method)
+            for sem_name, sem_val in [("Học kỳ 1", '1'), ("Học kỳ 2", '2'), ("Tổng hợp", 'all'), ("Tích lũy", 'cum')]:
+                position = positions.get(sem_val)
+                if position:
+                    rank, total, gpa = position
+                    st.info(f"**{sem_name}:** Xếp hạng **{rank}/{total}** - Điểm TB: **{gpa:.2f}**")
+                elif sem_val == 'all':
+                    st.warning(f"**{sem_name}:** Bạn chưa hoàn thành đủ 2 học kỳ")
+                else:
+                    st.warning(f"**{sem_name}:** Chưa có điểm")
     
     elif menu == "Thống kê chung":
         st.title("Thống kê chung")
-        if not df.empty:
+        stats = get_grade_aggregates(conn, academic_year)
+        if stats is not None:
+            overview = stats['overview']
             col1, col2, col3, col4 = st.columns(4)
             with col1:
-                st.metric("Tổng SV", df['mssv'].nunique())
+                st.metric("Tổng SV", overview['students'])
             with col2:
-                st.metric("Điểm TB", f"{df['diem_tb'].mean():.2f}")
+                st.metric("Điểm TB", f"{overview['mean']:.2f}")
             with col3:
-                excellent_rate = (df['xep_loai'].isin(['Giỏi', 'Xuất sắc'])).sum() / len(df) * 100
-                st.metric("Tỷ lệ Giỏi/Xuất sắc", f"{excellent_rate:.1f}%")
+                st.metric("Tỷ lệ Giỏi/Xuất sắc", f"{overview['excellent_rate']:.1f}%")
             with col4:
-                st.metric("Số lớp", df['class_name'].nunique())
+                st.metric("Số lớp", overview['classes'])
             
-            fig = px.pie(df, names='xep_loai', title='Phân bố xếp loại')
+            fig = px.pie(stats['xep_loai_counts'], values='count', names='xep_loai', title='Phân bố xếp loại')
             st.plotly_chart(fig, use_container_width=True)
 # ======================== MAIN ========================
 def main():
     st.set_page_config(page_title="Quản lý điểm sinh viên", page_icon="logotl.jpg", layout="wide")
 
-    conn = init_db()
-    
-    if 'logged_in' not in st.session_state:
-        st.session_state['logged_in'] = False
-    
-    if not st.session_state['logged_in']:
-        login_page(conn)
-    else:
-        if st.session_state['role'] == 'teacher':
-            teacher_dashboard(conn)
+    with pooled_connection() as conn:
+        if 'logged_in' not in st.session_state:
+            restore_session(conn)
+        if 'session_cookie' in st.session_state:
+            set_session_cookie(st.session_state.pop('session_cookie'))
+        
+        if not st.session_state['logged_in']:
+            login_page(conn)
         else:
-            student_dashboard(conn)
+            if st.session_state['role'] == 'teacher':
+                teacher_dashboard(conn)
+            else:
+                student_dashboard(conn)
 
 if __name__ == "__main__":
     main()
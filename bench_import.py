@@ -0,0 +1,97 @@
+# bench_import.py - Đo tốc độ import (dòng/giây) theo số tiến trình tính điểm trên file CSV tổng hợp
+#
+#   python bench_import.py                       # 1.000.000 dòng, workers = 1, 2, 4, ... tới số lõi
+#   python bench_import.py --rows 200000 --workers 1,2 --no-db
+#
+# Mỗi số workers được đo 2 giai đoạn:
+#   - prepare: đọc CSV theo khối + chuẩn hóa + tính điểm (phần chạy song song), không ghi DB
+#   - import : toàn bộ import_grades_chunks vào một DB SQLite mới (một tiến trình ghi duy nhất)
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import app1  # noqa: E402
+
+
+def make_synthetic_csv(path, rows, seed=1):
+    """Sinh file CSV giống file import thật: mỗi SV 2 dòng (HK1, HK2), ~5% ô điểm trống, ~1% điểm âm"""
+    rng = np.random.default_rng(seed)
+    students = (rows + 1) // 2
+    index = np.arange(rows)
+    mssv = np.char.add('SV', (index // 2).astype(str))
+    semester = index % 2 + 1
+    frame = pd.DataFrame({
+        'mssv': mssv,
+        'student_name': np.char.add('Sinh viên ', (index // 2).astype(str)),
+        'class_name': np.char.add('L', (index // 2 % max(students // 40, 1)).astype(str)),
+        'semester': semester,
+    })
+    for key in app1.SUBJECTS:
+        scores = np.round(rng.uniform(0, 10, rows), 1)
+        scores[rng.random(rows) < 0.01] = -1
+        in_semester = semester == (1 if key in app1.SEMESTER_1_SUBJECTS else 2)
+        frame[key] = np.where(in_semester & (rng.random(rows) > 0.05), scores, np.nan)
+    frame.to_csv(path, index=False)
+    return os.path.getsize(path)
+
+
+def bench_prepare(path, workers):
+    started = time.perf_counter()
+    rows = 0
+    with open(path, 'rb') as f:
+        for frame, *_ in app1.prepare_import_chunks(app1.iter_upload_chunks(f), workers=workers):
+            rows += len(frame)
+    return rows, time.perf_counter() - started
+
+
+def bench_import(path, workers, directory):
+    conn = app1.init_db(os.path.join(directory, f"bench_{workers}.db"))
+    conn.execute(f"PRAGMA cache_size = -{app1.IMPORT_CACHE_KIB}")  # như kết nối của job import
+    try:
+        with open(path, 'rb') as f:
+            report = app1.import_grades_chunks(conn, app1.iter_upload_chunks(f), workers=workers)
+    finally:
+        conn.close()
+    return report['inserted'], report['seconds']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Đo tốc độ import theo số tiến trình")
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--workers', default=None, help="Danh sách số tiến trình, ví dụ 1,2,4 (mặc định tới số lõi)")
+    parser.add_argument('--no-db', action='store_true', help="Chỉ đo giai đoạn prepare")
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    if args.workers:
+        worker_counts = [int(w) for w in args.workers.split(',')]
+    else:
+        worker_counts = sorted({1, *[2 ** i for i in range(1, cores.bit_length()) if 2 ** i <= cores], cores})
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'synthetic.csv')
+        started = time.perf_counter()
+        size = make_synthetic_csv(path, args.rows)
+        print(f"{args.rows:,} dòng, {size / 1024 ** 2:.1f} MB (sinh trong {time.perf_counter() - started:.1f}s), "
+              f"{cores} lõi, khối {app1.IMPORT_CHUNK_ROWS:,} dòng")
+        print(f"{'workers':>7} | {'stage':<7} | {'giây':>8} | {'dòng/giây':>11} | {'tăng tốc':>8}")
+        baseline = {}
+        for workers in worker_counts:
+            stages = [('prepare', lambda w=workers: bench_prepare(path, w))]
+            if not args.no_db:
+                stages.append(('import', lambda w=workers: bench_import(path, w, directory)))
+            for stage, run in stages:
+                rows, seconds = run()
+                rate = rows / seconds if seconds > 0 else float(rows)
+                baseline.setdefault(stage, rate)
+                print(f"{workers:>7} | {stage:<7} | {seconds:>8.2f} | {rate:>11,.0f} | {rate / baseline[stage]:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
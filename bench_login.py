@@ -0,0 +1,103 @@
+# bench_login.py - Đo thời gian đăng nhập (p50/p95/max) khi nhiều người đăng nhập cùng lúc
+#
+#   python bench_login.py                              # 50 lượt đồng thời, AUTH_WORKERS = 1, 2, 4, ... tới số lõi
+#   python bench_login.py --concurrency 100 --workers 2,4 --rounds 10
+#
+# Mỗi số AUTH_WORKERS được đo 2 trường hợp trên một DB mới:
+#   - bcrypt: tài khoản đã có hash bcrypt
+#   - legacy: tài khoản còn hash SHA-256 cũ (kiểm tra + băm lại bằng bcrypt trong lần đăng nhập này)
+# Cuối cùng đo thời gian khôi phục phiên từ token (tải lại trang: kiểm tra chữ ký + tra bảng thu hồi).
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import app1  # noqa: E402
+
+PASSWORD = 'matkhau-bench'
+
+
+def make_users(db_path, count, legacy):
+    """Tạo DB mới với count tài khoản sinh viên cùng một mật khẩu (băm một lần, dùng chung cho mọi dòng)"""
+    conn = app1.init_db(db_path)
+    stored = app1._legacy_hash(PASSWORD) if legacy else app1.hash_password(PASSWORD)
+    conn.executemany("INSERT INTO users (username, password, fullname, role, student_id) VALUES (?, ?, ?, ?, ?)",
+                     [(f"sv{i}", stored, f"Sinh viên {i}", 'student', f"SV{i}") for i in range(count)])
+    conn.commit()
+    conn.close()
+
+
+def bench_logins(db_path, concurrency):
+    """concurrency lượt đăng nhập bắt đầu cùng lúc, mỗi lượt một kết nối riêng như một session Streamlit.
+    Trả về (mảng thời gian từng lượt, tổng thời gian)"""
+    connections = [app1._connect(db_path) for _ in range(concurrency)]
+    start = threading.Barrier(concurrency)
+
+    def login(i):
+        start.wait()
+        started = time.perf_counter()
+        user = app1.verify_user(connections[i], f"sv{i}", PASSWORD)
+        assert user is not None and user[1] == f"sv{i}"
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies = np.array(list(pool.map(login, range(concurrency))))
+    finally:
+        for conn in connections:
+            conn.close()
+    return latencies, time.perf_counter() - started
+
+
+def bench_token(db_path, count=10000):
+    """Thời gian kiểm tra chữ ký + tra bảng thu hồi của một token (không băm mật khẩu)"""
+    fields = {'username': 'sv0', 'user_id': 1, 'fullname': 'Sinh viên 0', 'role': 'student', 'student_id': 'SV0'}
+    token = app1.issue_session_token(fields)
+    conn = app1._connect(db_path)
+    try:
+        started = time.perf_counter()
+        for _ in range(count):
+            assert app1.resolve_session_token(conn, token) == fields
+        return (time.perf_counter() - started) / count
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Đo thời gian đăng nhập đồng thời")
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--workers', default=None, help="Danh sách AUTH_WORKERS, ví dụ 1,2,4 (mặc định tới số lõi)")
+    parser.add_argument('--rounds', type=int, default=app1.BCRYPT_ROUNDS, help="Số vòng bcrypt (log2)")
+    args = parser.parse_args()
+
+    app1.BCRYPT_ROUNDS = args.rounds
+    cores = os.cpu_count() or 1
+    if args.workers:
+        worker_counts = [int(w) for w in args.workers.split(',')]
+    else:
+        worker_counts = sorted({1, *[2 ** i for i in range(1, cores.bit_length()) if 2 ** i <= cores], cores})
+
+    print(f"{args.concurrency} lượt đăng nhập đồng thời, bcrypt {args.rounds} vòng, {cores} lõi")
+    print(f"{'workers':>7} | {'hash':<6} | {'p50 (s)':>8} | {'p95 (s)':>8} | {'max (s)':>8} | {'lượt/giây':>9}")
+    with tempfile.TemporaryDirectory() as directory:
+        for workers in worker_counts:
+            app1.AUTH_WORKERS = workers
+            for case in ('bcrypt', 'legacy'):
+                db_path = os.path.join(directory, f"login_{workers}_{case}.db")
+                make_users(db_path, args.concurrency, legacy=case == 'legacy')
+                latencies, seconds = bench_logins(db_path, args.concurrency)
+                p50, p95 = np.percentile(latencies, [50, 95])
+                print(f"{workers:>7} | {case:<6} | {p50:>8.3f} | {p95:>8.3f} | {latencies.max():>8.3f} | "
+                      f"{args.concurrency / seconds:>9.1f}")
+        print(f"Khôi phục phiên từ token: {bench_token(db_path) * 1e6:.1f} µs/lần")
+
+
+if __name__ == '__main__':
+    main()
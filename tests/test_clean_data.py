@@ -0,0 +1,61 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app1  # noqa: E402
+
+# id theo thứ tự ghi: (mssv, họ tên, năm học, học kỳ, triết, giải tích 1)
+ROWS = [
+    ('SV1', 'An', 1, 1, 8.0, 7.0),      # 1
+    ('SV1', 'An', 1, 1, -1.0, 7.0),     # 2: trùng SV1 năm 1 kỳ 1 -> xóa (ô âm của dòng bị xóa không tính)
+    ('SV1', 'An', 1, 2, -2.0, 6.0),     # 3: ô triết âm -> NULL, điểm TB tính lại (chỉ còn giải tích 1)
+    ('SV2', 'Bình', 1, 1, 5.0, 5.0),    # 4
+    ('SV2', 'Bình', 1, 2, 6.0, 6.0),    # 5
+    ('SV2', 'Binh', 2, 1, 7.0, 7.0),    # 6: tên khác tên xuất hiện nhiều nhất của SV2 -> xóa
+]
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = app1.init_db(str(tmp_path / 'clean.db'))
+    # DB cũ: chưa có UNIQUE(mssv, academic_year, semester) nên còn bản ghi trùng
+    conn.execute("DROP INDEX idx_grades_term")
+    frame = pd.DataFrame(ROWS, columns=['mssv', 'student_name', 'academic_year', 'semester', 'triet', 'giai_tich_1'])
+    frame['class_name'] = 'A1'
+    frame['diem_tb'], frame['xep_loai'] = app1.score_grades(frame.reindex(columns=list(app1.SUBJECTS)))
+    app1.insert_grades(conn, frame.reindex(columns=app1.GRADE_COLUMNS))
+    app1.refresh_rankings(conn)
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def snapshot(conn):
+    return {table: conn.execute(f"SELECT * FROM {table} ORDER BY 1, 2, 3").fetchall()
+            for table in ('grades', 'scores', 'grade_stats', 'rankings')}
+
+
+def test_dry_run_plans_without_writing(conn):
+    before, changes = snapshot(conn), conn.total_changes
+    plan = app1.clean_data(conn, dry_run=True)
+    assert plan['duplicate_ids'] == [2]
+    assert plan['name_conflict_ids'] == [6]
+    assert plan['null_cells'] == {'triet': [3]}
+    assert plan['rescored']['id'].tolist() == [3]
+    assert plan['rescored']['diem_tb'].tolist() == [6.0]
+    assert (plan['removed_semester'], plan['removed_name_conflict'], plan['negative_fixed']) == (1, 1, 1)
+    assert conn.total_changes == changes
+    assert not conn.in_transaction
+    assert snapshot(conn) == before
+
+
+def test_apply_follows_plan(conn):
+    plan = app1.clean_data(conn)
+    assert [r[0] for r in conn.execute("SELECT id FROM grades ORDER BY id")] == [1, 3, 4, 5]
+    assert conn.execute("SELECT diem_tb FROM grades WHERE id = 3").fetchone()[0] == 6.0
+    assert conn.execute("SELECT COUNT(*) FROM scores WHERE score < 0").fetchone()[0] == 0
+    assert app1.clean_data(conn, dry_run=True)['negative_fixed'] == 0
+    assert plan['negative_fixed'] == 1
@@ -0,0 +1,65 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app1  # noqa: E402
+
+
+def old_rule(row):
+    """Luật cũ của can_take_semester_2: ĐTB(giải tích 1, tiếng Ấn Độ 1) >= 4; ô trống (NaN) làm ĐTB thành NaN"""
+    try:
+        giai_tich_1 = float(row.get('giai_tich_1') or 0)
+    except Exception:
+        giai_tich_1 = 0
+    try:
+        tieng_an_do_1 = float(row.get('tieng_an_do_1') or 0)
+    except Exception:
+        tieng_an_do_1 = 0
+    return (giai_tich_1 + tieng_an_do_1) / 2.0 >= 4
+
+
+def semester_1(count, seed):
+    """Bản ghi HK1 ngẫu nhiên gồm cả điểm âm, điểm 0, ô trống và các giá trị sát ngưỡng"""
+    rng = np.random.default_rng(seed)
+    scores = rng.choice([np.nan, -1.0, 0.0, 3.5, 3.9, 4.0, 4.1, 4.5, 7.0, 10.0], size=(count, len(app1.SUBJECTS)))
+    df = pd.DataFrame(scores, columns=list(app1.SUBJECTS))
+    df.insert(0, 'mssv', [f"SV{i:04d}" for i in range(count)])
+    return df
+
+
+def test_gate_is_the_old_pair():
+    assert sorted(app1.COURSE_GRAPH['semester_2_gate']) == ['giai_tich_1', 'tieng_an_do_1']
+
+
+def test_bulk_matches_old_rule():
+    sem1 = semester_1(3000, seed=5)
+    result = app1.evaluate_eligibility(sem1)
+    assert result['eligible_sem2'].any() and not result['eligible_sem2'].all()
+    assert result['eligible_sem2'].tolist() == [old_rule(row) for _, row in sem1.iterrows()]
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = app1.init_db(str(tmp_path / 'eligibility.db'))
+    sem1 = semester_1(200, seed=8)
+    sem1['student_name'] = 'SV'
+    sem1['semester'] = 1
+    sem1['academic_year'] = 1
+    sem1['diem_tb'], sem1['xep_loai'] = app1.score_grades(sem1)
+    app1.insert_grades(conn, sem1.reindex(columns=app1.GRADE_COLUMNS))
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def test_report_and_lookup_match_old_rule(conn):
+    report = app1.load_semester_2_eligibility(conn, academic_year=1).set_index('mssv')['eligible_sem2']
+    assert len(report) == 200 and report.any() and not report.all()
+    for mssv, eligible in report.items():
+        assert eligible == old_rule(app1.get_student_sem1(conn, mssv, 1))
+        assert app1.can_take_semester_2(conn, mssv, 1)[0] == eligible
+    assert app1.can_take_semester_2(conn, 'SV9999', 1) == (False, "Chưa có điểm học kỳ 1")
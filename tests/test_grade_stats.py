@@ -0,0 +1,85 @@
+import io
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app1  # noqa: E402
+
+
+def upload(students, years, seed):
+    """File import (đọc lại từ CSV như khi upload) nhiều năm, có ô trống"""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for year in range(1, years + 1):
+        for semester in (1, 2):
+            df = pd.DataFrame({'mssv': [f"SV{i:03d}" for i in range(students)],
+                               'student_name': [f"Sinh viên {i}" for i in range(students)],
+                               'class_name': rng.choice(['A1', 'A2', 'B1'], students),
+                               'semester': semester, 'academic_year': year})
+            for key in app1.SUBJECTS:
+                df[key] = np.where(rng.random(students) < 0.2, np.nan, np.round(rng.uniform(0, 10, students), 1))
+            frames.append(df)
+    text = pd.concat(frames, ignore_index=True).to_csv(index=False)
+    return pd.read_csv(io.StringIO(text), dtype=app1.IMPORT_TEXT_DTYPES)
+
+
+def stats_rows(conn):
+    return pd.read_sql_query("SELECT * FROM grade_stats ORDER BY academic_year, dim, bucket", conn)
+
+
+def assert_matches_rebuild(conn):
+    incremental = stats_rows(conn)
+    app1.rebuild_grade_stats(conn)
+    rebuilt = stats_rows(conn)
+    conn.rollback()
+    # Tổng cộng dồn theo thứ tự khác nhau chỉ lệch ở sai số làm tròn của phép cộng số thực
+    pd.testing.assert_frame_equal(incremental.drop(columns='total'), rebuilt.drop(columns='total'))
+    np.testing.assert_allclose(incremental['total'], rebuilt['total'], rtol=1e-9)
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = app1.init_db(str(tmp_path / 'stats.db'))
+    app1.import_grades_chunks(conn, [(upload(60, 2, seed=1), 1.0)])
+    yield conn
+    conn.close()
+
+
+def test_import_matches_rebuild(conn):
+    assert_matches_rebuild(conn)
+    # Import lại với một phần dòng đổi điểm: cập nhật theo upsert
+    corrected = upload(60, 2, seed=1)
+    corrected.loc[::7, 'giai_tich_1'] = 9.9
+    report = app1.import_grades_chunks(conn, [(corrected, 1.0)], mode='upsert')
+    assert report['updated'] > 0
+    assert_matches_rebuild(conn)
+
+
+def test_save_and_delete_match_rebuild(conn):
+    row = app1._query_grades(conn, "WHERE id = 1").iloc[0]
+    record = {**row.to_dict(), 'mssv': 'SV999', 'diem_tb': 10.0, 'xep_loai': 'Xuất sắc'}
+    assert app1.save_grade(conn, tuple(record[col] for col in app1.GRADE_COLUMNS))[0]
+    assert_matches_rebuild(conn)
+    # Xóa đúng dòng đang giữ điểm TB cao nhất: biên max phải được tính lại
+    top = conn.execute("SELECT id FROM grades WHERE academic_year = 1 ORDER BY diem_tb DESC LIMIT 1").fetchone()[0]
+    app1.delete_grade(conn, top)
+    assert_matches_rebuild(conn)
+    app1.delete_grades_batch(conn, [r[0] for r in conn.execute("SELECT id FROM grades WHERE mssv < 'SV010'")])
+    assert_matches_rebuild(conn)
+
+
+def test_delete_where_and_clean_match_rebuild(conn):
+    assert app1.delete_grades_where(conn, academic_year=2, class_name='A1') > 0
+    assert_matches_rebuild(conn)
+    assert app1.delete_grades_where(conn, semester=1, academic_year=1) > 0
+    assert_matches_rebuild(conn)
+    # Điểm âm chỉ còn trong DB cũ (import nay loại dòng có điểm ngoài 0-10): ghi thẳng rồi dựng lại thống kê
+    conn.execute("UPDATE scores SET score = -1 WHERE subject_key = 'triet' AND grade_id % 5 = 0")
+    app1.rebuild_grade_stats(conn)
+    conn.commit()
+    assert app1.clean_data(conn)['negative_fixed'] > 0
+    assert_matches_rebuild(conn)
@@ -0,0 +1,49 @@
+import io
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app1  # noqa: E402
+
+OLD_TIMESTAMP = '2000-01-01 00:00:00'
+
+
+def grade_file(count, seed):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({'mssv': [f"SV{i:03d}" for i in range(count)],
+                       'student_name': [f"Sinh viên {i}" for i in range(count)],
+                       'class_name': 'A1', 'semester': 1})
+    for key in app1.SUBJECTS:
+        df[key] = np.round(rng.uniform(0, 10, count), 1)
+    return df
+
+
+def upload(df):
+    return pd.read_csv(io.StringIO(df.to_csv(index=False)), dtype=app1.IMPORT_TEXT_DTYPES)
+
+
+def test_reimport_updates_only_corrected_rows(tmp_path):
+    conn = app1.init_db(str(tmp_path / 'upsert.db'))
+    original = grade_file(40, seed=2)
+    assert app1.import_grades_chunks(conn, [(upload(original), 1.0)])['inserted'] == 40
+    # Mốc thời gian cũ để thấy rõ dòng nào bị ghi lại
+    conn.execute("UPDATE grades SET updated_at = ?", (OLD_TIMESTAMP,))
+    conn.commit()
+
+    corrected = original.copy()
+    rows = [3, 11, 12, 30]
+    corrected.loc[rows[:3], 'triet'] = 10.0
+    corrected.loc[rows[3], 'student_name'] = 'Tên đã sửa'
+    report = app1.import_grades_chunks(conn, [(upload(corrected), 1.0)], mode='upsert')
+    assert (report['inserted'], report['updated'], report['unchanged']) == (0, len(rows), 40 - len(rows))
+
+    updated_at = dict(conn.execute("SELECT mssv, updated_at FROM grades"))
+    changed = {mssv for mssv, stamp in updated_at.items() if stamp != OLD_TIMESTAMP}
+    assert changed == set(original.loc[rows, 'mssv'])
+    assert conn.execute("SELECT COUNT(*) FROM grades").fetchone()[0] == 40
+    assert conn.execute("SELECT score FROM scores s JOIN grades g ON g.id = s.grade_id "
+                        "WHERE g.mssv = 'SV003' AND s.subject_key = 'triet'").fetchone()[0] == 10.0
+    conn.close()
@@ -0,0 +1,44 @@
+import io
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app1  # noqa: E402
+
+
+def upload(text):
+    """Khối đọc từ CSV như khi import (cột chữ giữ nguyên kiểu str)"""
+    return pd.read_csv(io.StringIO(text), dtype=app1.IMPORT_TEXT_DTYPES)
+
+
+def test_rejects_out_of_range_and_unparseable_scores():
+    df = upload("mssv,student_name,class_name,semester,triet,giai_tich_1\n"
+                "SV1,An,A1,1,8,9\n"        # hợp lệ
+                "SV2,Bình,A1,1,85,9\n"     # điểm > 10
+                "SV3,Chi,A1,1,abc,9\n"     # không phải số
+                "SV4,Dũng,A1,1,-1,9\n"     # điểm âm
+                "SV5,Em,A1,1,10,0\n"       # biên của khoảng hợp lệ
+                "SV6,Giang,A1,1, ,7\n"     # ô trống = chưa có điểm
+                ",Không mã,A1,1,5,5\n")    # thiếu MSSV
+    frame, rejected, skipped, invalid_scores = app1.prepare_import_frame(df)
+    assert frame['mssv'].tolist() == ['SV1', 'SV5', 'SV6']
+    assert rejected == 4
+    assert invalid_scores == 3
+    assert skipped == 0
+    scores = frame[list(app1.SUBJECTS)].stack().dropna()
+    assert scores.between(*app1.SCORE_RANGE).all()
+    assert frame['diem_tb'].tolist() == [8.5, 5.0, 7.0]
+
+
+def test_import_report_counts_invalid_scores(tmp_path):
+    conn = app1.init_db(str(tmp_path / 'import.db'))
+    text = ("mssv,student_name,class_name,semester,triet\n"
+            "SV1,An,A1,1,8\n"
+            "SV2,Bình,A1,1,85\n"
+            "SV3,Chi,A1,1,x\n")
+    report = app1.import_grades_chunks(conn, [(upload(text), 1.0)])
+    assert (report['inserted'], report['rejected'], report['invalid_scores']) == (1, 2, 2)
+    assert conn.execute("SELECT MAX(score) FROM scores").fetchone()[0] == 8.0
+    conn.close()
@@ -0,0 +1,146 @@
+import io
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app1  # noqa: E402
+
+
+def random_grades(students, years, seed):
+    """Bảng điểm nhiều năm, điểm làm tròn 0.5 để có nhiều dòng đồng điểm; khoảng 15% (SV, kỳ) không có điểm"""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for year in range(1, years + 1):
+        for semester in (1, 2):
+            df = pd.DataFrame({'mssv': [f"SV{i:03d}" for i in range(students)],
+                               'student_name': [f"Sinh viên {i}" for i in range(students)],
+                               'class_name': rng.choice(['A1', 'A2'], students),
+                               'semester': semester, 'academic_year': year, 'cohort': 'K1'})
+            for key in app1.SUBJECTS:
+                df[key] = np.round(rng.uniform(4, 10, students) * 2) / 2
+            frames.append(df[rng.random(students) > 0.15])
+    df = pd.concat(frames, ignore_index=True)
+    df['diem_tb'], df['xep_loai'] = app1.score_grades(df)
+    return df.reindex(columns=app1.GRADE_COLUMNS)
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = app1.init_db(str(tmp_path / 'rankings.db'))
+    app1.insert_grades(conn, random_grades(40, 3, seed=6))
+    app1.refresh_rankings(conn)
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def ranking_rows(conn):
+    return sorted(conn.execute("SELECT * FROM rankings").fetchall())
+
+
+def assert_matches_rebuild(conn):
+    incremental = ranking_rows(conn)
+    app1.refresh_rankings(conn)
+    assert incremental == ranking_rows(conn)
+    conn.rollback()
+
+
+def reference_positions(conn, academic_year, scope):
+    """Hạng tính bằng window function trên cả phạm vi"""
+    rows = conn.execute(f'''SELECT mssv, grade_id, {", ".join(app1.RANK_WINDOWS[m] for m in app1.RANK_METHODS)}
+                            FROM rankings WHERE academic_year = ? AND scope = ?''', (academic_year, scope))
+    return {(mssv, grade_id): dict(zip(app1.RANK_METHODS, ranks)) for mssv, grade_id, *ranks in rows}
+
+
+@pytest.mark.parametrize('scope', app1.RANKING_SCOPES)
+def test_positions_match_window_functions(conn, scope):
+    expected = reference_positions(conn, 2, scope)
+    entries = conn.execute("SELECT diem_tb, grade_id, mssv FROM rankings WHERE academic_year = 2 AND scope = ?",
+                           (scope,)).fetchall()
+    positions = app1.ranking_positions(conn, 2, scope, entries)
+    assert {(mssv, grade_id): p for (_, grade_id, mssv), p in zip(entries, positions)} == expected
+
+
+def test_ranking_pages_follow_ranking_order(conn):
+    expected = reference_positions(conn, 3, 'cum')
+    page_df, total = app1.query_ranking_page(conn, 'cum', 3, 'min', page=2, page_size=7)
+    ranks = sorted(p['min'] for p in expected.values())
+    assert total == len(expected)
+    assert page_df['xep_hang'].tolist() == ranks[7:14]
+    filtered, _ = app1.query_ranking_page(conn, 'cum', 3, 'dense', xep_loai='Khá')
+    assert filtered['xep_hang'].tolist() == [expected[(mssv, 0)]['dense'] for mssv in filtered['mssv']]
+
+
+def test_student_positions(conn):
+    positions = app1.get_student_positions(conn, 'SV007', 2, 'dense')
+    for scope, (rank, total, _) in positions.items():
+        expected = reference_positions(conn, 2, scope)
+        grade_id = 0 if scope in ('all', 'cum') else conn.execute(
+            "SELECT id FROM grades WHERE mssv = 'SV007' AND academic_year = 2 AND semester = ?", (int(scope),)).fetchone()[0]
+        assert (rank, total) == (expected[('SV007', grade_id)]['dense'], len(expected))
+
+
+def test_save_and_delete_match_rebuild(conn):
+    record = random_grades(1, 1, seed=9).iloc[0].to_dict()
+    record.update(mssv='SV100', academic_year=1, semester=2)
+    ok, error = app1.save_grade(conn, tuple(record[col] for col in app1.GRADE_COLUMNS))
+    assert ok, error
+    assert_matches_rebuild(conn)
+    # Xóa một kỳ của năm đầu: hạng tích lũy của SV ở mọi năm sau đều đổi
+    grade_id = conn.execute("SELECT id FROM grades WHERE mssv = 'SV003' AND academic_year = 1").fetchone()[0]
+    app1.delete_grade(conn, grade_id)
+    assert_matches_rebuild(conn)
+
+
+def test_import_job_rankings_follow_each_chunk(tmp_path, monkeypatch):
+    db_path = str(tmp_path / 'job.db')
+    conn = app1.init_db(db_path)
+    path = tmp_path / 'upload.csv'
+    grades = random_grades(1500, 3, seed=3)
+    grades.to_csv(path, index=False)
+    assert len(grades) > app1.IMPORT_CHUNK_ROWS
+    job_id = app1.create_job(conn, 'import', {'path': str(path), 'option': 'Cả hai kỳ', 'mode': 'append',
+                                              'academic_year': 1, 'import_batch': 'job'})
+    committed = []
+
+    def cancel_after_first_chunk(job_conn, job_id):
+        # Giữa hai khối: khối đầu đã commit phải kèm đúng xếp hạng của nó
+        if committed:
+            assert conn.execute("SELECT COUNT(*) FROM grades").fetchone()[0] == app1.IMPORT_CHUNK_ROWS
+            assert_matches_rebuild(conn)
+        committed.append(job_id)
+        return len(committed) > 1
+
+    monkeypatch.setattr(app1, '_job_cancel_requested', cancel_after_first_chunk)
+    app1.run_job(job_id, db_path)
+    assert app1.get_job(conn, job_id)['status'] == 'cancelled'
+    conn.close()
+
+
+def test_recompute_and_clean_match_rebuild(conn):
+    conn.execute("UPDATE scores SET score = 0 WHERE mssv = 'SV005' AND academic_year = 1")
+    conn.execute("UPDATE scores SET score = -1 WHERE mssv = 'SV006' AND subject_key = 'triet'")
+    conn.commit()
+    app1.recompute_grades_chunk(conn)
+    conn.commit()
+    assert_matches_rebuild(conn)
+    app1.clean_data(conn)
+    assert_matches_rebuild(conn)
+
+
+def test_import_and_bulk_deletes_match_rebuild(conn):
+    corrected = random_grades(50, 3, seed=6)
+    corrected.loc[::5, 'triet'] = 2.0
+    text = corrected.to_csv(index=False)
+    upload = pd.read_csv(io.StringIO(text), dtype=app1.IMPORT_TEXT_DTYPES)
+    report = app1.import_grades_chunks(conn, [(upload, 1.0)], mode='upsert')
+    assert report['inserted'] > 0 and report['updated'] > 0
+    assert_matches_rebuild(conn)
+    app1.delete_grades_batch(conn, [r[0] for r in conn.execute("SELECT id FROM grades WHERE mssv < 'SV005'")])
+    assert_matches_rebuild(conn)
+    assert app1.delete_grades_where(conn, academic_year=2, class_name='A1') > 0
+    assert_matches_rebuild(conn)
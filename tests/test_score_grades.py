@@ -0,0 +1,71 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app1  # noqa: E402
+
+
+def reference(df):
+    """Kết quả tính từng dòng bằng calculate_average + calculate_grade"""
+    diem_tb = [app1.calculate_average(row) for _, row in df.iterrows()]
+    return diem_tb, [app1.calculate_grade(v) for v in diem_tb]
+
+
+def random_grades(count, seed):
+    """Bảng điểm ngẫu nhiên: khoảng 20% ô trống, 10% ô âm, số môn có điểm từ 0 tới đủ 9 môn"""
+    rng = np.random.default_rng(seed)
+    scores = rng.integers(0, 101, size=(count, len(app1.SUBJECTS))) / 10
+    scores[rng.random(scores.shape) < 0.1] *= -1
+    scores[rng.random(scores.shape) < 0.2] = np.nan
+    return pd.DataFrame(scores, columns=list(app1.SUBJECTS))
+
+
+def assert_matches_reference(df):
+    diem_tb, xep_loai = app1.score_grades(df)
+    expected_tb, expected_loai = reference(df)
+    assert diem_tb.tolist() == expected_tb
+    assert xep_loai.tolist() == expected_loai
+
+
+@pytest.mark.parametrize('row', [
+    {},                                                              # không có điểm nào
+    {key: -1.0 for key in app1.SUBJECTS},                            # toàn điểm âm
+    {'triet': 8.0},                                                  # chỉ một môn
+    {'triet': 8.0, 'giai_tich_1': -2.0, 'thvp': None},               # âm + trống bị bỏ qua
+    {'gdtc': 10.0},                                                  # môn không tính GPA
+    {'triet': 9.45, 'giai_tich_1': 9.55},                            # sát ngưỡng xếp loại
+], ids=['empty', 'negative', 'single', 'negative-missing', 'not-gpa', 'threshold'])
+def test_edge_rows(row):
+    df = pd.DataFrame([row], columns=list(app1.SUBJECTS), dtype=float)
+    assert_matches_reference(df)
+
+
+def test_eight_or_more_scores():
+    # Từ 8 điểm np.mean cộng theo cặp - kết quả phải giống hệt, kể cả chữ số làm tròn
+    df = random_grades(2000, seed=4)
+    df.loc[:, app1.GPA_SUBJECTS] = df[app1.GPA_SUBJECTS].abs().fillna(7.3)
+    df.loc[df.index[::2], app1.GPA_SUBJECTS[0]] = np.nan
+    valid = (df[app1.GPA_SUBJECTS] >= 0).sum(axis=1)
+    assert set(valid.unique()) == {8, 9}
+    assert_matches_reference(df)
+
+
+def test_random_rows():
+    assert_matches_reference(random_grades(5000, seed=1))
+
+
+def test_matrix_input():
+    df = random_grades(500, seed=2)
+    diem_tb, xep_loai = app1.score_grades(df[app1.GPA_SUBJECTS].to_numpy())
+    expected_tb, expected_loai = reference(df)
+    assert diem_tb.tolist() == expected_tb
+    assert xep_loai.tolist() == expected_loai
+
+
+def test_no_rows():
+    diem_tb, xep_loai = app1.score_grades(pd.DataFrame(columns=list(app1.SUBJECTS)))
+    assert len(diem_tb) == 0 and len(xep_loai) == 0
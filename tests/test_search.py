@@ -0,0 +1,51 @@
+import os
+import sys
+import unicodedata
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app1  # noqa: E402
+
+NAMES = ['Nguyễn Văn An', 'Trần Đức Bình', 'Lê Thị Cúc', 'Nguyên Hà']
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = app1.init_db(str(tmp_path / 'search.db'))
+    frame = pd.DataFrame({'mssv': [f"SV{i}" for i in range(len(NAMES))], 'student_name': NAMES,
+                          'class_name': 'A1', 'semester': 1, 'academic_year': 1, 'triet': 7.0})
+    frame['diem_tb'], frame['xep_loai'] = app1.score_grades(frame.reindex(columns=list(app1.SUBJECTS)))
+    app1.insert_grades(conn, frame.reindex(columns=app1.GRADE_COLUMNS))
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+@pytest.mark.parametrize('term, expected', [
+    ('nguyen', ['SV0', 'SV3']),                   # không dấu khớp cả "Nguyễn" và "Nguyên"
+    ('NGUYỄN', ['SV0', 'SV3']),
+    ('duc', ['SV1']),                             # "đ" gấp thành "d"
+    ('Đức', ['SV1']),
+    (unicodedata.normalize('NFD', 'Đức'), ['SV1']),  # chuỗi nhập dạng tổ hợp
+    ('cu', ['SV2']),                              # tiền tố
+    ('sv3', ['SV3']),
+    ('nguyen an', ['SV0']),
+    ('xyz', []),
+])
+def test_search_ignores_diacritics(conn, term, expected):
+    assert sorted(app1.search_grades(conn, term)['mssv']) == expected
+
+
+def test_search_follows_renames(conn):
+    conn.execute("UPDATE grades SET student_name = 'Phạm Đăng Khoa' WHERE mssv = 'SV1'")
+    conn.commit()
+    assert app1.search_grades(conn, 'duc').empty
+    assert app1.search_grades(conn, 'dang')['mssv'].tolist() == ['SV1']
+
+
+def test_ranking_search_ignores_diacritics(conn):
+    app1.refresh_rankings(conn)
+    page_df, total = app1.query_ranking_page(conn, '1', 1, search='duc')
+    assert (page_df['mssv'].tolist(), total) == (['SV1'], 1)
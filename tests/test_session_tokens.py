@@ -0,0 +1,66 @@
+import base64
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app1  # noqa: E402
+
+FIELDS = {'username': 'sv1', 'user_id': 7, 'fullname': 'Nguyễn Văn A', 'role': 'student', 'student_id': 'SV1'}
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = app1.init_db(str(tmp_path / 'sessions.db'))
+    yield conn
+    conn.close()
+
+
+def test_valid_token(conn):
+    assert app1.resolve_session_token(conn, app1.issue_session_token(FIELDS)) == FIELDS
+
+
+@pytest.mark.parametrize('token', [
+    None, '', 'junk', 'abc.', '.abc',
+    'abc.é',                                   # ký tự ngoài ASCII ở chữ ký
+    'abc.' + 'é' * 64,
+    'é.' + '0' * 64,                           # ký tự ngoài ASCII ở nội dung
+    'abc.' + '0' * 64,                         # chữ ký đúng dạng nhưng sai
+], ids=['none', 'empty', 'junk', 'no-signature', 'no-payload', 'non-ascii', 'non-ascii-64', 'non-ascii-payload',
+        'forged'])
+def test_rejects_malformed(conn, token):
+    assert app1.resolve_session_token(conn, token) is None
+
+
+def test_rejects_tampered(conn):
+    token = app1.issue_session_token(FIELDS)
+    payload, signature = token.rsplit('.', 1)
+    claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    claims['user']['role'] = 'teacher'
+    forged = base64.urlsafe_b64encode(json.dumps(claims).encode()).decode().rstrip('=')
+    assert app1.resolve_session_token(conn, f"{forged}.{signature}") is None
+    flipped = signature[:-1] + ('0' if signature[-1] != '0' else '1')
+    assert app1.resolve_session_token(conn, f"{payload}.{flipped}") is None
+
+
+def test_rejects_expired(conn, monkeypatch):
+    monkeypatch.setattr(app1, 'SESSION_TTL_SECONDS', -1)
+    assert app1.resolve_session_token(conn, app1.issue_session_token(FIELDS)) is None
+
+
+def test_revoked_token(conn):
+    token, other = app1.issue_session_token(FIELDS), app1.issue_session_token(FIELDS)
+    app1.revoke_session_token(conn, token)
+    assert app1.resolve_session_token(conn, token) is None
+    assert app1.resolve_session_token(conn, other) == FIELDS
+
+
+def test_deleted_user_tokens_revoked(conn):
+    conn.execute("INSERT INTO users (username, password, fullname, role) VALUES ('sv1', 'x', 'A', 'student')")
+    conn.commit()
+    user_id = conn.execute("SELECT id FROM users WHERE username = 'sv1'").fetchone()[0]
+    token = app1.issue_session_token({**FIELDS, 'user_id': user_id})
+    app1.delete_user(conn, user_id)
+    assert app1.resolve_session_token(conn, token) is None